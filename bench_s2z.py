@@ -0,0 +1,387 @@
+#!/usr/bin/python
+"""
+Benchmarks for scrapbook2zotero migration tool
+
+Generates synthetic Scrapbook directory of given size and measures every
+phase of export: parse, tree build, lost items fixup, export and write,
+and check of written file (verify subcommand).
+Writing the same items straight into Zotero database (--format=sqlite) is
+measured as sqlite phase, to compare it with export and write.
+Rendering of a single item is measured separately as micro-benchmark.
+Results are saved as JSON to compare them between commits:
+
+    make bench
+    ./bench_s2z.py --items 50000 --output tmp/bench-new.json --compare tmp/bench-old.json
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+    Copyright (C) 2018 Roman V. Isaev
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import random
+import datetime
+import argparse
+import subprocess
+import resource
+import scrapbook2zotero
+
+RDF_HEADER = u"""<?xml version="1.0"?>
+<RDF:RDF xmlns:NS1="http://amb.vis.ne.jp/mozilla/scrapbook-rdf#"
+         xmlns:NC="http://home.netscape.com/NC-rdf#"
+         xmlns:RDF="http://www.w3.org/1999/02/22-rdf-syntax-ns#">"""
+
+RDF_DESCRIPTION = u"""
+  <RDF:Description RDF:about="urn:scrapbook:item{0}"
+                   NS1:id="{0}"
+                   NS1:create="{0}"
+                   NS1:modify="{0}"
+                   NS1:type="{1}"
+                   NS1:title="{2}"
+                   NS1:chars="UTF-8"
+                   NS1:comment=""
+                   NS1:icon=""
+                   NS1:source="{3}" />"""
+
+def escape(text):
+    """ Escape text for XML attribute """
+    return (text.replace(u'&', u'&amp;').replace(u'<', u'&lt;')
+            .replace(u'>', u'&gt;').replace(u'"', u'&quot;'))
+
+def make_ids(count):
+    """ Generate count unique Scrapbook ids, one second apart """
+    start = datetime.datetime(2010, 1, 1)
+    return [(start + datetime.timedelta(seconds=idx)).strftime('%Y%m%d%H%M%S')
+            for idx in range(count)]
+
+def make_item_dir(path, nodeid, title, source, pdf):
+    """ Create data directory of saved page """
+    basedir = os.path.join(path, 'data', nodeid)
+    os.makedirs(basedir)
+    with io.open(os.path.join(basedir, 'index.html'), 'w', encoding='utf-8') as filehandle:
+        filehandle.write(u"<html><head><title>%s</title></head><body>%s</body></html>\n"
+                         % (escape(title), u"Lorem ipsum dolor sit amet. " * 20))
+    with io.open(os.path.join(basedir, 'index.dat'), 'w', encoding='utf-8') as filehandle:
+        filehandle.write(u"id\t%s\ncreate\t%s\ntype\t\ntitle\t%s\nchars\tUTF-8\nsource\t%s\n"
+                         % (nodeid, nodeid, title, source))
+    if pdf:
+        with open(os.path.join(basedir, 'document.pdf'), 'wb') as filehandle:
+            filehandle.write(b"%PDF-1.4\n%%EOF\n")
+
+def make_scrapbook(path, items=1000, depth=3, pdf_ratio=0.1, dup_ratio=0.1,
+                   lost_folders=0, lost_items=0, seed=1):
+    """ Generate synthetic Scrapbook directory
+
+    Args:
+        path: directory to create, removed first if exists
+        items: number of saved pages
+        depth: depth of folder tree
+        pdf_ratio: fraction of pages with PDF attachment
+        dup_ratio: fraction of pages with title of some other page
+        lost_folders: number of data directories without RDF entry
+        lost_items: number of pages with RDF entry but without parent folder
+        seed: random seed, same arguments and seed give same scrapbook
+    """
+    rnd = random.Random(seed)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(os.path.join(path, 'data'))
+
+    # about 8 items per folder, spread over depth levels
+    folder_count = max(1, items // 8)
+    ids = make_ids(items + folder_count + lost_folders)
+    folder_ids = ids[items:items + folder_count]
+    folders = [('urn:scrapbook:root', 0)]
+    children = {'urn:scrapbook:root': []}
+    entries = []
+    for idx, nodeid in enumerate(folder_ids):
+        name = 'urn:scrapbook:item' + nodeid
+        candidates = [folder for folder in folders if folder[1] < depth]
+        parent = rnd.choice(candidates) if candidates else folders[0]
+        children[parent[0]].append(name)
+        children[name] = []
+        folders.append((name, parent[1] + 1))
+        entries.append(RDF_DESCRIPTION.format(nodeid, u'folder', u'Folder %d' % idx, u''))
+
+    titles = []
+    for idx, nodeid in enumerate(ids[:items]):
+        if titles and rnd.random() < dup_ratio:
+            title = rnd.choice(titles)
+        else:
+            title = u'Page %d & friends' % idx
+            titles.append(title)
+        source = u'http://example.com/%d/page.html?a=1&b=2' % idx
+        entries.append(RDF_DESCRIPTION.format(nodeid, u'', escape(title), escape(source)))
+        make_item_dir(path, nodeid, title, source, rnd.random() < pdf_ratio)
+        if idx >= items - lost_items:
+            # no parent
+            continue
+        children[rnd.choice(folders)[0]].append('urn:scrapbook:item' + nodeid)
+
+    for nodeid in ids[items + folder_count:]:
+        make_item_dir(path, nodeid, u'Lost ' + nodeid, u'', False)
+
+    with io.open(os.path.join(path, 'scrapbook.rdf'), 'w', encoding='utf-8') as filehandle:
+        filehandle.write(RDF_HEADER)
+        for name, _ in folders:
+            filehandle.write(u'\n  <RDF:Seq RDF:about="%s">' % name)
+            for child in children[name]:
+                filehandle.write(u'\n    <RDF:li RDF:resource="%s"/>' % child)
+            filehandle.write(u'\n  </RDF:Seq>')
+        filehandle.writelines(entries)
+        filehandle.write(u'\n</RDF:RDF>\n')
+
+def peak_rss():
+    """ Peak resident set size of this process in KB """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def fresh_tree(items, manifest):
+    """ Tree of items as open_scrapbook_rdf() makes it, export changes names of nodes """
+    S2Z = scrapbook2zotero
+    nodes = {}
+    root = S2Z.load_node(S2Z.ROOT_ID, items, nodes)
+    S2Z.fix_lost_items(items, root, nodes)
+    S2Z.fix_lost_folders(items, root, manifest)
+    return root
+
+def run_phases(path, output, workers=2):
+    """ Run all export phases one by one
+
+    Args:
+        path: scrapbook directory
+        output: RDF file to write
+        workers: number of processes of 'workers' phase, export with --workers
+
+    Returns:
+        list of (phase name, seconds) tuples and number of exported items
+    """
+    S2Z = scrapbook2zotero
+    phases = []
+
+    def phase(name, function, *args):
+        """ Time a single phase """
+        started = time.time()
+        result = function(*args)
+        phases.append((name, time.time() - started, peak_rss()))
+        return result
+
+    items = phase('parse', S2Z.rdf_file_to_items, path + '/scrapbook.rdf')
+    items[S2Z.ROOT_ID] = items[S2Z.ROOT_ID]._replace(type=u'folder')
+    nodes = {}
+    root = phase('tree', S2Z.load_node, S2Z.ROOT_ID, items, nodes)
+    manifest = S2Z.DataManifest(path)
+    phase('scan', manifest.scan)
+    phase('fixup', lambda: (S2Z.fix_lost_items(items, root, nodes),
+                            S2Z.fix_lost_folders(items, root, manifest)))
+    fragments = phase('export', list, S2Z.export_rdf(root, path, manifest))
+    def write():
+        """ Write prepared fragments """
+        with io.open(output, 'w', encoding='utf-8',
+                     buffering=S2Z.WRITE_BUFFER_SIZE) as filehandle:
+            filehandle.writelines(fragments)
+    phase('write', write)
+    phase('verify', S2Z.RdfVerifier().verify, output)
+    exported = sum(fragment.count(u'<bib:Document ') for fragment in fragments)
+
+    root = fresh_tree(items, manifest)
+    rendered = phase('workers', list, S2Z.export_rdf(root, path, manifest, workers=workers))
+    assert rendered == fragments, "output of --workers differs"
+    del rendered
+
+    root = fresh_tree(items, manifest)
+    dbfilename = os.path.splitext(output)[0] + '.sqlite'
+    make_zotero_db(dbfilename)
+    phase('sqlite', S2Z.export_sqlite, root, path, manifest, dbfilename)
+    return phases, exported
+
+def make_zotero_db(filename):
+    """ Create empty Zotero database from zotero_schema.sql """
+    import sqlite3
+    if os.path.exists(filename):
+        os.remove(filename)
+    connection = sqlite3.connect(filename)
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'zotero_schema.sql')) as filehandle:
+        connection.executescript(filehandle.read())
+    connection.close()
+
+def micro_benchmarks(repeat=20000):
+    """ Cost of rendering single item, escaping single field, formatting date
+    and checking record number against --exclude selectors
+
+    Returns:
+        dict() of microseconds per call by benchmark name
+    """
+    S2Z = scrapbook2zotero
+    job = S2Z.ItemJob('20100101000000', u'Page 1 & friends', u'http://example.com/1?a=1&b=2',
+                      u'Folder 1/Folder 2', u'2010-01-01 00:00:00', 'scrapbook/data/20100101000000',
+                      'scrapbook/data/20100101000000/index.html', ['document.pdf'])
+    plain = u'How to install SeaMonkey on Ubuntu Linux | LinuxPitStop'
+    special = u'http://example.com/?q="a<b>"&x=1'
+    def strptime(nodeid):
+        """ Old way of formatting item date """
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.strptime(nodeid, '%Y%m%d%H%M%S'))
+    # 1000 numbers and 1000 ranges, like a long list of problem records
+    selector = S2Z.Selector([str(number) for number in range(1, 20000, 20)] +
+                            ['%d-%d' % (number, number + 5) for number in range(10, 20000, 20)])
+    node = S2Z.Node(job.nodeid, None)
+    benchmarks = [('render_item', S2Z.render_item, job),
+                  ('selector', lambda number: selector.matches(number, node), 15000),
+                  ('xml_escape plain', S2Z.xml_escape, plain),
+                  ('xml_escape special', S2Z.xml_escape, special),
+                  ('format_timestamp', S2Z.format_timestamp, job.nodeid),
+                  ('strptime', strptime, job.nodeid)]
+    results = {}
+    for name, function, arg in benchmarks:
+        started = time.time()
+        for _ in range(repeat):
+            function(arg)
+        results[name] = (time.time() - started) / repeat * 1e6
+    return results
+
+def startup_times(repeat=20):
+    """ Start time of script and frozen executable, if it is built
+
+    Every run is a new process, so it includes interpreter start and imports.
+
+    Returns:
+        list of (command, best milliseconds, median milliseconds) tuples
+    """
+    commands = [[sys.executable, 'scrapbook2zotero.py', '--version']]
+    if os.path.exists('dist/scrapbook2zotero.exe'):
+        commands.append((['wine'] if os.name != 'nt' else []) +
+                        ['dist/scrapbook2zotero.exe', '--version'])
+    elif os.path.exists('dist/scrapbook2zotero'):
+        commands.append(['dist/scrapbook2zotero', '--version'])
+    results = []
+    with open(os.devnull, 'w') as devnull:
+        for command in commands:
+            times = []
+            for _ in range(repeat):
+                started = time.time()
+                subprocess.call(command, stdout=devnull, stderr=devnull)
+                times.append((time.time() - started) * 1000)
+            times.sort()
+            results.append((' '.join(command), times[0], times[len(times) // 2]))
+    return results
+
+def git_revision():
+    """ Current commit, to tell results apart """
+    try:
+        return subprocess.check_output(['git', 'describe', '--abbrev=4', '--dirty',
+                                        '--always', '--tags']).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def report(results, previous=None):
+    """ Print results table, compared to previous results if given """
+    sys.stdout.write("%d items, revision %s\n" % (results['items'], results['revision']))
+    sys.stdout.write("%-8s %10s %12s %12s %10s\n"
+                     % ('phase', 'seconds', 'items/sec', 'peak RSS KB', 'change'))
+    old = dict((phase['name'], phase) for phase in previous['phases']) if previous else {}
+    for phase in results['phases']:
+        change = ''
+        if phase['name'] in old and old[phase['name']]['seconds'] > 0:
+            change = '%+.0f%%' % ((phase['seconds'] / old[phase['name']]['seconds'] - 1) * 100)
+        sys.stdout.write("%-8s %10.3f %12.0f %12d %10s\n"
+                         % (phase['name'], phase['seconds'], phase['items_per_sec'],
+                            phase['peak_rss_kb'], change))
+    old = previous.get('micro', {}) if previous else {}
+    for name, usec in sorted(results.get('micro', {}).items()):
+        change = ''
+        if old.get(name):
+            change = '%+.0f%%' % ((usec / old[name] - 1) * 100)
+        sys.stdout.write("%-20s %8.2f us/call %10s\n" % (name, usec, change))
+
+def main(argv):
+    """ Generate scrapbook, run benchmark, save and print results """
+    parser = argparse.ArgumentParser(description="Benchmark scrapbook2zotero export phases")
+    parser.add_argument('--items', type=int, default=10000, help="Number of saved pages")
+    parser.add_argument('--depth', type=int, default=3, help="Folder tree depth")
+    parser.add_argument('--pdf-ratio', type=float, default=0.1,
+                        help="Fraction of pages with PDF attachments")
+    parser.add_argument('--dup-ratio', type=float, default=0.1,
+                        help="Fraction of pages with duplicate titles")
+    parser.add_argument('--lost-folders', type=int, default=10,
+                        help="Number of data directories without RDF entries")
+    parser.add_argument('--lost-items', type=int, default=10,
+                        help="Number of RDF entries without parent folder")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed")
+    parser.add_argument('--workers', type=int, default=2,
+                        help="Number of processes rendering items in 'workers' phase")
+    parser.add_argument('--workdir', default='tmp/bench',
+                        help="Directory for generated scrapbook and output")
+    parser.add_argument('--output', metavar='FILE',
+                        help="Save results as JSON, default is WORKDIR/REVISION.json")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="Compare with results saved before")
+    parser.add_argument('--startup', action='store_true',
+                        help="Only measure start time of script and dist/ executable")
+    parsed = parser.parse_args(argv)
+
+    if parsed.startup:
+        sys.stdout.write("%10s %10s  command\n" % ('best ms', 'median ms'))
+        for command, best, median in startup_times():
+            sys.stdout.write("%10.1f %10.1f  %s\n" % (best, median, command))
+        return
+
+    path = os.path.join(parsed.workdir, 'scrapbook')
+    params = dict(items=parsed.items, depth=parsed.depth, pdf_ratio=parsed.pdf_ratio,
+                  dup_ratio=parsed.dup_ratio, lost_folders=parsed.lost_folders,
+                  lost_items=parsed.lost_items, seed=parsed.seed)
+    # generated scrapbook is reused while parameters are the same
+    paramsfname = os.path.join(parsed.workdir, 'scrapbook.json')
+    try:
+        with open(paramsfname) as filehandle:
+            reuse = json.load(filehandle) == params
+    except (IOError, ValueError):
+        reuse = False
+    if not reuse:
+        sys.stdout.write("generating %d items in %s\n" % (parsed.items, path))
+        make_scrapbook(path, **params)
+        with open(paramsfname, 'w') as filehandle:
+            json.dump(params, filehandle)
+
+    phases, exported = run_phases(path, os.path.join(parsed.workdir, 'output.rdf'),
+                                  parsed.workers)
+    results = {'revision': git_revision(), 'params': params, 'items': exported,
+               'phases': [{'name': name, 'seconds': seconds,
+                           'items_per_sec': exported / seconds if seconds > 0 else 0,
+                           'peak_rss_kb': rss}
+                          for name, seconds, rss in phases],
+               'micro': micro_benchmarks()}
+    output = parsed.output or os.path.join(parsed.workdir, results['revision'] + '.json')
+    with open(output, 'w') as filehandle:
+        json.dump(results, filehandle, indent=2)
+    previous = None
+    if parsed.compare:
+        with open(parsed.compare) as filehandle:
+            previous = json.load(filehandle)
+    report(results, previous)
+    sys.stdout.write("results saved to %s\n" % output)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
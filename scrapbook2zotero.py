@@ -40,10 +40,21 @@ import sys
 import time
 import argparse
 import fnmatch
-import rdflib
-# import these to help pyinstaller
-import rdflib.plugins.memory
-import rdflib.plugins.parsers.rdfxml
+import re
+import bisect
+import hashlib
+import json
+import copy
+import marshal
+import codecs
+import shutil
+import contextlib
+import collections
+import xml.etree.cElementTree as ElementTree
+import xml.parsers.expat as expat
+# Slow to import and not always needed modules (rdflib, multiprocessing,
+# cProfile, scandir, sqlite3, HTMLParser, zipfile, urllib) are imported where
+# they are used, to start fast
 
 # Enforce python 2 (for many reasons, including win32 test environment)
 assert sys.version_info.major==2, 'Python 2 required'
@@ -51,48 +62,341 @@ assert sys.version_info.major==2, 'Python 2 required'
 # SemVer
 VERSION = "1.0.2"
 
-def debug(msg):
-    """ Print debug message if --debug option was given """
-    if Args.debug:
-        sys.stderr.write('DEBUG: ' + msg + '\n')
+class ExportError(Exception):
+    """ Export of a scrapbook can't go on, the message says why """
+    pass
+
+class Stats(object):
+    """ Phase timers and counters for --stats option
+
+    Phase times and counters are always collected: there are just a few
+    phases, a counter is a dict update per item, and batch and bisect read
+    counters of runs without --stats. Timing of every fragment by timed()
+    and anything costing more per item is done only when enabled.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.times = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+
+    def reset(self, enabled=False):
+        """ Forget everything collected so far """
+        self.enabled = enabled
+        self.times.clear()
+        self.counters.clear()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Context manager adding time spent inside to phase name """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0.0) + time.time() - started
+
+    def timed(self, name, iterable):
+        """ Add time spent generating items of iterable to phase name,
+        not counting time spent by consumer """
+        if not self.enabled:
+            return iterable
+        return self._timed(name, iterable)
+
+    def _timed(self, name, iterable):
+        """ Generator for timed() """
+        iterator = iter(iterable)
+        spent = 0.0
+        try:
+            while True:
+                started = time.time()
+                try:
+                    value = next(iterator)
+                finally:
+                    spent += time.time() - started
+                yield value
+        except StopIteration:
+            return
+        finally:
+            self.times[name] = self.times.get(name, 0.0) + spent
+
+    def add(self, name, value=1):
+        """ Increase counter name by value """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self):
+        """ Everything collected as dict() for JSON """
+        return {'phases': self.times, 'counters': self.counters}
+
+    def report(self, filehandle):
+        """ Print summary """
+        for name, seconds in self.times.items():
+            filehandle.write("STATS: %-20s %10.3f s\n" % (name, seconds))
+        for name, value in self.counters.items():
+            filehandle.write("STATS: %-20s %10d\n" % (name, value))
+
+STATS = Stats()
+
+# --debug option of current run, set by run()
+DEBUG = False
+
+def debug(msg, *args):
+    """ Print debug message if --debug option was given
+
+    Message is formatted with args only when it is printed.
+    """
+    if DEBUG:
+        sys.stderr.write('DEBUG: ' + (msg % args if args else msg) + '\n')
+
+def decode_arg(value):
+    """ Command line argument as unicode, python 2 gives bytes """
+    if not isinstance(value, bytes):
+        return value
+    try:
+        return value.decode(sys.getfilesystemencoding() or 'utf-8')
+    except UnicodeDecodeError:
+        # C locale, but UTF-8 terminal
+        return value.decode('utf-8', 'replace')
+
+RDF_NAMESPACE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+NS1_NAMESPACE = "http://amb.vis.ne.jp/mozilla/scrapbook-rdf#"
+
+# Parser engines for --parser option, first one is the default
+PARSERS = ('stream', 'rdflib')
+
+def import_rdflib():
+    """ Import rdflib, it is optional and takes long to import
+
+    Returns:
+        rdflib module or None if it is not installed
+    """
+    try:
+        import rdflib
+        # import these to help pyinstaller
+        import rdflib.plugins.memory # pylint: disable=unused-variable
+        import rdflib.plugins.parsers.rdfxml # pylint: disable=unused-variable
+    except ImportError:
+        # rdflib is optional, built-in stream parser is used by default
+        return None
+    return rdflib
+
+def iter_triples_rdflib(filename):
+    """ Read triples from rdf file with rdflib
 
-def rdf_to_dict(path):
-    """Read and return dictionary of parsed rdf file as dict()
     Args:
-        path: Path to scrapbook directory
+        filename: rdf file to read
     Returns:
-        A ``Dict`` object with parsed rdf data
+        Iterator over (subject, predicate, object) triples with full URIs
     """
 
+    rdflib = import_rdflib()
     graph = rdflib.Graph()
-    graph.parse(path + "/scrapbook.rdf")
-    rdf_namespace = rdflib.Namespace("http://www.w3.org/1999/02/22-rdf-syntax-ns#")
-    ns1_namespace = rdflib.Namespace("http://amb.vis.ne.jp/mozilla/scrapbook-rdf#")
-    items = dict()
-
+    graph.parse(filename)
     for itemname, propname, value in graph:
+        # to string, or triggers strange behavior
+        yield itemname.toPython(), propname.toPython(), value
+
+def iter_triples_stream(filename):
+    """ Read triples from rdf file without building a graph
+
+    Understands the RDF/XML dialect written by Scrapbook: node elements
+    (RDF:Description, RDF:Seq) directly under RDF:RDF with properties as
+    attributes or as RDF:li / property child elements. Elements are dropped
+    as soon as they are processed, so memory use does not depend on file size.
+
+    Args:
+        filename: rdf file to read
+    Returns:
+        Iterator over (subject, predicate, object) triples with full URIs,
+        same as iter_triples_rdflib()
+    """
+
+    rdf = '{' + RDF_NAMESPACE + '}'
+    about = rdf + 'about'
+    resource = rdf + 'resource'
+    description = rdf + 'Description'
+    listitem = rdf + 'li'
+    # syntax attributes, they are not properties
+    syntax = (about, rdf + 'ID', rdf + 'nodeID', rdf + 'bagID')
+
+    document = None
+    depth = 0
+    subject = None
+    listidx = 0
+    for event, elem in ElementTree.iterparse(filename, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 1:
+                document = elem
+            elif depth == 2:
+                # node element
+                subject = elem.get(about)
+                listidx = 0
+                if subject is None:
+                    continue
+                if elem.tag != description:
+                    # typed node, i.e. RDF:Seq
+                    yield subject, RDF_NAMESPACE + 'type', elem.tag[1:].replace('}', '', 1)
+                for propname, value in elem.items():
+                    if propname.startswith('{') and propname not in syntax:
+                        yield subject, propname[1:].replace('}', '', 1), value
+            continue
+
+        if depth == 3 and subject is not None:
+            # property element
+            if elem.tag == listitem:
+                listidx += 1
+                propname = RDF_NAMESPACE + '_' + str(listidx)
+            else:
+                propname = elem.tag[1:].replace('}', '', 1)
+            value = elem.get(resource)
+            if value is None:
+                value = elem.text or ''
+            yield subject, propname, value
+        elif depth == 2:
+            # node element is done, forget it and its children
+            document.clear()
+        depth -= 1
+
+def iter_items_triples(filename, parser=PARSERS[0]):
+    """ Read triples of scrapbook items from rdf file
+
+    Args:
+        filename: rdf file to read
+        parser: parser engine, one of PARSERS
+    Returns:
+        Iterator over (item id, property, value) triples, with
+        urn:scrapbook:item prefix removed from ids and values and with
+        NS1: and RDF: prefixes in property names
+    """
+
+    if parser == 'rdflib':
+        triples = iter_triples_rdflib(filename)
+    else:
+        triples = iter_triples_stream(filename)
+    debugging = DEBUG
+    count = 0
+
+    for itemname, propname, value in triples:
+        count += 1
 
-        itemname = itemname.toPython() # to string, or triggers strange behavior
         if itemname.startswith("urn:scrapbook:search"):
             # Dunno what's this but we don't care
             continue
         if itemname.startswith("urn:scrapbook:item"):
             itemname = itemname[18:]
         # There's also urn:scrapbook:root which is a root folder
-        item = items.setdefault(itemname, dict())
 
-        propname = propname.toPython()
-        if propname.startswith(ns1_namespace):
-            propname = 'NS1:'+propname[len(ns1_namespace):]
-        elif propname.startswith(rdf_namespace):
-            propname = 'RDF:'+propname[len(rdf_namespace):]
+        if propname.startswith(NS1_NAMESPACE):
+            propname = 'NS1:'+propname[len(NS1_NAMESPACE):]
+        elif propname.startswith(RDF_NAMESPACE):
+            propname = 'RDF:'+propname[len(RDF_NAMESPACE):]
 
         if value.startswith("urn:scrapbook:item"):
             value = value[18:]
 
-        item[propname] = value
+        if debugging:
+            debug("reading itemname='%s', propname='%s'", itemname, propname)
+        yield itemname, propname, value
+    STATS.add('triples read', count)
+
+def rdf_file_to_dict(filename, parser=PARSERS[0]):
+    """Read and return dictionary of parsed rdf file as dict()
+    Args:
+        filename: rdf file to read
+        parser: parser engine, one of PARSERS
+    Returns:
+        A ``Dict`` object with parsed rdf data
+    """
+
+    items = dict()
+    for itemname, propname, value in iter_items_triples(filename, parser):
+        items.setdefault(itemname, dict())[propname] = value
+    return items
+
+def rdf_to_dict(path, parser=PARSERS[0]):
+    """Read and return dictionary of parsed scrapbook.rdf as dict()
+    Args:
+        path: Path to scrapbook directory
+        parser: parser engine, one of PARSERS
+    Returns:
+        A ``Dict`` object with parsed rdf data
+    """
+
+    return rdf_file_to_dict(path + "/scrapbook.rdf", parser)
+
+# Id of root folder item
+ROOT_ID = 'urn:scrapbook:root'
+
+# Compact scrapbook item, only properties used for export.
+# children is a tuple of child item ids of a folder.
+Item = collections.namedtuple('Item', ['type', 'title', 'comment', 'source',
+                                       'create', 'modify', 'chars', 'children'])
+
+# Item field number by rdf property name
+ITEM_PROPERTIES = {'NS1:type': 0, 'NS1:title': 1, 'NS1:comment': 2, 'NS1:source': 3,
+                   'NS1:create': 4, 'NS1:modify': 5, 'NS1:chars': 6}
+
+# Few distinct values repeated in every item
+_INTERNED = {}
+
+def intern_value(value):
+    """ Return single shared copy of value """
+    return _INTERNED.setdefault(value, value)
+
+def make_item(record):
+    """ Make Item from [type, title, comment, source, create, modify, chars,
+    {child number: child id}] list """
+
+    children = ()
+    if record[7] is not None:
+        indexed = record[7]
+        children = []
+        # RDF:_1, RDF:_2, ... up to the first gap
+        while len(children) + 1 in indexed:
+            children.append(indexed[len(children) + 1])
+        children = tuple(children)
+    return Item(intern_value(unicode(record[0])), unicode(record[1]), unicode(record[2]),
+                unicode(record[3]), unicode(record[4]), unicode(record[5]),
+                intern_value(unicode(record[6])), children)
+
+def rdf_file_to_items(filename, parser=PARSERS[0]):
+    """ Read rdf file into compact item table
+
+    Args:
+        filename: rdf file to read
+        parser: parser engine, one of PARSERS
+    Returns:
+        dict() of Item by item id
+    """
+
+    records = {}
+    for itemname, propname, value in iter_items_triples(filename, parser):
+        record = records.get(itemname)
+        if record is None:
+            record = records[itemname] = [u'', u'', u'', u'', u'', u'', u'', None]
+        idx = ITEM_PROPERTIES.get(propname)
+        if idx is not None:
+            record[idx] = value
+        elif propname.startswith('RDF:_') and propname[5:].isdigit():
+            if record[7] is None:
+                record[7] = {}
+            record[7][int(propname[5:])] = value
+    items = {}
+    while records:
+        itemname, record = records.popitem()
+        items[itemname] = make_item(record)
+    return items
+
+def items_from_dict(rdfdict):
+    """ Convert dict() from rdf_to_dict() to item table of rdf_file_to_items() """
 
-        debug("reading itemname='%s', propname='%s'" % (itemname, propname))
+    items = {}
+    for itemname, item in rdfdict.items():
+        record = [item.get(propname, u'') for propname in sorted(ITEM_PROPERTIES,
+                                                                 key=ITEM_PROPERTIES.get)]
+        record.append(dict((int(propname[5:]), value) for propname, value in item.items()
+                           if propname.startswith('RDF:_') and propname[5:].isdigit()))
+        items[itemname] = make_item(record)
     return items
 
 def neuter_name(name):
@@ -108,206 +412,649 @@ def neuter_name(name):
         name = name.replace(char, '')
     return name
 
+def node_name(nodeid, title):
+    """ Name of node with given title, as used in tags and collections """
+
+    # Name is a neutered title, suitable for use as filename and ini-id
+    name = neuter_name(title).strip()
+    # Folders in Windows fail when name ends with dots
+    # We could've tested for type==folder, but some other types end up as folders too,
+    # so it's safer to just prohibit this at all.
+    # Spaces too.
+    name = name.rstrip('. ').lstrip(' ')
+    if name == '':
+        name = nodeid # guaranteed to be safe
+    return name
+
 class Node(object): # pylint: disable=too-few-public-methods
     """ Individual node object """
 
+    __slots__ = ('nodeid', 'children', 'type', 'name', 'comment', 'source', 'create',
+                 'modify', 'chars')
+
     def __init__(self, nodeid, item):
         # This can be created with item==None, for lost folders
         self.nodeid = nodeid
-        self.children = []
 
-        self.type = unicode(item['NS1:type']) if item is not None else ''
+        self.type = item.type if item is not None else ''
+        # only folders have children
+        self.children = [] if self.type == 'folder' else ()
 
         if item is not None:
-            title = unicode(item.get('NS1:title', '')) # root has no title
+            title = item.title # root has no title
         else:
             title = nodeid
+        self.name = node_name(nodeid, title)
 
-        # Name is a neutered title, suitable for use as filename and ini-id
-        self.name = neuter_name(title).strip()
-        # Folders in Windows fail when name ends with dots
-        # We could've tested for type==folder, but some other types end up as folders too,
-        # so it's safer to just prohibit this at all.
-        # Spaces too.
-        self.name = self.name.rstrip('. ').lstrip(' ')
-        if self.name == '':
-            self.name = self.nodeid # guaranteed to be safe
-
-        self.comment = unicode(item.get('NS1:comment', '')) if item is not None else ''
-        self.source = unicode(item.get('NS1:source', '')) if item is not None else ''
-
-def load_node(nodeid, item, items):
-    """ Recursive load nodes from root """
-
-    if 'node' in item:
-        return item['node'] # do not create a second one
-
-    node = Node(nodeid, item)
-    if node.type == 'folder':
-        idx = 1
-        while 'RDF:_'+str(idx) in item:
-            subitemid = item['RDF:_'+str(idx)]
-            subitem = items[subitemid]
-            subnode = load_node(subitemid, subitem, items)
-            node.children += [subnode]
-            idx += 1
+        self.comment = item.comment if item is not None else ''
+        self.source = item.source if item is not None else ''
+        self.create = item.create if item is not None else ''
+        self.modify = item.modify if item is not None else ''
+        self.chars = item.chars if item is not None else ''
+
+def load_node(itemid, items, nodes):
+    """ Load nodes from item, walking the tree without recursion
+
+    Links to missing items and links making a cycle are reported and skipped.
+
+    Args:
+        itemid: id of item to load
+        items: item table from rdf_file_to_items()
+        nodes: dict() of loaded nodes by item id, updated
+    Returns:
+        Node of itemid
+    """
+
+    if itemid in nodes:
+        return nodes[itemid] # do not create a second one
+
+    item = items[itemid]
+    root = Node('' if itemid == ROOT_ID else itemid, item)
+    # folders being loaded: (node, item id, iterator over child ids)
+    stack = []
+    if root.type == 'folder':
+        stack.append((root, itemid, iter(item.children)))
     else:
-        assert 'RDF:_1' not in item  # should not have child items
-        if node.type == 'note':
-            # text note
-            # title == first line
-            # icon can't be changed
-            # no formatting
-            pass
-        elif node.type == 'notex':
-            # note with additional formatting
-            # title can be changed arbitrarily
-            # icon can be changed
-            # limited formatting
-            pass
+        nodes[itemid] = root
+    # ids of items on stack to detect cycles
+    path = set(entry[1] for entry in stack)
+    while stack:
+        node, folderid, children = stack[-1]
+        for subitemid in children:
+            subitem = items.get(subitemid)
+            if subitem is None:
+                sys.stderr.write("ERROR: folder '%s' refers to missing item '%s'. "
+                                 "Skipping.\n" % (node.nodeid, subitemid))
+                continue
+            if subitemid in path:
+                cycle = [entry[1] for entry in stack]
+                cycle = cycle[cycle.index(subitemid):]
+                sys.stderr.write("ERROR: folder cycle %s -> %s. Skipping the last link.\n"
+                                 % (' -> '.join(cycle), subitemid))
+                continue
+            if subitemid in nodes:
+                node.children += [nodes[subitemid]] # do not create a second one
+                continue
+            subnode = Node(subitemid, subitem)
+            node.children += [subnode]
+            if subnode.type == 'folder':
+                stack.append((subnode, subitemid, iter(subitem.children)))
+                path.add(subitemid)
+                break
+            assert not subitem.children  # should not have child items
+            if subnode.type == 'note':
+                # text note
+                # title == first line
+                # icon can't be changed
+                # no formatting
+                pass
+            elif subnode.type == 'notex':
+                # note with additional formatting
+                # title can be changed arbitrarily
+                # icon can be changed
+                # limited formatting
+                pass
+            else:
+                # saved page
+                pass
+            nodes[subitemid] = subnode
         else:
-            # saved page
-            pass
+            # all children are loaded
+            stack.pop()
+            path.discard(folderid)
+            nodes[folderid] = node
+    return root
+
+def find_folders(items, specs):
+    """ Resolve --folder options to folder ids
+
+    Args:
+        items: item table from rdf_file_to_items()
+        specs: folder ids or paths of folder names from root, like 'Work/Projects'
+    Returns:
+        list of folder ids, without folders inside other found folders
+    Raises:
+        ExportError if a folder is not found
+    """
 
-    item['node'] = node # set backreference
-    return node
+    found = []
+    for spec in specs:
+        spec = decode_arg(spec)
+        if spec in items and spec != ROOT_ID:
+            if items[spec].type != u'folder':
+                raise ExportError("item '%s' is not a folder" % spec)
+            folderids = [spec]
+        else:
+            folderids = [ROOT_ID]
+            for name in [part for part in spec.split(u'/') if part]:
+                folderids = [childid for folderid in folderids
+                             for childid in items[folderid].children
+                             if childid in items and items[childid].type == u'folder'
+                             and name in (items[childid].title.strip(),
+                                          node_name(childid, items[childid].title))]
+            if not folderids or folderids == [ROOT_ID]:
+                raise ExportError("no folder '%s' in scrapbook.rdf" % spec)
+        found.extend(folderid for folderid in folderids if folderid not in found)
+    # subfolders of found folders are exported with them
+    inside = set()
+    for folderid in found:
+        stack = [folderid]
+        while stack:
+            for childid in items[stack.pop()].children:
+                item = items.get(childid)
+                if item is not None and item.type == u'folder' and childid not in inside:
+                    inside.add(childid)
+                    stack.append(childid)
+    return [folderid for folderid in found if folderid not in inside]
 
-def fix_lost_items(items, root):
+def fix_lost_items(items, root, nodes):
     """Attaches all items without a parent to a root folder"""
 
     lost_items = 0
-    for key, item in items.items():
-        if item['node'] is None:
+    for key in items:
+        if key not in nodes:
             lost_items += 1
-            root.children += [load_node(key, item, items)]
+            root.children += [load_node(key, items, nodes)]
     return lost_items
 
-def subfiles(a_dir):
-    """ Return list of files in a_dir
+# Directory listing: all entry names in directory order,
+# set of regular files and list of subdirectories
+DirEntries = collections.namedtuple('DirEntries', ['names', 'files', 'subdirs'])
+
+# Files looked up by name in item directories. Without scandir() only these
+# names are checked by stat(), see list_dir()
+ITEM_FILES = ('index.html', 'default.html', 'index.dat')
+
+def parallel_map(function, values, jobs=1, chunksize=16):
+    """ map() by jobs threads, for functions waiting for disk or releasing GIL
+
+    Returns:
+        list of results in order of values
+    """
+    if jobs <= 1 or len(values) <= 1:
+        return [function(value) for value in values]
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(jobs)
+    try:
+        return pool.map(function, values, chunksize=chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+# scandir() function or None, found on first use
+_SCANDIR = []
+
+def import_scandir():
+    """ Find scandir(), python 2 backport is slow to import (loads ctypes)
 
-    Args:
-      a_dir: directory to scan
     Returns:
-      List of files in a_dir
+        scandir function or None if there is none
     """
-    return [name for name in os.listdir(a_dir)
-            if os.path.isfile(os.path.join(a_dir, name))]
+    if not _SCANDIR:
+        try:
+            from os import scandir
+        except ImportError:
+            try:
+                # backport for python 2
+                from scandir import scandir
+            except ImportError:
+                scandir = None
+        _SCANDIR.append(scandir)
+    return _SCANDIR[0]
 
-def subdirs(a_dir):
-    """ Return list of subdirectories in a_dir
+def list_dir(a_dir, only=None):
+    """ Read directory a_dir with a single scan
+
+    Without scandir() every checked name costs a stat() call, which is slow
+    on network shares, so item directories are read with only=ITEM_FILES:
+    other names are not checked and are left out of files and subdirs
+    (PDFs are matched by name in names, as export did before).
 
     Args:
       a_dir: directory to scan
+      only: names to check without scandir(), all names if None
     Returns:
-      List of directories in a_dir
+      DirEntries of a_dir or None if a_dir can't be read
     """
-    return [name for name in os.listdir(a_dir)
-            if os.path.isdir(os.path.join(a_dir, name))]
+    scandir = import_scandir()
+    try:
+        if scandir is None:
+            names = os.listdir(a_dir)
+            checked = names if only is None else [name for name in only if name in names]
+            files = set(name for name in checked
+                        if os.path.isfile(os.path.join(a_dir, name)))
+            subdirs = [name for name in checked
+                       if name not in files and os.path.isdir(os.path.join(a_dir, name))]
+            return DirEntries(names, files, subdirs)
+        names = []
+        files = set()
+        subdirs = []
+        for entry in scandir(a_dir):
+            names.append(entry.name)
+            if entry.is_file():
+                files.add(entry.name)
+            elif entry.is_dir():
+                subdirs.append(entry.name)
+        return DirEntries(names, files, subdirs)
+    except OSError:
+        return None
 
-def fix_lost_folders(items, root, path):
-    """ Adds an entry for every data directory lacking an entry"""
+def list_item_dir(a_dir):
+    """ list_dir() of item directory, see ITEM_FILES """
+    return list_dir(a_dir, ITEM_FILES)
 
-    lost_folders = 0
-    for subdir in subdirs(path + '/data'):
-        if subdir in items:
-            continue
-        debug("found lost folder: %s" % subdir)
-        node = Node(subdir, None)
-        # try to guess the node type
-        files = subfiles(path + '/data/' + subdir)
-        if (len(files) == 1) and (files[0].lower() == 'index.html'):
-            node.type = "note"
+class DataManifest(object):
+    """ Listing of scrapbook data directory and item directories inside it
+
+    Every directory is read once, either in bulk by scan() or on first request,
+    or elsewhere and recorded by add().
+    """
+
+    def __init__(self, path, jobs=1):
+        if isinstance(path, bytes):
+            # read unicode names, same as export_node() paths
+            path = path.decode(sys.getfilesystemencoding() or 'utf-8')
+        self.path = path
+        self.jobs = jobs
+        self.entries = {}
+        # ids of directories with every name checked, see list_dir()
+        self.complete = set()
+        data = list_dir(path + '/data')
+        self.subdirs = data.subdirs if data is not None else []
+
+    def dirname(self, nodeid):
+        """ Path to item directory """
+        return "%s/data/%s" % (self.path, nodeid)
+
+    def scan(self, nodeids=None):
+        """ Read item directories, in parallel if jobs > 1
+
+        Args:
+          nodeids: ids of directories to read, all data subdirectories by default
+        """
+        if nodeids is None:
+            nodeids = self.subdirs
+        nodeids = [nodeid for nodeid in nodeids if nodeid not in self.entries]
+        dirnames = [self.dirname(nodeid) for nodeid in nodeids]
+        listings = parallel_map(list_item_dir, dirnames, self.jobs)
+        STATS.add('directory reads', len(dirnames))
+        self.entries.update(zip(nodeids, listings))
+
+    def read_index_dats(self, nodeids):
+        """ Read index.dat files of item directories, in parallel if jobs > 1
+
+        Args:
+          nodeids: ids of item directories
+        Returns:
+          dict() of read_index_dat() fields by node id, for directories
+          having index.dat
+        """
+        self.scan(nodeids)
+        nodeids = [nodeid for nodeid in nodeids if self.entries[nodeid] is not None and
+                   'index.dat' in self.entries[nodeid].files]
+        fields = parallel_map(read_index_dat,
+                              [self.dirname(nodeid) + '/index.dat' for nodeid in nodeids],
+                              self.jobs)
+        return dict(zip(nodeids, fields))
+
+    def add(self, nodeid, entries):
+        """ Record DirEntries of item directory read with every name checked """
+        self.entries[nodeid] = entries
+        self.complete.add(nodeid)
+
+    def get(self, nodeid):
+        """ DirEntries of item directory or None if there is no such directory """
+        if nodeid not in self.entries:
+            STATS.add('directory reads')
+            self.entries[nodeid] = list_item_dir(self.dirname(nodeid))
+        return self.entries[nodeid]
+
+def item_from_index_dat(fields):
+    """ Make Item from index.dat fields, see read_index_dat() """
+    return Item(intern_value(fields.get(u'type', u'')), fields.get(u'title', u''),
+                fields.get(u'comment', u''), fields.get(u'source', u''),
+                fields.get(u'create', u''), fields.get(u'modify', u''),
+                intern_value(fields.get(u'chars', u'')), ())
+
+def fix_lost_folders(items, root, manifest):
+    """ Adds an entry for every data directory lacking an entry
+
+    Title, source, type and times are taken from index.dat of the
+    directory, if there is one.
+    """
+
+    lost = [subdir for subdir in manifest.subdirs if subdir not in items]
+    index_dats = manifest.read_index_dats(lost)
+    for subdir in lost:
+        debug("found lost folder: %s", subdir)
+        fields = index_dats.get(subdir)
+        if fields is not None:
+            node = Node(subdir, item_from_index_dat(fields))
         else:
-            node.type = ""
+            node = Node(subdir, None)
+            # try to guess the node type
+            entries = manifest.get(subdir)
+            if (entries is not None and import_scandir() is None and
+                    subdir not in manifest.complete):
+                # only ITEM_FILES were checked, this needs all files
+                entries = list_dir(manifest.dirname(subdir))
+            files = [name for name in entries.names if name in entries.files] if entries else []
+            if (len(files) == 1) and (files[0].lower() == 'index.html'):
+                node.type = "note"
+            else:
+                node.type = ""
         root.children += [node]
-        lost_folders += 1
-    return lost_folders
+    return len(lost)
+
+def check_index_dats(items, manifest):
+    """ Compare items of scrapbook.rdf with index.dat files of their directories
+
+    Differences are printed as warnings.
+
+    Returns:
+        number of items with differences
+    """
+
+    nodeids = [subdir for subdir in manifest.subdirs if subdir in items]
+    mismatches = 0
+    for nodeid, fields in sorted(manifest.read_index_dats(nodeids).items()):
+        item = items[nodeid]
+        for name, value in ((u'title', item.title), (u'source', item.source),
+                            (u'type', item.type)):
+            if name in fields and fields[name] != value:
+                sys.stderr.write((u"WARNING: item %s: %s is '%s' in scrapbook.rdf and '%s' "
+                                  u"in index.dat\n" % (nodeid, name, value, fields[name]))
+                                 .encode('utf-8'))
+                mismatches += 1
+    STATS.add('index.dat mismatches', mismatches)
+    return mismatches
 
-def open_scrapbook_rdf(path):
+def open_scrapbook_rdf(path, parser=PARSERS[0], manifest=None, check_index_dat=False,
+                       cache=None, folders=None, lost=None):
     """Parse rdf file and turn it to the tree
 
     Args:
         path: Path to Scrapbook directory
+        parser: parser engine, one of PARSERS
+        manifest: DataManifest of path, created if not given
+        check_index_dat: compare items with their index.dat files
+        cache: ItemCache to take item table from instead of parsing
+        folders: --folder options, if given, only these folders are loaded
+            as children of root, without looking for lost items and folders
+        lost: list to add nodes of lost items and folders to, they are
+            children of root too
     Returns:
         root: root of the tree
-        items: items dict()
+        nodes: dict() of nodes by item id, for all items of rdf file
     """
 
-    debug("rdf path is " + path)
-    items = rdf_to_dict(path)
-    items['urn:scrapbook:root']['NS1:type'] = 'folder' # force explicit
-    root = load_node('', items['urn:scrapbook:root'], items)
-    lost_items = fix_lost_items(items, root)
+    debug("rdf path is %s", path)
+    rdffilename = path + "/scrapbook.rdf"
+    try:
+        items = cache.load(rdffilename, parser) if cache is not None else None
+        if items is not None:
+            STATS.add('item cache hits')
+        else:
+            with STATS.phase('parse'):
+                items = rdf_file_to_items(rdffilename, parser)
+            if cache is not None:
+                STATS.add('item cache misses')
+                cache.save(rdffilename, parser, items)
+    except (IOError, OSError, SyntaxError) as error:
+        # SyntaxError is base of ElementTree.ParseError
+        raise ExportError("can't read %s/scrapbook.rdf: %s" % (path, error))
+    items[ROOT_ID] = items[ROOT_ID]._replace(type=u'folder') # force explicit
+    if folders:
+        items[ROOT_ID] = items[ROOT_ID]._replace(children=tuple(find_folders(items, folders)))
+    nodes = {}
+    root = load_node(ROOT_ID, items, nodes)
+    if folders:
+        if check_index_dat:
+            if manifest is None:
+                manifest = DataManifest(path)
+            with STATS.phase('check_index_dat'):
+                check_index_dats(dict((nodeid, items[nodeid]) for nodeid in nodes), manifest)
+        return root, nodes
+    found = len(root.children)
+    with STATS.phase('fix_lost_items'):
+        lost_items = fix_lost_items(items, root, nodes)
     if lost_items > 0:
-        debug("lost items found: " + str(lost_items))
-    lost_folders = fix_lost_folders(items, root, path)
+        debug("lost items found: %d", lost_items)
+    if manifest is None:
+        manifest = DataManifest(path)
+    with STATS.phase('fix_lost_folders'):
+        lost_folders = fix_lost_folders(items, root, manifest)
     if lost_folders > 0:
-        debug("lost folders found: "+str(lost_folders))
+        debug("lost folders found: %d", lost_folders)
+    if lost is not None:
+        lost.extend(root.children[found:])
+    if check_index_dat:
+        with STATS.phase('check_index_dat'):
+            check_index_dats(items, manifest)
 
-    return root, items
+    # item table is not needed anymore, nodes have everything
+    return root, nodes
 
 class Counter(object): # pylint: disable=too-few-public-methods
     """ Counter to exclude certain entries """
     def __init__(self):
         self.cnt = 1
+        # record number by source
         self.uniq = dict()
 
     def count(self, source):
         """ Count only unique entries """
         if not source in self.uniq:
+            self.uniq[source] = self.cnt
             self.cnt += 1
-            self.uniq[source] = 1
 
-def ampersand(url):
-    """ Replace '&' with &amp; to satisfy Zotero importer """
-    return url.replace('&', '&amp;')
+# Record number or range of record numbers: 12, 100-250, 300-
+SELECTOR_RANGE = re.compile(r'([0-9]+)(?:(-)([0-9]*))?\Z')
+
+class Selector(object):
+    """ Items selected by --exclude or --include
+
+    Selectors are record numbers (12), ranges of them (100-250, 300-),
+    item ids (id:20180222112456) and glob patterns on titles or sources
+    (title:*linux*, url:*example.com/*, case-insensitive). Numbers and ids
+    go to sets, ranges to sorted disjoint intervals, patterns to a single
+    regular expression per field.
+    """
+
+    def __init__(self, specs):
+        """ Compile selectors, ValueError if one is wrong """
+        self.specs = [decode_arg(spec) for spec in specs]
+        self.numbers = set()
+        self.ids = set()
+        ranges = []
+        patterns = {'title': [], 'url': []}
+        for spec in self.specs:
+            prefix, _, value = spec.partition(':')
+            match = SELECTOR_RANGE.match(spec)
+            if match is not None:
+                first = int(match.group(1))
+                if match.group(2) is None:
+                    self.numbers.add(first)
+                else:
+                    last = int(match.group(3)) if match.group(3) else sys.maxsize
+                    if last < first:
+                        raise ValueError("empty range '%s'" % spec)
+                    ranges.append((first, last))
+            elif prefix == 'id' and value:
+                self.ids.add(value)
+            elif prefix in patterns and value:
+                patterns[prefix].append(fnmatch.translate(value))
+            else:
+                raise ValueError("bad selector '%s', expected N, N-M, id:ID, "
+                                 "title:PATTERN or url:PATTERN" % spec)
+        # merge overlapping ranges
+        self.starts = []
+        self.ends = []
+        for first, last in sorted(ranges):
+            if self.ends and first <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], last)
+            else:
+                self.starts.append(first)
+                self.ends.append(last)
+        self.title = self.compile(patterns['title'])
+        self.url = self.compile(patterns['url'])
+
+    @staticmethod
+    def compile(patterns):
+        """ One regular expression matching any of fnmatch.translate() patterns """
+        if not patterns:
+            return None
+        return re.compile(u'|'.join(u'(?:%s)' % pattern for pattern in patterns),
+                          re.IGNORECASE | re.UNICODE)
+
+    def matches(self, number, node):
+        """ True if item with given record number is selected """
+        if number in self.numbers or node.nodeid in self.ids:
+            return True
+        if self.starts:
+            # last range starting at or before number
+            idx = bisect.bisect_right(self.starts, number) - 1
+            if idx >= 0 and number <= self.ends[idx]:
+                return True
+        if self.title is not None and self.title.match(node.name):
+            return True
+        return self.url is not None and self.url.match(node.source) is not None
+
+    def __str__(self):
+        return ' '.join(self.specs)
+
+# XML metacharacters
+XML_SPECIAL = re.compile(u'[&<>"]')
+
+def xml_escape(text):
+    """ Escape XML metacharacters for text and attribute values
+
+    Text is scanned once and returned as is when there is nothing to escape.
+    str.replace() is faster than re.sub() with a callback, so it does the rest.
+    """
+    if XML_SPECIAL.search(text) is None:
+        return text
+    return (text.replace(u'&', u'&amp;').replace(u'<', u'&lt;')
+            .replace(u'>', u'&gt;').replace(u'"', u'&quot;'))
+
+COLLECTION_TEMPLATE = u"""\n    <z:Collection rdf:about="#collection_{0}">
+        <dc:title>{1}</dc:title>"""
+SUBCOLLECTION_TEMPLATE = u'\n        <dcterms:hasPart rdf:resource="#collection_{0}"/>'
+COLLECTION_ITEM_TEMPLATE = u'\n        <dcterms:hasPart rdf:resource="{0}"/>'
+COLLECTION_FOOTER = u'\n    </z:Collection>'
+
+def iter_folders(node):
+    """ Iterate over node and its subfolders, parents before children,
+    in order of export_collections()
+    """
+
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node.type != 'folder':
+            continue
+        yield node
+        stack.extend(reversed(node.children))
+
+def find_collections(node, sources, needed):
+    """ Find folders holding items with given sources
+
+    Args:
+        node: node to search
+        sources: set of item sources
+        needed: set to add ids of found folders to
+    Returns:
+        True if node has any of sources, directly or in subfolders
+    """
 
-def export_collections(node):
+    found = set()
+    # children come after parents, so go backwards
+    for folder in reversed(list(iter_folders(node))):
+        if any(id(subnode) in found if subnode.type == 'folder' else subnode.source in sources
+               for subnode in folder.children):
+            found.add(id(folder))
+            needed.add(folder.nodeid)
+    return id(node) in found
+
+def export_collections(node, sources=None, needed=None):
     """ Export collections
 
     Args:
         node: root node to export
+        sources: if given, export only collections and links needed
+            for items with these sources
+        needed: ids of needed folders, found by default
     Returns:
-        Text string with all subcollections as RDF entries
+        Iterator over text strings with all subcollections as RDF entries
     """
 
-    if node.type == 'folder':
-        subcollections = u""
+    if sources is not None and needed is None:
+        needed = set()
+        find_collections(node, sources, needed)
+    for node in iter_folders(node):
+        if needed is not None and node.nodeid not in needed:
+            continue
+        # don't generate root collection (name="")
+        if node.name == "":
+            continue
         # collection header
-        collection = u"""\n    <z:Collection rdf:about="#collection_{0}">
-        <dc:title>{1}</dc:title>""".format(
-            node.nodeid, ampersand(node.name))
+        collection = [COLLECTION_TEMPLATE.format(node.nodeid, xml_escape(node.name))]
         for subnode in node.children:
             if subnode.type == 'folder':
+                if needed is not None and subnode.nodeid not in needed:
+                    continue
                 # add link to subcollection
-                collection += u'\n        <dcterms:hasPart rdf:resource="#collection_{0}"/>'.format(
-                    subnode.nodeid)
-                subcollections += export_collections(subnode)
+                collection.append(SUBCOLLECTION_TEMPLATE.format(subnode.nodeid))
             elif subnode.type != 'note' and subnode.type != 'separator':
+                if sources is not None and subnode.source not in sources:
+                    continue
                 # add link to item
-                collection += u'\n        <dcterms:hasPart rdf:resource="{0}"/>'.format(
-                    ampersand(subnode.source))
+                collection.append(COLLECTION_ITEM_TEMPLATE.format(xml_escape(subnode.source)))
         # collection footer
-        collection += u'\n    </z:Collection>'
-        # don't generate root collection (name="")
-        if node.name == "":
-            collection = u""
-        return collection+subcollections
-    else:
-        return u""
+        collection.append(COLLECTION_FOOTER)
+        yield u"".join(collection)
 
-def addchain(chain, name):
-    """ Generate tags as x/y/z """
-    if not Args.disable_tags: # honor --notags flag
+def addchain(chain, name, tags=True):
+    """ Generate tags as x/y/z, empty tags if tags is False (--notags) """
+    if tags:
         if chain is None:
             return name
         return chain + '/' + name
     return ''
 
-class Deduper(object): # pylint: disable=too-few-public-methods
+class Deduper(object):
     """ Deduplication mechanism """
-    def __init__(self):
-        self.dupes = {}
+    def __init__(self, dupes=None, contents=None, numbering=True):
+        # can continue numbering from previous run
+        self.dupes = dupes if dupes is not None else {}
+        # False for --nodedup
+        self.numbering = numbering
+        # content keys by node id for --dedup=content, see find_same_content()
+        self.contents = contents if contents is not None else {}
+        # first exported node by content key
+        self.captures = {}
+        # (merged node, kept node) tuples for the report
+        self.merged = []
     def getdupnum(self, title):
         """ Get duplication number
 
@@ -318,7 +1065,7 @@ class Deduper(object): # pylint: disable=too-few-public-methods
             or u'' if no dupe.
         """
         # Honor --nodedup flag
-        if Args.disable_dedup:
+        if not self.numbering:
             return u''
         if title in self.dupes:
             self.dupes[title] += 1
@@ -326,106 +1073,1355 @@ class Deduper(object): # pylint: disable=too-few-public-methods
         self.dupes[title] = 1
         return u''
 
-def export_node(node, source_dir, tagchain, counter, deduplicator):
-    """ Export node
+    def merge(self, node):
+        """ Merge node into exported node with the same content
+
+        Merged node gets source of the kept node, so collections link
+        to the kept item.
+
+        Args:
+            node: node to export
+        Returns:
+            kept node or None if node must be exported
+        """
+        key = self.contents.get(node.nodeid)
+        if key is None:
+            return None
+        kept = self.captures.setdefault(key, node)
+        if kept is node:
+            return None
+        node.source = kept.source
+        self.merged.append((node, kept))
+        return kept
+
+    def report(self, filehandle):
+        """ Write list of merged items """
+        if not self.merged:
+            return
+        filehandle.write("Merged %d identical captures:\n" % len(self.merged))
+        for node, kept in self.merged:
+            filehandle.write((u"  %s '%s' -> %s '%s'\n"
+                              % (node.nodeid, node.name, kept.nodeid, kept.name))
+                             .encode('utf-8'))
+
+def write_json(filename, data):
+    """ Write data as compact JSON, replacing filename at once """
+    data = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    write_file(filename, data)
+
+def write_file(filename, data):
+    """ Write bytes to filename, replacing it at once """
+    # several batch processes may write the same cache
+    tmpname = '%s.%d.tmp' % (filename, os.getpid())
+    with io.open(tmpname, 'wb') as filehandle:
+        filehandle.write(data)
+    if os.path.exists(filename):
+        # windows can't rename over existing file
+        os.remove(filename)
+    os.rename(tmpname, filename)
+
+# Files are hashed by blocks of this size
+HASH_BLOCK_SIZE = 1024 * 1024
+
+def hash_file(filename):
+    """ SHA-1 of file contents as hex string """
+    digest = hashlib.sha1()
+    with io.open(filename, 'rb') as filehandle:
+        for block in iter(lambda: filehandle.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class HashCache(object):
+    """ File hashes by path, size and mtime, kept in a JSON file between runs """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.hashes = {}
+        if filename is None:
+            return
+        try:
+            with io.open(filename, 'r', encoding='utf-8') as filehandle:
+                self.hashes = json.load(filehandle)
+        except IOError:
+            # first run
+            pass
+        except ValueError:
+            sys.stderr.write("ERROR: can't read hash cache '%s', hashing everything.\n"
+                             % filename)
+
+    def get(self, path, size, mtime):
+        """ Hash of file, None if file is unknown or changed """
+        record = self.hashes.get(path)
+        if record is not None and record[0] == size and record[1] == mtime:
+            return record[2]
+        return None
+
+    def set(self, path, size, mtime, digest):
+        """ Remember hash of file """
+        self.hashes[path] = [size, mtime, digest]
+
+    def save(self):
+        """ Write cache file """
+        if self.filename is not None:
+            write_json(self.filename, self.hashes)
+
+# Bump when layout of cached item tables changes
+ITEM_CACHE_VERSION = 1
+
+class ItemCache(object):
+    """ Parsed item tables of scrapbook.rdf files, kept in a directory between runs
+
+    Cache file holds two marshal records: header (version, parser, size,
+    mtime, sha1 of rdf file) and item table as {item id: tuple}. Cached table
+    is used while size and mtime of rdf file match, or when only mtime has
+    changed but content hash is the same.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # made by other process of batch meanwhile
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    def filename(self, rdffilename):
+        """ Cache file of rdf file """
+        path = os.path.abspath(rdffilename)
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        return os.path.join(self.cache_dir, hashlib.sha1(path).hexdigest() + '.items')
+
+    def load(self, rdffilename, parser):
+        """ Cached item table of rdf file, None if there is none or it is stale """
+        if self.cache_dir is None:
+            return None
+        stat = os.stat(rdffilename)
+        try:
+            # marshal can read only built-in file objects
+            with open(self.filename(rdffilename), 'rb') as filehandle:
+                header = marshal.load(filehandle)
+                if (not isinstance(header, tuple) or len(header) != 5
+                        or header[:3] != (ITEM_CACHE_VERSION, parser, stat.st_size)):
+                    return None
+                if header[3] != stat.st_mtime and header[4] != hash_file(rdffilename):
+                    return None
+                table = marshal.load(filehandle)
+        except IOError:
+            # first run
+            return None
+        except (EOFError, ValueError, TypeError):
+            sys.stderr.write("ERROR: can't read item cache of '%s', parsing it.\n"
+                             % rdffilename)
+            return None
+        items = {}
+        for itemname, record in table.iteritems():
+            items[itemname] = Item(intern_value(record[0]), record[1], record[2], record[3],
+                                   record[4], record[5], intern_value(record[6]), record[7])
+        if header[3] != stat.st_mtime:
+            # touched but not changed, don't hash it again next time
+            self.save(rdffilename, parser, items)
+        return items
+
+    def save(self, rdffilename, parser, items):
+        """ Remember item table of rdf file """
+        if self.cache_dir is None:
+            return
+        stat = os.stat(rdffilename)
+        header = (ITEM_CACHE_VERSION, parser, stat.st_size, stat.st_mtime,
+                  hash_file(rdffilename))
+        table = dict((itemname, tuple(item)) for itemname, item in items.iteritems())
+        write_file(self.filename(rdffilename), marshal.dumps(header) + marshal.dumps(table))
+
+def index_name(files):
+    """ Name of index file of saved page, None if there is none """
+    if 'index.html' in files:
+        # typical
+        return 'index.html'
+    if 'default.html' in files:
+        # no index.html, hmm. try default.html
+        return 'default.html'
+    return None
+
+# Scrapbook timestamp, YYYYMMDDhhmmss
+TIMESTAMP = re.compile(u'[0-9]{14}\\Z')
+# Days in months of a year which is not leap
+MONTH_DAYS = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+def format_timestamp(value):
+    """ Turn Scrapbook timestamp into Zotero date, 'YYYY-MM-DD hh:mm:ss'
+
+    Same as strptime() and strftime(), but many times faster.
 
     Args:
-        node: node to process
-        source_dir: directory to scrapbook data
-        tagchain: a chain of tags
-        counter: count unique URLs to match items count during import
-        deduplicator: deduplicator object
+        value: item id or create time
     Returns:
-        String with all items as RDF entries
+        formatted date or None if value is not a valid timestamp
     """
+    if TIMESTAMP.match(value) is None:
+        return None
+    if not (u'01' <= value[4:6] <= u'12' and u'01' <= value[6:8] <= u'31' and
+            value[8:10] <= u'23' and value[10:12] <= u'59' and value[12:14] <= u'61'):
+        return None
+    if value[6:8] > u'28':
+        # the 29th and later, as rejected by strptime()
+        year, month = int(value[0:4]), int(value[4:6])
+        leap = month == 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+        if int(value[6:8]) > MONTH_DAYS[month - 1] + leap:
+            return None
+    return u'%s-%s-%s %s:%s:%s' % (value[0:4], value[4:6], value[6:8],
+                                   value[8:10], value[10:12], value[12:14])
 
-    result = u""
+# Buffer for whole index.dat, they are a few hundred bytes
+INDEX_DAT_READ_SIZE = 64 * 1024
 
-    if node.type == 'folder':
-        debug("exporting folder '%s'" % node.nodeid)
-        for subnode in node.children:
-            result += export_node(subnode, source_dir, addchain(tagchain, node.name),
-                                  counter, deduplicator)
-    elif node.type == 'note':
-        sys.stderr.write("ERROR: 'note' type is not implemented, can't process entry"
-                         "'%s'. Skipping.\n" % node.nodeid)
-    elif node.type == 'separator':
-        # no need to export
-        pass
-    elif Args.exclude is not None and str(counter.cnt) in Args.exclude:
-        debug("excluding node #%d" % counter.cnt)
-        counter.count(node.source)
-    else: # saved document or notex
-        debug("exporting item '%s' source '%s'" % (node.nodeid, node.source))
-        # Count unique URLs to track Zotero's import number
-        counter.count(node.source)
-        # Get reliable node creation time from node id
-        nodetime_formatted = time.strftime('%Y-%m-%d %H:%M:%S',
-                                           time.strptime(node.nodeid, '%Y%m%d%H%M%S'))
-        basedir = "%s/data/%s" % (source_dir, node.nodeid)
-        # Check index file existance
-        if os.path.isfile(basedir + '/index.html'):
-            # typical
-            indexfname = basedir + '/index.html'
-        elif  os.path.isfile(basedir + '/default.html'):
-            # no index.html, hmm. try default.html
-            indexfname = basedir + '/default.html'
-        else:
-            sys.stderr.write("ERROR: failed to export %s entry (#%d), no index.html "
-                             "or default.html. Skipping. Try to inspect directory "
-                             "'%s/data/%s' and decide what to do with orphaned data.\n"
-                             % (node.nodeid, counter.cnt, source_dir, node.nodeid))
-            return u""
-        # Avoid empty name and source
-        if node.name == '':
-            node.name = ampersand(node.source)
-        if node.source == '':
-            node.source = node.nodeid
+def read_small_file(filename):
+    """ Read whole small file, with a single read() call for most files
 
-        # Deduplicate
-        node.name = node.name + deduplicator.getdupnum(node.name)
+    Returns:
+        file contents as bytes, None if file can't be read
+    """
+    try:
+        descriptor = os.open(filename, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    except OSError:
+        return None
+    try:
+        chunks = []
+        while True:
+            chunk = os.read(descriptor, INDEX_DAT_READ_SIZE)
+            chunks.append(chunk)
+            if len(chunk) < INDEX_DAT_READ_SIZE:
+                return b''.join(chunks)
+    except OSError:
+        return None
+    finally:
+        os.close(descriptor)
 
-        # Check for PDF files and add them as separate entries
-        pdfs = u""
-        pdf_links = u""
-        pdf_count = 0
-        for pdfname in fnmatch.filter(os.listdir(basedir), "*.pdf"):
-            pdf_count += 1
-            pdf_resource = node.nodeid+'0'+str(pdf_count)
-            pdfs += u"""\n    <z:Attachment rdf:about="#item_{0}">
-        <z:itemType>attachment</z:itemType>
-        <rdf:resource rdf:resource="{1}"/>
-        <dc:title>{2}</dc:title>
-        <link:type>application/pdf</link:type>
-    </z:Attachment>""".format(pdf_resource, os.path.normpath(basedir + '/' + pdfname), pdfname)
-            pdf_links += u'\n        <link:link rdf:resource="#item_{0}"/>'.format(
-                pdf_resource)
-            debug("pdf attachment '%s' added to '%s'" % (pdfname, node.nodeid))
+INDEX_DAT_CHARS = re.compile(b'^chars\t([^\r\n]*)', re.MULTILINE)
 
-        # document entry
-        result += u"""\n    <bib:Document rdf:about="{0}">
-        <z:itemType>webpage</z:itemType>
-        <dcterms:isPartOf>
-           <z:Website></z:Website>
-        </dcterms:isPartOf>
-        <link:link rdf:resource="#item_{1}"/>{5}
-        <dc:subject>{4}</dc:subject>
-        <dc:identifier>
-            <dcterms:URI>
-               <rdf:value>{0}</rdf:value>
-            </dcterms:URI>
-        </dc:identifier>
-        <dcterms:dateSubmitted>{2}</dcterms:dateSubmitted>
-        <dc:title>{3}</dc:title>
-    </bib:Document>""".format(ampersand(node.source), # {0}
-                              node.nodeid, # {1}
-                              nodetime_formatted, # {2}
-                              ampersand(node.name), # {3}
-                              ampersand(tagchain.lstrip('/')), # {4}
-                              pdf_links # {5}
-                             )
-        # attachment entry
-        result += u"""\n    <z:Attachment rdf:about="#item_{0}">
+def parse_index_dat(data):
+    """ Parse contents of Scrapbook index.dat file, 'name<TAB>value' lines
+
+    Scrapbook writes it in UTF-8, but if it is not, encoding given by chars
+    field is used.
+
+    Returns:
+        dict() of field values by name
+    """
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError:
+        chars = INDEX_DAT_CHARS.search(data)
+        try:
+            text = data.decode(chars.group(1).decode('ascii', 'replace').strip()
+                               if chars else 'utf-8', 'replace')
+        except LookupError:
+            # unknown encoding
+            text = data.decode('utf-8', 'replace')
+    fields = {}
+    for line in text.splitlines():
+        name, sep, value = line.partition(u'\t')
+        if sep:
+            fields[name] = value
+    return fields
+
+def read_index_dat(filename):
+    """ Read fields of Scrapbook index.dat file
+
+    Returns:
+        dict() of field values by name, empty if file can't be read
+    """
+    data = read_small_file(filename)
+    STATS.add('index.dat reads')
+    return parse_index_dat(data) if data is not None else {}
+
+def item_date(node, basedir, entries, indexfname):
+    """ Creation date of item
+
+    Item id is creation time, unless it is a lost folder with some other
+    name. Then NS1:create and create field of index.dat are tried, and
+    at last modification time of index file.
+
+    Args:
+        node: node to export
+        basedir: item directory
+        entries: DirEntries of basedir
+        indexfname: index file inside basedir
+    Returns:
+        date formatted by format_timestamp()
+    """
+    date = format_timestamp(node.nodeid) or format_timestamp(node.create)
+    if date is None and 'index.dat' in entries.files:
+        date = format_timestamp(read_index_dat(basedir + '/index.dat').get(u'create', u''))
+    if date is None:
+        try:
+            date = time.strftime('%Y-%m-%d %H:%M:%S',
+                                 time.localtime(os.stat(indexfname).st_mtime))
+        except OSError:
+            date = u''
+    return date
+
+def find_same_content(root, source_dir, manifest, cache, jobs=1):
+    """ Find saved pages with byte-identical index file and PDFs
+
+    Only files of pages having the same file sizes as some other page
+    are hashed, by jobs threads.
+
+    Args:
+        root: root node
+        source_dir: directory to scrapbook data
+        manifest: DataManifest of source_dir
+        cache: HashCache
+        jobs: number of hashing threads
+    Returns:
+        dict() of content keys by node id, only for pages which may have
+        the same content as some other page
+    """
+
+    # pages by sizes of their files
+    by_sizes = collections.defaultdict(list)
+    seen = set()
+    for folder in iter_folders(root):
+        for node in folder.children:
+            if node.type in ('folder', 'note', 'separator') or node.nodeid in seen:
+                continue
+            seen.add(node.nodeid)
+            entries = manifest.get(node.nodeid)
+            indexname = index_name(entries.files) if entries is not None else None
+            if indexname is None:
+                continue
+            basedir = "%s/data/%s" % (source_dir, node.nodeid)
+            files = []
+            for name in [indexname] + fnmatch.filter(entries.names, "*.pdf"):
+                path = basedir + '/' + name
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((path, stat.st_size, stat.st_mtime))
+            STATS.add('stat calls', len(files))
+            sizes = (files[0][1], tuple(sorted(size for _, size, _ in files[1:])))
+            by_sizes[sizes].append((node.nodeid, files))
+
+    candidates = [page for pages in by_sizes.values() if len(pages) > 1 for page in pages]
+    todo = set(fileinfo for _, files in candidates for fileinfo in files
+               if cache.get(*fileinfo) is None)
+    todo = sorted(todo)
+    # hashlib releases GIL while hashing
+    digests = parallel_map(hash_file, [path for path, _, _ in todo], jobs, 1)
+    for fileinfo, digest in zip(todo, digests):
+        cache.set(fileinfo[0], fileinfo[1], fileinfo[2], digest)
+    STATS.add('files hashed', len(todo))
+    STATS.add('bytes hashed', sum(size for _, size, _ in todo))
+
+    contents = {}
+    for nodeid, files in candidates:
+        digests = [cache.get(*fileinfo) for fileinfo in files]
+        contents[nodeid] = (digests[0], tuple(sorted(digests[1:])))
+    return contents
+
+def dir_fingerprint(basedir, indexfname):
+    """ Cheap fingerprint of item directory for items without modify time
+
+    Args:
+        basedir: item directory
+        indexfname: index file inside basedir
+    Returns:
+        Unicode string which changes when directory or index file is changed
+    """
+    STATS.add('stat calls', 2)
+    try:
+        return u"%d:%d" % (os.stat(basedir).st_mtime, os.stat(indexfname).st_mtime)
+    except OSError:
+        return u""
+
+class ExportState(object):
+    """ Items exported by previous runs, kept in a JSON file between runs
+
+    For every exported node id it stores [modify, fingerprint, title, name, index,
+    parent]: Scrapbook modify time, dir_fingerprint() for items lacking modify
+    time, title before deduplication, exported (deduplicated) name, index file
+    name and id of parent folder. Items moved to another folder are exported
+    again into their new collection, items deleted from scrapbook are forgotten;
+    both are reported, as Zotero keeps what previous runs imported.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.items = {}
+        self.dupes = {}
+        # parent folder id by node id of current tree, see compare()
+        self.parents = {}
+        # previous parent folder id by node id, of moved and deleted items
+        self.moved = {}
+        self.deleted = {}
+        try:
+            with io.open(filename, 'r', encoding='utf-8') as filehandle:
+                data = json.load(filehandle)
+            self.items = data['items']
+            self.dupes = data['dupes']
+        except IOError:
+            # first run
+            pass
+        except (ValueError, KeyError, TypeError):
+            sys.stderr.write("ERROR: can't read state file '%s', exporting everything.\n"
+                             % filename)
+
+    def compare(self, root, complete=True):
+        """ Find items moved to other folders or deleted since previous run
+
+        Args:
+            root: root node from open_scrapbook_rdf()
+            complete: False if root doesn't hold every item (--folder),
+                then missing items are not taken as deleted
+        """
+        for folder in iter_folders(root):
+            for node in folder.children:
+                if node.type != 'folder':
+                    self.parents[node.nodeid] = folder.nodeid
+        for nodeid, record in self.items.items():
+            parent = self.parents.get(nodeid)
+            if parent is None:
+                if complete:
+                    self.deleted[nodeid] = record[5] if len(record) > 5 else None
+            elif len(record) < 6 or record[5] is None:
+                # state file of older version, parent is not known
+                record[5:] = [parent]
+            elif record[5] != parent:
+                self.moved[nodeid] = record[5]
+
+    def pending(self, nodes):
+        """ Ids of items which may need export, others are known to be unchanged
+
+        Args:
+            nodes: nodes dict() from open_scrapbook_rdf()
+        """
+        for nodeid, node in nodes.items():
+            record = self.items.get(nodeid)
+            if (record is None or record[0] == '' or record[0] != node.modify or
+                    nodeid in self.moved):
+                yield nodeid
+
+    def unchanged(self, node, basedir):
+        """ Check if node was exported already and not modified since
+
+        Items with modify time are checked without touching the disk.
+        """
+        record = self.items.get(node.nodeid)
+        if record is None or node.nodeid in self.moved:
+            return False
+        if node.modify != '':
+            return record[0] == node.modify
+        return record[1] != '' and record[1] == dir_fingerprint(
+            basedir, basedir + '/' + record[4])
+
+    def name(self, node, title):
+        """ Name given to the node by previous run, None if title was changed """
+        record = self.items.get(node.nodeid)
+        if record is not None and record[2] == title:
+            return record[3]
+        return None
+
+    def update(self, node, title, basedir, indexfname):
+        """ Remember exported node """
+        fingerprint = dir_fingerprint(basedir, indexfname) if node.modify == '' else u""
+        self.items[node.nodeid] = [node.modify, fingerprint, title, node.name,
+                                   os.path.basename(indexfname),
+                                   self.parents.get(node.nodeid)]
+
+    def report(self, filehandle):
+        """ Write lists of moved and deleted items """
+        if self.moved:
+            filehandle.write("Exported again %d items moved to other folders:\n"
+                             % len(self.moved))
+            for nodeid, parent in sorted(self.moved.items()):
+                filehandle.write("  %s: %s -> %s\n" % (nodeid, parent, self.parents[nodeid]))
+        if self.deleted:
+            filehandle.write("Deleted %d items exported before, they are left in Zotero:\n"
+                             % len(self.deleted))
+            for nodeid, parent in sorted(self.deleted.items()):
+                filehandle.write("  %s (folder %s)\n" % (nodeid, parent))
+
+    def save(self):
+        """ Write state file, without deleted items """
+        for nodeid in self.deleted:
+            self.items.pop(nodeid, None)
+        write_json(self.filename, {'items': self.items, 'dupes': self.dupes})
+
+def stage_file(source, target, link=True):
+    """ Put copy of source file to target, unless it is there already
+
+    Args:
+        source: file to stage
+        target: its place in stage directory
+        link: try hardlink first, copy if it fails (i.e. other filesystem)
+    Returns:
+        'unchanged', 'linked' or 'copied'
+    """
+    try:
+        target_stat = os.stat(target)
+    except OSError:
+        target_stat = None
+    source_stat = os.stat(source)
+    if (target_stat is not None and target_stat.st_size == source_stat.st_size
+            and int(target_stat.st_mtime) == int(source_stat.st_mtime)):
+        # copied before (copy2 keeps mtime) or hardlink of the same file
+        return 'unchanged'
+    if target_stat is not None:
+        os.remove(target)
+    if link:
+        try:
+            os.link(source, target)
+            return 'linked'
+        except OSError:
+            pass
+    shutil.copy2(source, target)
+    return 'copied'
+
+# Number of directories given to staging thread at once
+STAGE_CHUNK_SIZE = 64
+
+class Stager(object):
+    """ Data directories of exported items copied into --stage-dir
+
+    Directories are copied by a thread pool while export goes on, RDF
+    entries point to the copies. Files are hardlinked where possible and
+    files already staged with the same size and mtime are left alone.
+    """
+
+    def __init__(self, stage_dir, jobs=1):
+        from multiprocessing.pool import ThreadPool
+        self.stage_dir = stage_dir
+        self.pool = ThreadPool(jobs)
+        self.pending = []
+        self.chunk = []
+        # no hardlinks on windows with python 2
+        self.link = hasattr(os, 'link')
+
+    def add(self, node, job): # pylint: disable=unused-argument
+        """ Start staging directory of item, return job with staged paths """
+        basedir = "%s/data/%s" % (self.stage_dir, job.nodeid)
+        self.chunk.append((job.basedir, basedir))
+        if len(self.chunk) >= STAGE_CHUNK_SIZE:
+            self.pending.append(self.pool.apply_async(self.stage_dir_trees, (self.chunk,)))
+            self.chunk = []
+        return job._replace(basedir=basedir,
+                            indexfname=basedir + '/' + os.path.basename(job.indexfname))
+
+    def stage_dir_trees(self, pairs):
+        """ Stage all files of (source, target) directories, runs in the pool
+
+        Returns:
+            dict() of number of files by stage_file() result or 'failed'
+        """
+        results = collections.defaultdict(int)
+        for source, target in pairs:
+            self.stage_dir_tree(source, target, results)
+        return results
+
+    def stage_dir_tree(self, source, target, results):
+        """ Stage all files of source directory, counting them in results """
+        for dirpath, _, filenames in os.walk(source):
+            targetdir = os.path.join(target, os.path.relpath(dirpath, source))
+            try:
+                if not os.path.isdir(targetdir):
+                    os.makedirs(targetdir)
+            except OSError as error:
+                sys.stderr.write(("ERROR: can't create directory '%s': %s\n"
+                                  % (targetdir, error)).encode('utf-8'))
+                results['failed'] += len(filenames)
+                continue
+            for filename in filenames:
+                try:
+                    result = stage_file(os.path.join(dirpath, filename),
+                                        os.path.join(targetdir, filename), self.link)
+                except (IOError, OSError) as error:
+                    sys.stderr.write(("ERROR: can't stage file '%s': %s\n"
+                                      % (os.path.join(dirpath, filename), error))
+                                     .encode('utf-8'))
+                    result = 'failed'
+                results[result] += 1
+
+    def finish(self):
+        """ Wait for all directories to be staged
+
+        Returns:
+            number of files which failed to stage
+        """
+        with STATS.phase('stage'):
+            failed = self.wait()
+        if failed:
+            sys.stderr.write("ERROR: %d files were not staged, see errors above.\n" % failed)
+        return failed
+
+    def wait(self):
+        """ Stage the rest and wait for the pool, for finish() """
+        if self.chunk:
+            self.pending.append(self.pool.apply_async(self.stage_dir_trees, (self.chunk,)))
+            self.chunk = []
+        self.pool.close()
+        self.pool.join()
+        totals = collections.defaultdict(int)
+        for pending in self.pending:
+            for result, count in pending.get().items():
+                totals[result] += count
+        STATS.add('files staged', totals['linked'] + totals['copied'])
+        STATS.add('files hardlinked', totals['linked'])
+        STATS.add('files unchanged', totals['unchanged'])
+        debug("files staged: %d copied, %d linked, %d unchanged, %d failed",
+              totals['copied'], totals['linked'], totals['unchanged'], totals['failed'])
+        return totals['failed']
+
+# Item files packed by --pack into file named after item
+PACK_FORMATS = ('zip', 'html')
+
+# Number of items given to packing process at once
+PACK_CHUNK_SIZE = 16
+
+# Files compressed already, stored into --pack=zip archives as they are
+PACK_STORED = frozenset(['.gif', '.jpg', '.jpeg', '.png', '.webp', '.ico', '.zip', '.gz',
+                         '.bz2', '.xz', '.7z', '.rar', '.mp3', '.mp4', '.ogg', '.webm',
+                         '.swf', '.flv', '.woff', '.woff2', '.pdf'])
+
+# Frames inside frames inlined by --pack=html
+PACK_FRAME_DEPTH = 3
+
+# Tags with attributes linking files which page needs to be shown. Scrapbook
+# saves pages serialized by Firefox, with lower case tags and url(), upper
+# case tags are for pages saved otherwise. Case-sensitive patterns are several
+# times faster.
+PACK_TAGS = ['img', 'script', 'link', 'input', 'embed', 'frame', 'iframe', 'body', 'table',
+             'td', 'th', 'source', 'video', 'audio', 'track']
+PACK_TAG = re.compile(r'<(?:%s)\b[^>]*>'
+                      % '|'.join(PACK_TAGS + list(name.upper() for name in PACK_TAGS)))
+PACK_ATTRIBUTE = re.compile(r'''(\s(?:src|href|background|poster)\s*=\s*)'''
+                            r'''("[^"]*"|'[^']*'|[^\s"'>]+)''', re.IGNORECASE)
+PACK_CSS_URL = re.compile(r'''(url\(\s*)("[^"]*"|'[^']*'|[^\s"')]+)(\s*\))''')
+# Scheme of URL, at least two letters to tell it from windows drive
+URL_SCHEME = re.compile(r'[a-zA-Z][a-zA-Z0-9+.-]+:')
+
+class PageInliner(object):
+    """ Saved page turned into single HTML file with its files as data: URIs
+
+    Pages are handled as bytes, so they are written back in their own
+    encoding, only links to local files are replaced.
+    """
+
+    def __init__(self, basedir, encoding=u''):
+        self.basedir = os.path.abspath(basedir)
+        self.encoding = encoding or 'utf-8'
+        # files being inlined, to stop on frames including each other
+        self.stack = []
+        # all inlined files
+        self.files = set()
+
+    def local_file(self, dirname, link):
+        """ Path to file of item directory, link is relative URL or None """
+        link = link.strip(b'"\'').strip()
+        if not link or link[0] in b'#/' or URL_SCHEME.match(link):
+            return None
+        import urllib
+        name = urllib.unquote(link.split(b'#')[0].split(b'?')[0])
+        for encoding in (self.encoding, 'utf-8'):
+            try:
+                path = os.path.normpath(os.path.join(dirname, name.decode(encoding)))
+            except (UnicodeDecodeError, LookupError):
+                continue
+            if path.startswith(self.basedir + os.sep) and os.path.isfile(path):
+                return path
+        return None
+
+    def data_uri(self, filename):
+        """ File as data: URI, with its own links inlined """
+        import base64
+        import mimetypes
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        with open(filename, 'rb') as filehandle:
+            data = filehandle.read()
+        if mimetype == 'text/css':
+            data = self.inline_css(data, os.path.dirname(filename))
+        elif mimetype == 'text/html':
+            self.stack.append(filename)
+            data = self.inline_html(data, os.path.dirname(filename))
+            self.stack.pop()
+        self.files.add(filename)
+        return b'data:%s;base64,%s' % (mimetype, base64.b64encode(data))
+
+    def inline(self, dirname, link):
+        """ Link replaced by quoted data: URI, or None if it is not a local file """
+        filename = self.local_file(dirname, link)
+        if filename is None or filename in self.stack or (
+                filename.endswith(('.htm', '.html')) and len(self.stack) >= PACK_FRAME_DEPTH):
+            return None
+        try:
+            return b'"%s"' % self.data_uri(filename)
+        except (IOError, OSError):
+            return None
+
+    def inline_css(self, data, dirname):
+        """ Style sheet with url() of local files replaced by data: URIs """
+        def replace_url(match):
+            """ url() of file """
+            uri = self.inline(dirname, match.group(2))
+            return match.group(0) if uri is None else match.group(1) + uri + match.group(3)
+        return PACK_CSS_URL.sub(replace_url, data)
+
+    def inline_html(self, data, dirname):
+        """ Page with images, style sheets, scripts and frames replaced by data: URIs """
+        def replace_attribute(match):
+            """ src, href, ... attribute linking file """
+            uri = self.inline(dirname, match.group(2))
+            return match.group(0) if uri is None else match.group(1) + uri
+        def replace_tag(match):
+            """ Tag linking files """
+            return PACK_ATTRIBUTE.sub(replace_attribute, match.group(0))
+        # style attributes and <style> blocks first, inlined data has no url()
+        return PACK_TAG.sub(replace_tag, self.inline_css(data, dirname))
+
+def pack_html(source, indexname, target, encoding=u''):
+    """ Write page of item directory into target as single HTML file
+
+    Returns:
+        number of files inlined into page
+    """
+    inliner = PageInliner(source, encoding)
+    index = os.path.join(inliner.basedir, indexname)
+    inliner.stack.append(index)
+    with open(index, 'rb') as filehandle:
+        write_file(target, inliner.inline_html(filehandle.read(), inliner.basedir))
+    return len(inliner.files)
+
+def pack_zip(files, target):
+    """ Write files, list of (path, name in archive) tuples, into target zip archive """
+    import zipfile
+    temporary = "%s.%d.tmp" % (target, os.getpid())
+    with contextlib.closing(zipfile.ZipFile(temporary, 'w', zipfile.ZIP_DEFLATED,
+                                            allowZip64=True)) as archive:
+        for path, name in files:
+            if os.path.splitext(name)[1].lower() in PACK_STORED:
+                archive.write(path, name, zipfile.ZIP_STORED)
+            else:
+                archive.write(path, name)
+    if os.path.exists(target):
+        # windows can't rename over existing file
+        os.remove(target)
+    os.rename(temporary, target)
+
+def pack_item(source, target, indexname, pack_format, encoding, pdfnames, results):
+    """ Pack directory of item into target file, PDFs are staged next to it
+
+    Files are packed again only if some of them is newer than packed file.
+    """
+    files = []
+    newest = 0
+    for dirpath, _, filenames in os.walk(source):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            newest = max(newest, os.path.getmtime(path))
+            name = os.path.relpath(path, source).replace(os.sep, '/')
+            if name not in pdfnames:
+                files.append((path, name))
+    results['files'] += len(files) + len(pdfnames)
+    results['outputs'] += 1 + len(pdfnames)
+    packed = "%s.%s" % (target, pack_format)
+    if os.path.exists(packed) and os.path.getmtime(packed) >= newest:
+        results['unchanged'] += 1
+    else:
+        if not os.path.isdir(os.path.dirname(packed)):
+            try:
+                os.makedirs(os.path.dirname(packed))
+            except OSError:
+                # made by other process meanwhile
+                if not os.path.isdir(os.path.dirname(packed)):
+                    raise
+        if pack_format == 'zip':
+            pack_zip(files, packed)
+        else:
+            pack_html(source, indexname, packed, encoding)
+        results['packed'] += 1
+        results['bytes'] += sum(os.path.getsize(path) for path, _ in files)
+    if pdfnames and not os.path.isdir(target):
+        os.makedirs(target)
+    for pdfname in pdfnames:
+        stage_file(os.path.join(source, pdfname), os.path.join(target, pdfname),
+                   hasattr(os, 'link'))
+
+def pack_items(items):
+    """ Pack every item of chunk made by Packer, runs in worker processes
+
+    Returns:
+        dict() of counters: 'files' in item directories, 'outputs' files
+        they are packed into, 'packed' and 'unchanged' items, 'bytes' read
+        and 'failed' items
+    """
+    results = collections.defaultdict(int)
+    for item in items:
+        try:
+            pack_item(*item, results=results)
+        except (IOError, OSError) as error:
+            sys.stderr.write((u"ERROR: can't pack directory '%s': %s\n"
+                              % (item[0], error)).encode('utf-8'))
+            results['failed'] += 1
+    return dict(results)
+
+class Packer(object):
+    """ Data directories of exported items packed into --stage-dir (--pack)
+
+    Every item becomes single file, zip archive or HTML page with files
+    inlined, which Zotero imports much faster than lots of small files.
+    PDFs are left as separate files for their attachments. Items are packed
+    by a pool of worker processes while export goes on, RDF entries point
+    to the packed files.
+    """
+
+    def __init__(self, stage_dir, pack_format, workers=1):
+        self.stage_dir = stage_dir
+        self.pack_format = pack_format
+        self.workers = workers
+        self.pool = None
+        if workers > 1:
+            import multiprocessing
+            self.pool = multiprocessing.Pool(workers)
+        self.chunk = []
+        self.pending = collections.deque()
+        self.totals = collections.defaultdict(int)
+        self.started = time.time()
+
+    def add(self, node, job):
+        """ Queue directory of item, return job with packed paths """
+        basedir = "%s/data/%s" % (self.stage_dir, job.nodeid)
+        self.chunk.append((job.basedir, basedir, os.path.basename(job.indexfname),
+                           self.pack_format, node.chars, job.pdfnames))
+        if len(self.chunk) >= PACK_CHUNK_SIZE:
+            self.submit()
+        return job._replace(basedir=basedir, indexfname=basedir + '.' + self.pack_format)
+
+    def submit(self):
+        """ Give current chunk to workers, count results of finished ones """
+        if self.pool is None:
+            self.count(pack_items(self.chunk))
+        else:
+            self.pending.append(self.pool.apply_async(pack_items, (self.chunk,)))
+            while len(self.pending) > 2 * self.workers:
+                self.count(self.pending.popleft().get())
+        self.chunk = []
+
+    def count(self, results):
+        """ Add results of packed chunk to totals """
+        for name, value in results.items():
+            self.totals[name] += value
+
+    def finish(self):
+        """ Pack the rest, wait for workers and report
+
+        Returns:
+            number of items which failed to pack
+        """
+        with STATS.phase('pack'):
+            try:
+                if self.chunk:
+                    self.submit()
+                while self.pending:
+                    self.count(self.pending.popleft().get())
+                if self.pool is not None:
+                    self.pool.close()
+            finally:
+                if self.pool is not None:
+                    self.pool.terminate()
+                    self.pool.join()
+        totals = self.totals
+        seconds = time.time() - self.started
+        STATS.add('files before packing', totals['files'])
+        STATS.add('files after packing', totals['outputs'])
+        STATS.add('items packed', totals['packed'])
+        STATS.add('items unchanged', totals['unchanged'])
+        STATS.add('bytes packed', totals['bytes'])
+        sys.stderr.write("Packed %d items (%d unchanged): %d files -> %d files, "
+                         "%.1f MB in %.1f s, %.1f MB/s\n"
+                         % (totals['packed'], totals['unchanged'], totals['files'],
+                            totals['outputs'], totals['bytes'] / 1e6, seconds,
+                            totals['bytes'] / 1e6 / max(seconds, 1e-3)))
+        if totals['failed']:
+            sys.stderr.write("ERROR: %d items were not packed, see errors above.\n"
+                             % totals['failed'])
+        return totals['failed']
+
+# Bytes of index file given to text extractor at once
+FULLTEXT_READ_SIZE = 64 * 1024
+# Pages given to text extracting process at once
+FULLTEXT_CHUNK_SIZE = 32
+# Pages written to full-text index in one transaction
+FULLTEXT_COMMIT_SIZE = 1000
+
+# HTMLParser subclass, made on first use
+_TEXT_EXTRACTOR = []
+
+def text_extractor():
+    """ New HTML parser collecting visible text of page, see extract_text() """
+    if not _TEXT_EXTRACTOR:
+        import HTMLParser
+        import htmlentitydefs
+
+        class TextExtractor(HTMLParser.HTMLParser):
+            """ Text of page without markup, scripts and styles """
+            skipped_tags = ('script', 'style', 'template')
+            # other tags separate words
+            inline_tags = frozenset(['a', 'abbr', 'b', 'code', 'em', 'font', 'i', 'mark',
+                                     'q', 's', 'small', 'span', 'strong', 'sub', 'sup', 'u'])
+
+            def __init__(self):
+                HTMLParser.HTMLParser.__init__(self)
+                self.parts = []
+                self.skipping = 0
+
+            def handle_starttag(self, tag, attrs):
+                if tag in self.skipped_tags:
+                    self.skipping += 1
+                elif tag not in self.inline_tags:
+                    self.parts.append(u' ')
+
+            def handle_endtag(self, tag):
+                if tag in self.skipped_tags:
+                    if self.skipping:
+                        self.skipping -= 1
+                elif tag not in self.inline_tags:
+                    self.parts.append(u' ')
+
+            def handle_data(self, data):
+                if not self.skipping:
+                    self.parts.append(data)
+
+            def handle_entityref(self, name):
+                if name in htmlentitydefs.name2codepoint:
+                    self.handle_data(unichr(htmlentitydefs.name2codepoint[name]))
+
+            def handle_charref(self, name):
+                try:
+                    if name[:1] in 'xX':
+                        self.handle_data(unichr(int(name[1:], 16)))
+                    else:
+                        self.handle_data(unichr(int(name)))
+                except (ValueError, OverflowError):
+                    pass
+
+            def text(self):
+                """ Collected text, whitespace collapsed """
+                return u' '.join(u''.join(self.parts).split())
+
+        _TEXT_EXTRACTOR.append((TextExtractor, HTMLParser.HTMLParseError))
+    return _TEXT_EXTRACTOR[0][0]()
+
+def extract_text(filename, chars=u''):
+    """ Visible text of HTML file
+
+    File is read and parsed by blocks, so it is never in memory at once.
+
+    Args:
+        filename: HTML file
+        chars: its encoding (NS1:chars of item), UTF-8 if empty or unknown
+    Returns:
+        text as unicode, u'' if file can't be read
+    """
+    try:
+        decoder = codecs.getincrementaldecoder(chars or 'utf-8')('replace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    parser = text_extractor()
+    try:
+        with io.open(filename, 'rb') as filehandle:
+            for block in iter(lambda: filehandle.read(FULLTEXT_READ_SIZE), b''):
+                parser.feed(decoder.decode(block))
+        parser.feed(decoder.decode(b'', True))
+        parser.close()
+    except (IOError, OSError) as error:
+        sys.stderr.write(("ERROR: can't read '%s' for full-text index: %s\n"
+                          % (filename, error)).encode('utf-8'))
+    except _TEXT_EXTRACTOR[0][1]:
+        # broken markup, keep text found before it
+        pass
+    return parser.text()
+
+def extract_texts(pages):
+    """ Text of pages, runs in worker processes of FulltextIndexer
+
+    Args:
+        pages: list of (nodeid, title, source, index file, chars) tuples
+    Returns:
+        list of (nodeid, title, source, text) tuples
+    """
+    return [(nodeid, title, source, extract_text(indexfname, chars))
+            for nodeid, title, source, indexfname, chars in pages]
+
+class FulltextIndex(object):
+    """ Text of exported pages in SQLite full-text index
+
+    FTS5 table is used if SQLite has it, FTS4 otherwise. Pages table keeps
+    item ids, titles and sources, its ids are rowids of full-text table.
+    """
+
+    def __init__(self, filename, create=False):
+        import sqlite3
+        self.error = sqlite3.Error
+        if not create and not os.path.isfile(filename):
+            raise ExportError("no full-text index '%s'" % filename)
+        self.connection = sqlite3.connect(filename)
+        try:
+            row = self.connection.execute(
+                "SELECT sql FROM sqlite_master WHERE name = 'fulltext'").fetchone()
+            if row is not None:
+                self.module = 'fts5' if 'fts5' in row[0].lower() else 'fts4'
+            elif create:
+                self.module = self.create()
+            else:
+                raise ExportError("'%s' is not a full-text index" % filename)
+        except sqlite3.Error as error:
+            self.connection.close()
+            raise ExportError("can't use full-text index '%s': %s" % (filename, error))
+
+    def create(self):
+        """ Create tables, return name of full-text module """
+        for module in ('fts5', 'fts4'):
+            try:
+                self.connection.execute("CREATE VIRTUAL TABLE fulltext USING %s(title, content)"
+                                        % module)
+            except self.error:
+                # no such module
+                continue
+            self.connection.execute("CREATE TABLE pages (id INTEGER PRIMARY KEY, "
+                                    "nodeid TEXT UNIQUE, title TEXT, source TEXT)")
+            return module
+        raise ExportError("SQLite has neither FTS5 nor FTS4")
+
+    def add(self, pages):
+        """ Add or replace pages, in transaction left open until commit()
+
+        Args:
+            pages: list of (nodeid, title, source, text) tuples
+        """
+        execute = self.connection.execute
+        try:
+            for nodeid, title, source, text in pages:
+                row = execute("SELECT id FROM pages WHERE nodeid = ?", (nodeid,)).fetchone()
+                if row is not None:
+                    # changed since previous run
+                    pageid = row[0]
+                    execute("DELETE FROM fulltext WHERE rowid = ?", (pageid,))
+                    execute("UPDATE pages SET title = ?, source = ? WHERE id = ?",
+                            (title, source, pageid))
+                else:
+                    pageid = execute("INSERT INTO pages (nodeid, title, source) "
+                                     "VALUES (?, ?, ?)", (nodeid, title, source)).lastrowid
+                execute("INSERT INTO fulltext (rowid, title, content) VALUES (?, ?, ?)",
+                        (pageid, title, text))
+        except self.error as error:
+            raise ExportError("can't write to full-text index: %s" % error)
+
+    def commit(self):
+        """ Commit pages added so far """
+        try:
+            self.connection.commit()
+        except self.error as error:
+            raise ExportError("can't write to full-text index: %s" % error)
+
+    def search(self, query, limit=20):
+        """ Find pages by full-text query
+
+        Returns:
+            list of (nodeid, title, source, snippet) tuples, best first with FTS5
+        """
+        if self.module == 'fts5':
+            sql = ("SELECT nodeid, pages.title, source, "
+                   "snippet(fulltext, 1, '[', ']', '...', 12) FROM fulltext "
+                   "JOIN pages ON pages.id = fulltext.rowid WHERE fulltext MATCH ? "
+                   "ORDER BY rank LIMIT ?")
+        else:
+            sql = ("SELECT nodeid, pages.title, source, "
+                   "snippet(fulltext, '[', ']', '...', 1, 12) FROM fulltext "
+                   "JOIN pages ON pages.id = fulltext.rowid WHERE fulltext MATCH ? LIMIT ?")
+        try:
+            return self.connection.execute(sql, (query, limit)).fetchall()
+        except self.error as error:
+            raise ExportError("can't search for '%s': %s" % (query, error))
+
+    def close(self):
+        """ Close database """
+        self.connection.close()
+
+class FulltextIndexer(object):
+    """ Text of exported pages extracted into FulltextIndex (--fulltext)
+
+    Pages are given to a pool of workers processes in chunks, as they are
+    planned, and results are written as they come. Only a few chunks wait
+    at once, so memory use does not depend on the size of the library.
+    """
+
+    def __init__(self, filename, workers=1):
+        self.index = FulltextIndex(filename, create=True)
+        self.workers = workers
+        self.pool = None
+        if workers > 1:
+            import multiprocessing
+            self.pool = multiprocessing.Pool(workers)
+        self.chunk = []
+        self.pending = collections.deque()
+        self.uncommitted = 0
+
+    def add(self, node, job):
+        """ Queue index file of item, job is not changed """
+        self.chunk.append((job.nodeid, job.name, job.source, job.indexfname, node.chars))
+        if len(self.chunk) >= FULLTEXT_CHUNK_SIZE:
+            self.submit()
+        return job
+
+    def submit(self):
+        """ Give current chunk to workers, write results of finished ones """
+        if self.pool is None:
+            self.write(extract_texts(self.chunk))
+        else:
+            self.pending.append(self.pool.apply_async(extract_texts, (self.chunk,)))
+            while len(self.pending) > 2 * self.workers:
+                self.write(self.pending.popleft().get())
+        self.chunk = []
+
+    def write(self, pages):
+        """ Write extracted pages to index """
+        self.index.add(pages)
+        STATS.add('pages indexed', len(pages))
+        self.uncommitted += len(pages)
+        if self.uncommitted >= FULLTEXT_COMMIT_SIZE:
+            self.index.commit()
+            self.uncommitted = 0
+
+    def finish(self):
+        """ Index the rest, wait for workers and close index """
+        with STATS.phase('fulltext'):
+            try:
+                if self.chunk:
+                    self.submit()
+                while self.pending:
+                    self.write(self.pending.popleft().get())
+                self.index.commit()
+                if self.pool is not None:
+                    self.pool.close()
+            finally:
+                if self.pool is not None:
+                    self.pool.terminate()
+                    self.pool.join()
+                self.index.close()
+
+def plan_items(node, source_dir, tagchain, counter, deduplicator, manifest, state=None,
+               args=None, stages=()):
+    """ Decide what to export, walking the tree without recursion
+
+    Everything depending on order of items (record numbers, deduplication,
+    incremental state) is done here, the rest is left to render_item().
+
+    Args:
+        node: node to process
+        source_dir: directory to scrapbook data
+        tagchain: a chain of tags
+        counter: count unique URLs to match items count during import
+        deduplicator: deduplicator object
+        manifest: DataManifest of source_dir
+        state: ExportState, items exported before and not modified are skipped
+        args: Args of the run, defaults if not given
+        stages: objects getting every planned item by add(node, job), which
+            returns job to export (Stager, Packer, FulltextIndexer)
+    Returns:
+        Iterator over (node, ItemJob) tuples of exported items
+    """
+
+    if args is None:
+        args = Args()
+    # (iterator over nodes, tag chain of these nodes)
+    stack = [(iter([node]), tagchain)]
+    while stack:
+        nodes, tagchain = stack[-1]
+        for node in nodes:
+            if node.type == 'folder':
+                debug("exporting folder '%s'", node.nodeid)
+                stack.append((iter(node.children),
+                              addchain(tagchain, node.name, not args.disable_tags)))
+                break
+            job = plan_item(node, source_dir, tagchain, counter, deduplicator,
+                            manifest, state, args.exclude, args.include)
+            if job is not None:
+                for stage in stages:
+                    job = stage.add(node, job)
+                yield node, job
+        else:
+            stack.pop()
+
+def export_items(node, source_dir, tagchain, counter, deduplicator, manifest, state=None,
+                 workers=1, args=None, stages=()):
+    """ Export items of node one by one
+
+    Args:
+        node: node to process
+        source_dir: directory to scrapbook data
+        tagchain: a chain of tags
+        counter: count unique URLs to match items count during import
+        deduplicator: deduplicator object
+        manifest: DataManifest of source_dir
+        state: ExportState, items exported before and not modified are skipped
+        workers: number of processes rendering items, output is the same
+        args: Args of the run, defaults if not given
+        stages: pipeline stages of plan_items()
+    Returns:
+        Iterator over (node, text) tuples, text contains all RDF entries
+        of the node item: document, attachment and PDF attachments
+    """
+
+    planned = plan_items(node, source_dir, tagchain, counter, deduplicator, manifest, state,
+                         args, stages)
+    if workers <= 1:
+        for node, job in planned:
+            yield node, render_item(job)
+        return
+
+    # Items are planned here, a batch ahead of rendering: workers render one
+    # batch while the next is planned, and memory doesn't grow with scrapbook
+    import itertools
+    # imported on use, as elsewhere: multiprocessing is slow to import and
+    # most runs don't need it
+    import multiprocessing
+    pool = multiprocessing.Pool(workers)
+    batch_size = RENDER_CHUNK_SIZE * workers
+    try:
+        # (nodes, rendering result) of submitted batches
+        pending = collections.deque()
+        while True:
+            planned_batch = list(itertools.islice(planned, batch_size))
+            if not planned_batch:
+                break
+            pending.append(([node for node, _ in planned_batch],
+                            pool.map_async(render_item, [job for _, job in planned_batch],
+                                           RENDER_CHUNK_SIZE)))
+            if len(pending) > 1:
+                nodes, result = pending.popleft()
+                for node, text in zip(nodes, result.get()):
+                    yield node, text
+        while pending:
+            nodes, result = pending.popleft()
+            for node, text in zip(nodes, result.get()):
+                yield node, text
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+# Everything render_item() needs to know about exported item
+ItemJob = collections.namedtuple('ItemJob', ['nodeid', 'name', 'source', 'tags', 'date',
+                                             'basedir', 'indexfname', 'pdfnames'])
+
+# Number of items sent to worker process at once
+RENDER_CHUNK_SIZE = 64
+
+def plan_item(node, source_dir, tagchain, counter, deduplicator, manifest, state=None,
+              exclude=None, include=None):
+    """ Decide if and how to export single item
+
+    Args:
+        node: node to process, not a folder
+        source_dir: directory to scrapbook data
+        tagchain: a chain of tags
+        counter: count unique URLs to match items count during import
+        deduplicator: deduplicator object
+        manifest: DataManifest of source_dir
+        state: ExportState, items exported before and not modified are skipped
+        exclude: Selector of items not to export (--exclude)
+        include: Selector of the only items to export (--include)
+    Returns:
+        ItemJob for render_item() or None if item is not exported
+    """
+
+    if node.type == 'note':
+        sys.stderr.write("ERROR: 'note' type is not implemented, can't process entry"
+                         "'%s'. Skipping.\n" % node.nodeid)
+    elif node.type == 'separator':
+        # no need to export
+        pass
+    elif state is not None and state.unchanged(node, "%s/data/%s" % (source_dir, node.nodeid)):
+        debug("skipping unchanged item '%s'", node.nodeid)
+    elif exclude is not None and exclude.matches(counter.cnt, node):
+        debug("excluding node #%d", counter.cnt)
+        counter.count(node.source)
+    elif include is not None and not include.matches(counter.cnt, node):
+        # record numbers stay the same as in export of everything
+        counter.count(node.source)
+    elif deduplicator.merge(node) is not None:
+        # same content exported already, not a new Zotero item
+        debug("merging item '%s' into item with the same content", node.nodeid)
+        STATS.add('items merged')
+        if state is not None:
+            basedir = "%s/data/%s" % (source_dir, node.nodeid)
+            state.update(node, node.name, basedir,
+                         basedir + '/' + index_name(manifest.get(node.nodeid).files))
+    else: # saved document or notex
+        debug("exporting item '%s' source '%s'", node.nodeid, node.source)
+        # Count unique URLs to track Zotero's import number
+        counter.count(node.source)
+        basedir = "%s/data/%s" % (source_dir, node.nodeid)
+        entries = manifest.get(node.nodeid)
+        indexname = index_name(entries.files) if entries is not None else None
+        # Check index file existance
+        if indexname is None:
+            sys.stderr.write("ERROR: failed to export %s entry (#%d), no index.html "
+                             "or default.html. Skipping. Try to inspect directory "
+                             "'%s/data/%s' and decide what to do with orphaned data.\n"
+                             % (node.nodeid, counter.cnt, source_dir, node.nodeid))
+            return None
+        indexfname = basedir + '/' + indexname
+        # Avoid empty name and source
+        if node.name == '':
+            node.name = node.source
+        if node.source == '':
+            node.source = node.nodeid
+
+        # Deduplicate, keep name given by previous run
+        title = node.name
+        name = state.name(node, title) if state is not None else None
+        if name is not None:
+            node.name = name
+        else:
+            node.name = node.name + deduplicator.getdupnum(node.name)
+
+        # Check for PDF files and add them as separate entries
+        pdfnames = fnmatch.filter(entries.names, "*.pdf")
+        for pdfname in pdfnames:
+            debug("pdf attachment '%s' added to '%s'", pdfname, node.nodeid)
+        STATS.add('pdfs attached', len(pdfnames))
+        STATS.add('items exported')
+
+        if state is not None:
+            state.update(node, title, basedir, indexfname)
+        return ItemJob(node.nodeid, node.name, node.source, tagchain.lstrip('/'),
+                       item_date(node, basedir, entries, indexfname), basedir, indexfname,
+                       pdfnames)
+    return None
+
+# RDF entries of exported item, fields are escaped by render_item().
+# Positional fields are faster than named ones.
+DOCUMENT_TEMPLATE = u"""\n    <bib:Document rdf:about="{0}">
+        <z:itemType>webpage</z:itemType>
+        <dcterms:isPartOf>
+           <z:Website></z:Website>
+        </dcterms:isPartOf>
+        <link:link rdf:resource="#item_{1}"/>{5}
+        <dc:subject>{4}</dc:subject>
+        <dc:identifier>
+            <dcterms:URI>
+               <rdf:value>{0}</rdf:value>
+            </dcterms:URI>
+        </dc:identifier>
+        <dcterms:dateSubmitted>{2}</dcterms:dateSubmitted>
+        <dc:title>{3}</dc:title>
+    </bib:Document>"""
+ATTACHMENT_TEMPLATE = u"""\n    <z:Attachment rdf:about="#item_{0}">
         <z:itemType>attachment</z:itemType>
         <rdf:resource rdf:resource="{1}"/>
         <dc:identifier>
@@ -436,22 +2432,866 @@ def export_node(node, source_dir, tagchain, counter, deduplicator):
         <dcterms:dateSubmitted>{3}</dcterms:dateSubmitted>
         <dc:title>{4}</dc:title>
         <z:linkMode>1</z:linkMode>
-        <link:type>text/html</link:type>
-    </z:Attachment>""".format(node.nodeid, # {0}
-                              os.path.normpath(indexfname), # {1}
-                              ampersand(node.source), # {2}
-                              nodetime_formatted, # {3}
-                              ampersand(node.name) # {4}
-                             )
-        result += pdfs
-    return result
+        <link:type>{5}</link:type>
+    </z:Attachment>"""
+PDF_TEMPLATE = u"""\n    <z:Attachment rdf:about="#item_{0}">
+        <z:itemType>attachment</z:itemType>
+        <rdf:resource rdf:resource="{1}"/>
+        <dc:title>{2}</dc:title>
+        <link:type>application/pdf</link:type>
+    </z:Attachment>"""
+PDF_LINK_TEMPLATE = u'\n        <link:link rdf:resource="#item_{0}"/>'
+
+# Content types of attachments by extension of file, others are web pages
+ATTACHMENT_TYPES = {'.zip': u'application/zip'}
+
+def attachment_type(filename):
+    """ Content type of item attachment, packed by --pack or not """
+    return ATTACHMENT_TYPES.get(os.path.splitext(filename)[1], u'text/html')
+
+def render_item(job):
+    """ Make RDF entries of exported item
+
+    Runs in worker processes with --workers, so it must not depend on
+    anything but job. Every field is escaped once.
+
+    Args:
+        job: ItemJob from plan_item()
+    Returns:
+        Text with all RDF entries of the item: document, attachment and
+        PDF attachments
+    """
+
+    date = job.date
+    source = xml_escape(job.source)
+    name = xml_escape(job.name)
+
+    # PDF files are separate entries
+    pdfs = []
+    pdf_links = []
+    for pdf_count, pdfname in enumerate(job.pdfnames, 1):
+        pdf_resource = job.nodeid+'0'+str(pdf_count)
+        pdfs.append(PDF_TEMPLATE.format(
+            pdf_resource, xml_escape(os.path.normpath(job.basedir + '/' + pdfname)),
+            xml_escape(pdfname)))
+        pdf_links.append(PDF_LINK_TEMPLATE.format(pdf_resource))
+
+    document = DOCUMENT_TEMPLATE.format(source, # {0}
+                                        job.nodeid, # {1}
+                                        date, # {2}
+                                        name, # {3}
+                                        xml_escape(job.tags), # {4}
+                                        u"".join(pdf_links) # {5}
+                                       )
+    attachment = ATTACHMENT_TEMPLATE.format(job.nodeid, # {0}
+                                            xml_escape(os.path.normpath(job.indexfname)), # {1}
+                                            source, # {2}
+                                            date, # {3}
+                                            name, # {4}
+                                            attachment_type(job.indexfname) # {5}
+                                           )
+    return u"".join([document, attachment] + pdfs)
+
+def export_node(node, source_dir, tagchain, counter, deduplicator, manifest):
+    """ Export node
+
+    Args:
+        node: node to process
+        source_dir: directory to scrapbook data
+        tagchain: a chain of tags
+        counter: count unique URLs to match items count during import
+        deduplicator: deduplicator object
+        manifest: DataManifest of source_dir
+    Returns:
+        Iterator over text strings with all items as RDF entries
+    """
+
+    for _, text in export_items(node, source_dir, tagchain, counter, deduplicator, manifest):
+        yield text
+
+RDF_HEADER = u"""<rdf:RDF
+xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+xmlns:z="http://www.zotero.org/namespaces/export#"
+xmlns:dcterms="http://purl.org/dc/terms/"
+xmlns:link="http://purl.org/rss/1.0/modules/link/"
+xmlns:dc="http://purl.org/dc/elements/1.1/"
+xmlns:bib="http://purl.org/net/biblio#">"""
+
+RDF_FOOTER = u"\n</rdf:RDF>"
+
+# Output buffer size, fragments are small and there are a lot of them
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+def export_rdf(root, source_dir, manifest, state=None, workers=1, deduplicator=None,
+               args=None, stages=(), counter=None):
+    """ Export whole tree as RDF document
+
+    Args:
+        root: root node to export
+        source_dir: directory to scrapbook data
+        manifest: DataManifest of source_dir
+        state: ExportState for incremental export, only new and changed
+            items and their collections are exported
+        workers: number of processes rendering items
+        deduplicator: Deduper, new one by default
+        args: Args of the run, defaults if not given
+        stages: pipeline stages of plan_items()
+        counter: Counter numbering records, new one by default
+    Returns:
+        Iterator over text strings making up RDF document
+    """
+
+    if args is None:
+        args = Args()
+    if counter is None:
+        counter = Counter()
+    yield RDF_HEADER
+    if deduplicator is None:
+        deduplicator = Deduper(state.dupes if state is not None else None,
+                               numbering=not args.disable_dedup)
+    # when items are left out, collections link only to exported ones, as in chunks
+    sources = None
+    if state is not None or args.exclude is not None or args.include is not None:
+        sources = set()
+    for node, text in STATS.timed('export_node', export_items(
+            root, source_dir, None, counter, deduplicator, manifest, state, workers, args,
+            stages)):
+        if sources is not None:
+            sources.add(node.source)
+        yield text
+    # collections go after items, export_items() fixes names and sources
+    if not args.disable_collections:
+        for fragment in STATS.timed('export_collections', export_collections(root, sources)):
+            yield fragment
+    yield RDF_FOOTER
+
+def chunk_filename(rdffilename, number):
+    """ Make chunk file name: OUTPUT.RDF -> OUTPUT.001.RDF """
+    base, ext = os.path.splitext(rdffilename)
+    return "%s.%03d%s" % (base, number, ext or '.rdf')
+
+def close_output(filehandle):
+    """ Close output file, counting bytes written for --stats """
+    if STATS.enabled:
+        try:
+            filehandle.flush()
+            STATS.add('bytes written', filehandle.buffer.tell())
+        except (IOError, OSError):
+            # not a file, i.e. a pipe
+            pass
+    filehandle.close()
+
+def open_output(rdffilename):
+    """ Open output file for writing, '-' means standard output """
+    if rdffilename == '-':
+        return io.open(sys.stdout.fileno(), 'w', encoding='utf-8',
+                       buffering=WRITE_BUFFER_SIZE, closefd=False)
+    try:
+        return io.open(rdffilename, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE)
+    except IOError:
+        raise ExportError("can't open file '%s' to write." % rdffilename)
+
+class ChunkCollections(object):
+    """ Collections needed for items of current chunk, the same as
+    export_collections(root, sources) makes, without walking the tree
+
+    Places of items in folders are found once. Every item added to the chunk
+    links its folders, and new folders link to their parents. Size of the
+    collection entries is kept for --max-bytes.
+    """
+
+    def __init__(self, root):
+        # folders in order of export_collections()
+        self.folders = list(iter_folders(root))
+        # (parent folder number, index in parent) by folder number
+        self.parents = {}
+        # (folder number, index in folder) of items by their sources
+        self.places = collections.defaultdict(list)
+        # (source, folder number, index in folder) of item by id() of its node
+        self.filed = {}
+        numbers = dict((id(folder), number) for number, folder in enumerate(self.folders))
+        for number, folder in enumerate(self.folders):
+            for index, node in enumerate(folder.children):
+                if node.type == 'folder':
+                    self.parents[numbers[id(node)]] = (number, index)
+                elif node.type != 'note' and node.type != 'separator':
+                    self.places[node.source].append((number, index))
+                    self.filed[id(node)] = (node.source, number, index)
+        self.start()
+
+    def start(self):
+        """ Begin new chunk """
+        self.sources = set()
+        self.needed = set()
+        # (index in folder, entry) tuples by folder number
+        self.links = collections.defaultdict(list)
+        self.size = 0
+
+    def link(self, number, index, entry, added, dry_run=False):
+        """ Add entry to folder, new folder is linked to its parent
+
+        Args:
+            number: folder number
+            index: index of entry in folder
+            entry: RDF text of link
+            added: set of folder numbers needed since now
+            dry_run: only count size
+        Returns:
+            size of new collection entries in bytes
+        """
+        size = 0
+        while True:
+            folder = self.folders[number]
+            if folder.name != "":
+                # root collection is not generated
+                size += len(entry.encode('utf-8'))
+            if not dry_run:
+                self.links[number].append((index, entry))
+            if number in self.needed or number in added:
+                return size
+            added.add(number)
+            if folder.name != "":
+                size += len(COLLECTION_TEMPLATE.format(folder.nodeid, xml_escape(folder.name))
+                            .encode('utf-8')) + len(COLLECTION_FOOTER)
+            if number not in self.parents:
+                return size
+            number, index = self.parents[number]
+            entry = SUBCOLLECTION_TEMPLATE.format(folder.nodeid)
+
+    def add(self, source, dry_run=False):
+        """ Add item with source to chunk
+
+        Args:
+            source: source of exported item
+            dry_run: only count size, to check --max-bytes before adding
+        Returns:
+            size of new collection entries in bytes
+        """
+        if source in self.sources:
+            return 0
+        added = set() if dry_run else self.needed
+        entry = COLLECTION_ITEM_TEMPLATE.format(xml_escape(source))
+        size = sum(self.link(number, index, entry, added, dry_run)
+                   for number, index in self.places.get(source, ()))
+        if not dry_run:
+            self.sources.add(source)
+            self.size += size
+        return size
+
+    def move(self, node):
+        """ File item under its current source, plan_item() changes empty
+        sources and sources of merged items
+        """
+        source, number, index = self.filed.get(id(node), (node.source, None, None))
+        if source == node.source:
+            return
+        self.places[source].remove((number, index))
+        self.places[node.source].append((number, index))
+        self.filed[id(node)] = (node.source, number, index)
+        if node.source in self.sources:
+            self.size += self.link(number, index,
+                                   COLLECTION_ITEM_TEMPLATE.format(xml_escape(node.source)),
+                                   self.needed)
+
+    def export(self):
+        """ Iterator over text strings with collections of chunk as RDF entries """
+        for number in sorted(self.needed):
+            folder = self.folders[number]
+            if folder.name == "":
+                continue
+            yield u"".join([COLLECTION_TEMPLATE.format(folder.nodeid, xml_escape(folder.name))] +
+                           [entry for _, entry in sorted(self.links[number])] +
+                           [COLLECTION_FOOTER])
+
+def export_chunks(root, source_dir, manifest, rdffilename, max_items=None, max_bytes=None,
+                  state=None, workers=1, deduplicator=None, args=None, stages=(),
+                  counter=None):
+    """ Export whole tree as several self-contained RDF documents
+
+    Every chunk gets all entries of its items and only collections needed
+    for them. Record numbers are counted across all chunks.
+
+    Args:
+        root: root node to export
+        source_dir: directory to scrapbook data
+        manifest: DataManifest of source_dir
+        rdffilename: output file name, chunks are named by chunk_filename()
+        max_items: max number of items in a chunk
+        max_bytes: max size of a chunk, approximate, a single item is never split
+        state: ExportState for incremental export
+        workers: number of processes rendering items
+        deduplicator: Deduper, new one by default
+        args: Args of the run, defaults if not given
+        stages: pipeline stages of plan_items()
+        counter: Counter numbering records, new one by default
+    Returns:
+        Number of chunks written
+    """
+
+    if args is None:
+        args = Args()
+    if counter is None:
+        counter = Counter()
+    chunks = 0
+    filehandle = None
+    items = 0
+    size = 0
+    footer_size = len(RDF_FOOTER)
+    # found once, not for every chunk
+    chunk_collections = None if args.disable_collections else ChunkCollections(root)
+
+    def close_chunk():
+        """ Write collections and footer of current chunk """
+        if chunk_collections is not None:
+            filehandle.writelines(STATS.timed('export_collections', chunk_collections.export()))
+        filehandle.write(RDF_FOOTER)
+        close_output(filehandle)
+
+    if deduplicator is None:
+        deduplicator = Deduper(state.dupes if state is not None else None,
+                               numbering=not args.disable_dedup)
+    merged = 0
+    for node, text in STATS.timed('export_node', export_items(
+            root, source_dir, None, counter, deduplicator, manifest, state, workers, args,
+            stages)):
+        # collections written at the end of chunk count too
+        links_size = 0
+        if chunk_collections is not None:
+            # merged items link to the kept one, empty sources became ids
+            for merged_node, _ in deduplicator.merged[merged:]:
+                chunk_collections.move(merged_node)
+            merged = len(deduplicator.merged)
+            chunk_collections.move(node)
+            if max_bytes:
+                links_size = (chunk_collections.size +
+                              chunk_collections.add(node.source, dry_run=True))
+        if max_bytes:
+            text_size = len(text.encode('utf-8'))
+        if filehandle is not None and (
+                (max_items and items >= max_items) or
+                (max_bytes and size + text_size + links_size + footer_size > max_bytes)):
+            close_chunk()
+            filehandle = None
+        if filehandle is None:
+            chunks += 1
+            debug("writing chunk #%d", chunks)
+            filehandle = open_output(chunk_filename(rdffilename, chunks))
+            filehandle.write(RDF_HEADER)
+            if chunk_collections is not None:
+                chunk_collections.start()
+            items = 0
+            size = len(RDF_HEADER)
+        filehandle.write(text)
+        items += 1
+        if max_bytes:
+            size += text_size
+        if chunk_collections is not None:
+            chunk_collections.add(node.source)
+    if filehandle is not None:
+        close_chunk()
+    return chunks
+
+# Records and references of RDF written by export: tag, rdf attribute and its value.
+# Every element of export is on its own line, listing tags is twice faster.
+RDF_REFERENCE = re.compile(br'<(bib:Document|z:Attachment|z:Collection|link:link|rdf:resource|'
+                           br'dcterms:hasPart) rdf:(about|resource)="([^"]*)"')
+
+# Bytes of RDF file checked at once
+VERIFY_READ_SIZE = 1024 * 1024
+
+def xml_unescape(text):
+    """ Reverse xml_escape() """
+    return (text.replace(u'&quot;', u'"').replace(u'&gt;', u'>')
+            .replace(u'&lt;', u'<').replace(u'&amp;', u'&'))
+
+class RdfVerifier(object):
+    """ Streaming check of RDF files written by export (verify, --verify)
+
+    Files are read by blocks, expat checks that they are well-formed XML
+    and a regular expression finds records and references, both without
+    calling Python for every element. Only ids of records are kept, so
+    memory use depends on number of records, not on size of files.
+
+    Every reference (attachments of items, items and subcollections of
+    collections) must resolve to a record of the same file, as files are
+    imported one by one, and every attached file must exist.
+    """
+
+    def __init__(self, numbers=None, filehandle=None):
+        # record numbers by source from export, counted here if not given
+        self.numbers = numbers
+        self.documents = {}
+        # problems go to stderr by default
+        self.filehandle = filehandle
+        self.problems = 0
+        self.totals = collections.defaultdict(int)
+        self.filename = None
+        # record being checked, ids of records and unresolved references of file
+        self.label = None
+        self.defined = set()
+        self.pending = {}
+        self.owners = {}
+
+    def problem(self, label, message):
+        """ Report problem of record """
+        self.problems += 1
+        (self.filehandle or sys.stderr).write(
+            (u"ERROR: %s: %s: %s\n" % (self.filename, label, message)).encode('utf-8'))
+
+    def record(self, tag, about):
+        """ Label of record in problems, with record number for items """
+        if tag == b'bib:Document':
+            self.totals['items'] += 1
+            if self.numbers is not None:
+                number = self.numbers.get(about)
+            else:
+                number = self.documents.setdefault(about, len(self.documents) + 1)
+            return u'#%d %s' % (number, about) if number is not None else about
+        if tag == b'z:Attachment':
+            self.totals['attachments'] += 1
+            # problems of attachments are problems of their items
+            return self.owners.pop(about, None) or u'attachment ' + about
+        if tag == b'z:Collection':
+            self.totals['collections'] += 1
+            return u'collection ' + about.replace(u'#collection_', u'', 1)
+        return about
+
+    def scan(self, data, basedir):
+        """ Check records and references in block of complete lines
+
+        Returns:
+            list of (position, label) of records in data, starting with
+            record going on at its start
+        """
+        starts = [(0, self.label)]
+        for match in RDF_REFERENCE.finditer(data):
+            tag, attribute, value = match.groups()
+            # faster than value.decode()
+            value = unicode(value, 'utf-8')
+            if u'&' in value:
+                value = xml_unescape(value)
+            if attribute == b'about':
+                self.defined.add(value)
+                self.pending.pop(value, None)
+                self.label = self.record(tag, value)
+                starts.append((match.start(), self.label))
+            elif tag == b'rdf:resource':
+                # attached file, relative to output file or to current directory
+                self.totals['attached files'] += 1
+                if not (os.path.exists(value) or os.path.exists(os.path.join(basedir, value))):
+                    self.problem(self.label, u"attached file '%s' does not exist" % value)
+            else:
+                if tag == b'link:link':
+                    self.owners[value] = self.label
+                if value not in self.defined:
+                    self.pending.setdefault(value, (self.label, tag))
+        return starts
+
+    def unresolved(self):
+        """ Report references to records missing in file """
+        for value, (label, tag) in sorted(self.pending.items()):
+            if tag == b'link:link':
+                message = u"link to attachment '%s' which is not in file" % value
+            elif value.startswith(u'#collection_'):
+                message = u"link to subcollection '%s' which is not in file" % value
+            else:
+                message = u"link to item '%s' which is not in file" % value
+                number = self.numbers.get(value) if self.numbers is not None else None
+                if number is not None:
+                    message += u" (record #%d, excluded or skipped)" % number
+            self.problem(label, message)
+
+    def verify(self, filename):
+        """ Check single file
+
+        Returns:
+            number of problems found in file
+        """
+        problems = self.problems
+        self.filename = decode_arg(filename)
+        self.label = u'header'
+        self.defined = set()
+        self.pending = {}
+        self.owners = {}
+        self.totals['rdf files'] += 1
+        parser = expat.ParserCreate(namespace_separator=' ')
+        basedir = decode_arg(os.path.dirname(filename))
+        offset = 0
+        tail = b''
+        with open(filename, 'rb') as filehandle:
+            while True:
+                data = filehandle.read(VERIFY_READ_SIZE)
+                block = tail + data
+                # lines split by blocks wait for the next block
+                end = block.rfind(b'\n') + 1 if data else len(block)
+                starts = self.scan(block[:end], basedir)
+                try:
+                    parser.Parse(block[:end], not data)
+                except expat.ExpatError as error:
+                    position = parser.ErrorByteIndex - offset
+                    label = starts[bisect.bisect_right([start for start, _ in starts],
+                                                       position) - 1][1]
+                    self.problem(label, u"broken XML at line %d, column %d: %s"
+                                 % (error.lineno, error.offset + 1,
+                                    expat.ErrorString(error.code)))
+                    # the rest can't be trusted
+                    return self.problems - problems
+                offset += end
+                tail = block[end:]
+                if not data:
+                    break
+        self.unresolved()
+        return self.problems - problems
+
+    def report(self, filehandle):
+        """ Write totals of all checked files """
+        filehandle.write("Verified %d RDF files: %d items, %d attachments, %d attached files, "
+                         "%d collections, %d problems\n"
+                         % (self.totals['rdf files'], self.totals['items'],
+                            self.totals['attachments'], self.totals['attached files'],
+                            self.totals['collections'], self.problems))
+
+# Characters of Zotero item and collection keys
+ZOTERO_KEY_CHARS = '23456789ABCDEFGHIJKLMNPQRSTUVWXYZ'
+# Items written to Zotero database in one transaction
+SQLITE_BATCH_SIZE = 5000
+# Page cache of Zotero database connection
+SQLITE_CACHE_KB = 256 * 1024
+# itemAttachments.linkMode of files outside Zotero storage
+LINK_MODE_LINKED_FILE = 2
+
+# Statements of ZoteroDB, in order of writing
+INSERT_VALUE = "INSERT INTO itemDataValues (valueID, value) VALUES (?, ?)"
+INSERT_TAG = "INSERT INTO tags (tagID, name) VALUES (?, ?)"
+# dateAdded is NOT NULL, items without date are added now
+INSERT_ITEM = ("INSERT INTO items (itemID, itemTypeID, dateAdded, libraryID, key) "
+               "VALUES (?, ?, IFNULL(?, CURRENT_TIMESTAMP), ?, ?)")
+INSERT_ITEM_DATA = "INSERT INTO itemData (itemID, fieldID, valueID) VALUES (?, ?, ?)"
+INSERT_ATTACHMENT = ("INSERT INTO itemAttachments (itemID, parentItemID, linkMode, "
+                     "contentType, path) VALUES (?, ?, ?, ?, ?)")
+INSERT_ITEM_TAG = "INSERT OR IGNORE INTO itemTags (itemID, tagID, type) VALUES (?, ?, 0)"
+INSERT_COLLECTION = ("INSERT INTO collections (collectionID, collectionName, "
+                     "parentCollectionID, libraryID, key) VALUES (?, ?, ?, ?, ?)")
+INSERT_COLLECTION_ITEM = ("INSERT OR IGNORE INTO collectionItems (collectionID, itemID, "
+                          "orderIndex) VALUES (?, ?, ?)")
+DELETE_COLLECTION_ITEM = ("DELETE FROM collectionItems WHERE collectionID = ? AND itemID IN "
+                          "(SELECT itemID FROM items WHERE libraryID = ? AND key = ?)")
+ZOTERO_STATEMENTS = (DELETE_COLLECTION_ITEM, INSERT_VALUE, INSERT_TAG, INSERT_ITEM,
+                     INSERT_ITEM_DATA, INSERT_ATTACHMENT, INSERT_ITEM_TAG, INSERT_COLLECTION,
+                     INSERT_COLLECTION_ITEM)
+
+# Byte to key character, for str.translate()
+ZOTERO_KEY_TABLE = ''.join(ZOTERO_KEY_CHARS[byte % len(ZOTERO_KEY_CHARS)]
+                           for byte in range(256))
+
+def utc_date(date):
+    """ Turn local date made by item_date(), 'YYYY-MM-DD hh:mm:ss', into UTC,
+    as Zotero keeps dates in its database
+
+    Returns:
+        date in UTC or None if date is empty or invalid
+    """
+    try:
+        seconds = time.mktime((int(date[0:4]), int(date[5:7]), int(date[8:10]),
+                               int(date[11:13]), int(date[14:16]), int(date[17:19]), 0, 0, -1))
+    except (ValueError, OverflowError):
+        return None
+    return u'%04d-%02d-%02d %02d:%02d:%02d' % time.gmtime(seconds)[:6]
+
+def zotero_key(seed):
+    """ Zotero key made from seed string, the same for the same seed """
+    return hashlib.sha1(seed.encode('utf-8')).digest()[:8].translate(ZOTERO_KEY_TABLE)
+
+class ZoteroDB(object):
+    """ Items and collections written straight into Zotero database (zotero.sqlite)
+
+    Rows are collected in memory and written by executemany() every
+    SQLITE_BATCH_SIZE items, one transaction per batch. Ids of new rows are
+    given here, after the largest ids in database, and item types and
+    fields are looked up by name, so any Zotero 5 database will do.
+    """
+
+    def __init__(self, filename, library=1):
+        import sqlite3
+        self.error = sqlite3.Error
+        if not os.path.isfile(filename):
+            raise ExportError("no Zotero database '%s'" % filename)
+        self.library = library
+        self.connection = sqlite3.connect(filename)
+        execute = self.connection.execute
+        # indexes of big libraries don't fit into default 2 MB cache
+        execute("PRAGMA cache_size = -%d" % SQLITE_CACHE_KB)
+        try:
+            self.types = dict(execute("SELECT typeName, itemTypeID FROM itemTypes"))
+            self.fields = dict(execute("SELECT fieldName, fieldID FROM fields"))
+            self.next_ids = {}
+            for table, column in (('items', 'itemID'), ('itemDataValues', 'valueID'),
+                                  ('tags', 'tagID'), ('collections', 'collectionID')):
+                self.next_ids[table] = execute("SELECT IFNULL(MAX(%s), 0) + 1 FROM %s"
+                                               % (column, table)).fetchone()[0]
+            self.keys = set(row[0] for row in execute(
+                "SELECT key FROM items WHERE libraryID = ?", (library,)))
+            # collections of previous runs are reused
+            self.collection_ids = dict(execute(
+                "SELECT key, collectionID FROM collections WHERE libraryID = ?", (library,)))
+            self.values = dict(execute("SELECT value, valueID FROM itemDataValues"))
+            self.tags = dict(execute("SELECT name, tagID FROM tags"))
+        except sqlite3.Error as error:
+            self.connection.close()
+            raise ExportError("can't use Zotero database '%s': %s" % (filename, error))
+        missing = (set(['webpage', 'attachment']) - set(self.types) |
+                   set(['title', 'url']) - set(self.fields))
+        if missing:
+            self.connection.close()
+            raise ExportError("Zotero database '%s' has no %s" % (filename,
+                                                                  ', '.join(sorted(missing))))
+        self.rows = collections.defaultdict(list)
+        # Zotero item id by source, sources are item identities in RDF too
+        self.item_ids = {}
+        self.pending = 0
+
+    def new_id(self, table):
+        """ Id for new row of table """
+        newid = self.next_ids[table]
+        self.next_ids[table] = newid + 1
+        return newid
+
+    def new_key(self, seed):
+        """ Key for new item, made from seed but not used in library yet """
+        key = zotero_key(seed)
+        while key in self.keys:
+            seed += '+'
+            key = zotero_key(seed)
+        self.keys.add(key)
+        return key
+
+    def add_item(self, typename, seed, date):
+        """ Add item row, return its id
+
+        Args:
+            typename: Zotero item type
+            seed: seed of item key
+            date: dateAdded in UTC, None for now
+        """
+        itemid = self.new_id('items')
+        self.rows[INSERT_ITEM].append((itemid, self.types[typename], date,
+                                       self.library, self.new_key(seed)))
+        return itemid
+
+    def set_field(self, itemid, fieldname, value):
+        """ Add field value of item """
+        valueid = self.values.get(value)
+        if valueid is None:
+            valueid = self.values[value] = self.new_id('itemDataValues')
+            self.rows[INSERT_VALUE].append((valueid, value))
+        self.rows[INSERT_ITEM_DATA].append((itemid, self.fields[fieldname], valueid))
+
+    def add_tag(self, itemid, name):
+        """ Tag item """
+        tagid = self.tags.get(name)
+        if tagid is None:
+            tagid = self.tags[name] = self.new_id('tags')
+            self.rows[INSERT_TAG].append((tagid, name))
+        self.rows[INSERT_ITEM_TAG].append((itemid, tagid))
+
+    def add_job(self, job):
+        """ Add item planned by plan_item(), with its attachments
+
+        Items with the same source become one Zotero item with several
+        attachments, as they do in RDF import.
+        """
+        date = utc_date(job.date)
+        parentid = self.item_ids.get(job.source)
+        if parentid is None:
+            parentid = self.item_ids[job.source] = self.add_item('webpage', job.nodeid, date)
+            self.set_field(parentid, 'title', job.name)
+            self.set_field(parentid, 'url', job.source)
+        if job.tags:
+            self.add_tag(parentid, job.tags)
+        attachmentid = self.add_item('attachment', job.nodeid + '/index', date)
+        self.set_field(attachmentid, 'title', job.name)
+        self.set_field(attachmentid, 'url', job.source)
+        self.rows[INSERT_ATTACHMENT].append((attachmentid, parentid, LINK_MODE_LINKED_FILE,
+                                             attachment_type(job.indexfname),
+                                             os.path.abspath(job.indexfname)))
+        for pdfname in job.pdfnames:
+            pdfid = self.add_item('attachment', job.nodeid + '/' + pdfname, date)
+            self.set_field(pdfid, 'title', pdfname)
+            self.rows[INSERT_ATTACHMENT].append((pdfid, parentid, LINK_MODE_LINKED_FILE,
+                                                 u'application/pdf',
+                                                 os.path.abspath(job.basedir + '/' + pdfname)))
+        self.pending += 1
+        if self.pending >= SQLITE_BATCH_SIZE:
+            self.flush()
+
+    def remove_from_collections(self, memberships):
+        """ Take items written by previous runs out of collections
+
+        Must be called before add_job(), items written by this run are not
+        looked for.
+
+        Args:
+            memberships: (node id, folder id) tuples
+        """
+        for nodeid, folderid in memberships:
+            if folderid is None:
+                continue
+            collectionid = self.collection_ids.get(zotero_key(u'collection/' + folderid))
+            if collectionid is None:
+                continue
+            # every export of item got the next key, see new_key()
+            seed = nodeid
+            key = zotero_key(seed)
+            while key in self.keys:
+                self.rows[DELETE_COLLECTION_ITEM].append((collectionid, self.library, key))
+                seed += '+'
+                key = zotero_key(seed)
+
+    def add_collections(self, node, sources=None):
+        """ Add collections of folders, same as export_collections() does in RDF
+
+        Returns:
+            number of collections added
+        """
+        needed = None
+        if sources is not None:
+            needed = set()
+            find_collections(node, sources, needed)
+        # collection id by folder id, parents come before children
+        parents = {}
+        added = 0
+        for node in iter_folders(node):
+            if needed is not None and node.nodeid not in needed:
+                continue
+            if node.name == "":
+                # no root collection
+                continue
+            key = zotero_key(u'collection/' + node.nodeid)
+            collectionid = self.collection_ids.get(key)
+            if collectionid is None:
+                collectionid = self.collection_ids[key] = self.new_id('collections')
+                self.rows[INSERT_COLLECTION].append((collectionid, node.name,
+                                                     parents.get(node.nodeid),
+                                                     self.library, key))
+                added += 1
+            order = 0
+            for subnode in node.children:
+                if subnode.type == 'folder':
+                    parents[subnode.nodeid] = collectionid
+                elif subnode.source in self.item_ids:
+                    self.rows[INSERT_COLLECTION_ITEM].append(
+                        (collectionid, self.item_ids[subnode.source], order))
+                    order += 1
+        return added
+
+    def flush(self):
+        """ Write collected rows in one transaction """
+        try:
+            with self.connection:
+                for statement in ZOTERO_STATEMENTS:
+                    rows = self.rows.pop(statement, None)
+                    if rows:
+                        self.connection.executemany(statement, rows)
+        except self.error as error:
+            raise ExportError("can't write to Zotero database: %s" % error)
+        self.pending = 0
+
+    def close(self):
+        """ Close database, rows not flushed are lost """
+        self.connection.close()
+
+def export_sqlite(root, source_dir, manifest, dbfilename, state=None, deduplicator=None,
+                  args=None, stages=()):
+    """ Export whole tree straight into Zotero database, without RDF
+
+    Items, tags and collections are the same as export_rdf() makes, but
+    attachments link to files in place (or in --stage-dir) instead of being
+    copied into Zotero storage.
+
+    Args:
+        root: root node to export
+        source_dir: directory to scrapbook data
+        manifest: DataManifest of source_dir
+        dbfilename: zotero.sqlite to write to
+        state: ExportState for incremental export
+        deduplicator: Deduper, new one by default
+        args: Args of the run, defaults if not given
+        stages: pipeline stages of plan_items()
+    Returns:
+        Number of items written
+    """
+
+    if args is None:
+        args = Args()
+    if deduplicator is None:
+        deduplicator = Deduper(state.dupes if state is not None else None,
+                               numbering=not args.disable_dedup)
+    database = ZoteroDB(dbfilename)
+    # when items are left out, collections link only to exported ones, as in RDF
+    sources = None
+    if state is not None or args.exclude is not None or args.include is not None:
+        sources = set()
+    items = 0
+    try:
+        if state is not None and not args.disable_collections:
+            database.remove_from_collections(list(state.moved.items()) +
+                                             list(state.deleted.items()))
+        for node, job in STATS.timed('export_node', plan_items(
+                root, source_dir, None, Counter(), deduplicator, manifest, state, args,
+                stages)):
+            database.add_job(job)
+            if sources is not None:
+                sources.add(node.source)
+            items += 1
+        if not args.disable_collections:
+            with STATS.phase('export_collections'):
+                STATS.add('collections written', database.add_collections(root, sources))
+        database.flush()
+    finally:
+        database.close()
+    STATS.add('items written', items)
+    return items
+
+# --dedup choices
+DEDUP_MODES = ('title', 'content')
+# output formats
+OUTPUT_FORMATS = ('rdf', 'sqlite')
 
 class Args(object): # pylint: disable=too-few-public-methods
-    """ Arguments container """
-    pass
+    """ Options of a single run, made by parse_args()
+
+    Class attributes are defaults, used when functions get no options.
+    """
+    debug = False
+    exclude = None
+    include = None
+    folder = None
+    scrapbookdir = None
+    rdffilename = None
+    disable_collections = False
+    disable_tags = False
+    disable_dedup = False
+    dedup = DEDUP_MODES[0]
+    hash_cache = None
+    parser = PARSERS[0]
+    jobs = 1
+    workers = 1
+    chunk_size = None
+    max_bytes = None
+    state = None
+    stats = False
+    stats_json = None
+    profile = None
+    check_index_dat = False
+    cache_dir = None
+    stage_dir = None
+    fulltext = None
+    pack = None
+    verify = False
+    output_format = OUTPUT_FORMATS[0]
 
 def parse_args(argv):
-    """ Parse argv and store them in dummy Args class """
+    """ Parse argv into Args instance """
     parser = argparse.ArgumentParser(
         description="Export from Scrapbook/Scrapbook X to Zotero",
         epilog="""A tool to generate Zotero .rdf import data.
@@ -460,15 +3300,30 @@ File -> Import and import RDF file and wait for export to finish.
 If Zotero hangs during import operation (import counter does not increase
 without several minutes), note last record number and exclude it with
 --exclude option.
+Use '%(prog)s batch --help' to see how to export many scrapbooks at once.
+Use '%(prog)s search --help' to see how to search pages indexed by --fulltext.
+Use '%(prog)s bisect --help' to see how to find the record hanging Zotero.
+Use '%(prog)s verify --help' to see how to check RDF files before import.
+Use '%(prog)s analyze --help' to see how to find large folders and lost items.
 """)
     parser.add_argument('scrapbookdir', action='store', metavar='SCRAPBOOKDIR',
                         help="Source directory, usually somewhere inside mozilla profile")
     parser.add_argument('rdffilename', action='store', metavar='OUTPUT.RDF',
-                        help="Output RDF file name. Use '-' to specify standard output.")
+                        help="Output RDF file name. Use '-' to specify standard output. "
+                        "Zotero database file with --format=sqlite.")
     parser.add_argument('--debug', action='store_true',
                         help="Print debug messages")
-    parser.add_argument('--exclude', nargs='+', action='store',
-                        help="One or more record numbers to exclude")
+    parser.add_argument('--exclude', nargs='+', action='store', metavar='SELECTOR',
+                        help="Items not to export: record numbers (12), ranges (100-250), "
+                        "item ids (id:20180222112456), title or URL patterns "
+                        "(title:*linux*, url:*example.com*)")
+    parser.add_argument('--include', nargs='+', action='store', metavar='SELECTOR',
+                        help="Export only these items, same selectors as --exclude. "
+                        "Record numbers are the same as in export of everything")
+    parser.add_argument('--folder', action='append', metavar='ID|PATH',
+                        help="Export only this folder, given by item id or by path of "
+                        "folder names from root, like 'Work/Projects'. Can be repeated. "
+                        "Tags and collections start from the folder")
     parser.add_argument('--version', action='version', version='%(prog)s ' + VERSION)
     parser.add_argument('--nocoll', action='store_true',
                         help="Disable export of collections")
@@ -476,51 +3331,855 @@ without several minutes), note last record number and exclude it with
                         help="Disable export of tags")
     parser.add_argument('--nodedup', action='store_true',
                         help="Disable deduplication")
+    parser.add_argument('--dedup', choices=DEDUP_MODES, default=DEDUP_MODES[0],
+                        help="Deduplication mode: number equal titles (default) or also "
+                        "merge pages with byte-identical index file and PDFs into one item")
+    parser.add_argument('--hash-cache', metavar='FILE',
+                        help="Keep file hashes of --dedup=content in FILE between runs")
+    parser.add_argument('--cache-dir', metavar='DIR',
+                        help="Keep parsed scrapbook.rdf in DIR and reuse it while "
+                        "scrapbook.rdf is not changed")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default=OUTPUT_FORMATS[0],
+                        help="rdf: write RDF file for Zotero import (default), sqlite: write "
+                        "straight into existing Zotero database (zotero.sqlite, Zotero "
+                        "must be closed)")
+    parser.add_argument('--fulltext', metavar='FILE',
+                        help="Extract text of exported pages into full-text index FILE "
+                        "(SQLite), by --workers processes")
+    parser.add_argument('--stage-dir', metavar='DIR',
+                        help="Copy data directories of exported items into DIR (hardlink "
+                        "if possible, skip unchanged files) and refer to the copies")
+    parser.add_argument('--pack', choices=PACK_FORMATS,
+                        help="With --stage-dir, pack data directory of every exported item "
+                        "into single file instead of copying it: zip archive or HTML page "
+                        "with images, styles and frames inlined. PDFs stay separate files. "
+                        "Done by --workers processes")
+    parser.add_argument('--chunk-size', type=int, metavar='N',
+                        help="Split output into files with at most N items each: "
+                        "OUTPUT.001.RDF, OUTPUT.002.RDF, ...")
+    parser.add_argument('--max-bytes', type=int, metavar='N',
+                        help="Split output into files of about N bytes each")
+    parser.add_argument('--state', metavar='FILE',
+                        help="Incremental export: remember exported items in FILE and "
+                        "export only new and changed items on next runs")
+    parser.add_argument('--stats', action='store_true',
+                        help="Print time spent in every phase and counters of processed data")
+    parser.add_argument('--stats-json', metavar='FILE',
+                        help="Save --stats data to FILE as JSON")
+    parser.add_argument('--profile', metavar='FILE',
+                        help="Run under cProfile and save profile data to FILE")
+    parser.add_argument('--jobs', type=int, default=1, metavar='N',
+                        help="Number of threads scanning data directories (default: 1)")
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help="Number of processes rendering RDF entries (default: 1)")
+    parser.add_argument('--verify', action='store_true',
+                        help="Check written RDF: well-formed XML, links between records, "
+                        "attached files. Problems are reported with record numbers of "
+                        "--exclude, exit code is -1 if there are any")
+    parser.add_argument('--check-index-dat', action='store_true',
+                        help="Warn about items with title, source or type different "
+                        "in scrapbook.rdf and index.dat")
+    parser.add_argument('--parser', choices=PARSERS, default=PARSERS[0],
+                        help="RDF parser engine: built-in streaming parser (default) "
+                        "or rdflib")
     parsed = parser.parse_args(argv)
-    Args.debug = parsed.debug
-    Args.exclude = parsed.exclude
-    Args.scrapbookdir = parsed.scrapbookdir
-    Args.rdffilename = parsed.rdffilename
-    Args.disable_collections = parsed.nocoll
-    Args.disable_tags = parsed.notags
-    Args.disable_dedup = parsed.nodedup
+    if (parsed.chunk_size or parsed.max_bytes) and parsed.rdffilename == '-':
+        parser.error("can't split standard output into chunks")
+    if parsed.format == 'sqlite' and (parsed.chunk_size or parsed.max_bytes
+                                      or parsed.rdffilename == '-'):
+        parser.error("--format=sqlite writes a single database file")
+    if parsed.verify and (parsed.format != 'rdf' or parsed.rdffilename == '-'):
+        parser.error("--verify checks RDF files, not standard output or database")
+    if parsed.pack and not parsed.stage_dir:
+        parser.error("--pack needs --stage-dir to write packed files to")
+    args = Args()
+    args.debug = parsed.debug
+    args.folder = parsed.folder
+    try:
+        args.exclude = Selector(parsed.exclude) if parsed.exclude else None
+        args.include = Selector(parsed.include) if parsed.include else None
+    except ValueError as error:
+        parser.error(str(error))
+    args.scrapbookdir = parsed.scrapbookdir
+    args.rdffilename = parsed.rdffilename
+    args.disable_collections = parsed.nocoll
+    args.disable_tags = parsed.notags
+    args.disable_dedup = parsed.nodedup
+    args.dedup = parsed.dedup
+    args.hash_cache = parsed.hash_cache
+    args.cache_dir = parsed.cache_dir
+    args.stage_dir = parsed.stage_dir
+    args.fulltext = parsed.fulltext
+    args.pack = parsed.pack
+    args.output_format = parsed.format
+    args.parser = parsed.parser
+    args.jobs = max(1, parsed.jobs)
+    args.workers = max(1, parsed.workers)
+    args.chunk_size = parsed.chunk_size
+    args.state = parsed.state
+    args.stats = parsed.stats
+    args.stats_json = parsed.stats_json
+    args.profile = parsed.profile
+    args.max_bytes = parsed.max_bytes
+    args.check_index_dat = parsed.check_index_dat
+    args.verify = parsed.verify
+    return args
 
-def main(argv):
-    """ Main as function, useful to run test from py.test with command line args
+def export_scrapbook(args):
+    """ Generate .rdf file from Scrapbook data as told by args """
+
+    manifest = DataManifest(args.scrapbookdir, args.jobs)
+    state = ExportState(args.state) if args.state is not None else None
+    if state is None and not args.folder:
+        # read all data directories at once
+        with STATS.phase('scan'):
+            manifest.scan()
+    with STATS.phase('open_scrapbook_rdf'):
+        root, nodes = open_scrapbook_rdf(args.scrapbookdir, args.parser, manifest,
+                                         args.check_index_dat,
+                                         ItemCache(args.cache_dir) if args.cache_dir else None,
+                                         args.folder)
+    debug("# of items loaded: %d", len(nodes))
+    if state is not None:
+        state.compare(root, not args.folder)
+    if state is not None or args.folder:
+        # read only directories of selected items which may be changed
+        with STATS.phase('scan'):
+            subdirs = set(manifest.subdirs)
+            pending = state.pending(nodes) if state is not None else nodes
+            manifest.scan([nodeid for nodeid in pending if nodeid in subdirs])
+    contents = None
+    if args.dedup == 'content':
+        with STATS.phase('find_same_content'):
+            cache = HashCache(args.hash_cache)
+            contents = find_same_content(root, args.scrapbookdir, manifest, cache, args.jobs)
+            cache.save()
+    deduplicator = Deduper(state.dupes if state is not None else None, contents,
+                           not args.disable_dedup)
+    stages = []
+    if args.fulltext is not None:
+        # reads original files, before they are staged
+        stages.append(FulltextIndexer(args.fulltext, args.workers))
+    if args.pack is not None:
+        stages.append(Packer(args.stage_dir, args.pack, args.workers))
+    elif args.stage_dir is not None:
+        stages.append(Stager(args.stage_dir, args.jobs))
+    counter = Counter()
+    rdffilenames = [args.rdffilename]
+    if args.output_format == 'sqlite':
+        items = export_sqlite(root, args.scrapbookdir, manifest, args.rdffilename, state,
+                              deduplicator, args, stages)
+        debug("# of items written to database: %d", items)
+    elif args.chunk_size or args.max_bytes:
+        chunks = export_chunks(root, args.scrapbookdir, manifest, args.rdffilename,
+                               args.chunk_size, args.max_bytes, state, args.workers,
+                               deduplicator, args, stages, counter)
+        debug("# of chunks written: %d", chunks)
+        rdffilenames = [chunk_filename(args.rdffilename, number)
+                        for number in range(1, chunks + 1)]
+    else:
+        filehandle = open_output(args.rdffilename)
+        # write everything as it is generated
+        filehandle.writelines(export_rdf(root, args.scrapbookdir, manifest, state,
+                                         args.workers, deduplicator, args, stages, counter))
+        close_output(filehandle)
+    for stage in stages:
+        stage.finish()
+    deduplicator.report(sys.stderr)
+    if state is not None:
+        state.report(sys.stderr)
+        state.save()
+    if args.verify:
+        # after staging, attached files are there
+        with STATS.phase('verify'):
+            verifier = RdfVerifier(counter.uniq)
+            for rdffilename in rdffilenames:
+                verifier.verify(rdffilename)
+        verifier.report(sys.stderr)
+        if verifier.problems:
+            raise ExportError("%d problems in written RDF, see above" % verifier.problems)
+
+def run(args):
+    """ Export as told by args, with --stats, --stats-json and --profile
+
+    Raises:
+        ExportError if export can't be done
     """
 
-    parse_args(argv)
+    global DEBUG # pylint: disable=global-statement
+    DEBUG = args.debug
+
+    if args.parser == 'rdflib' and import_rdflib() is None:
+        raise ExportError("rdflib is not installed, can't use --parser=rdflib.")
+    if args.exclude is not None:
+        debug("excluding entries: %s", args.exclude)
+    if args.include is not None:
+        debug("including only entries: %s", args.include)
+
+    STATS.reset(args.stats or args.stats_json is not None)
+    with STATS.phase('total'):
+        if args.profile is not None:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.runcall(export_scrapbook, args)
+            profiler.dump_stats(args.profile)
+        else:
+            export_scrapbook(args)
+    if args.stats:
+        STATS.report(sys.stderr)
+    if args.stats_json is not None:
+        with open(args.stats_json, 'w') as filehandle:
+            json.dump(STATS.as_dict(), filehandle, indent=2)
+
+# Options naming a single file or directory, they can't be shared by scrapbooks
+# of a batch (staged files of equal item ids would overwrite each other), as
+# (Args attribute, option) pairs. --cache-dir can: its files are named after
+# paths of scrapbook.rdf files.
+BATCH_FORBIDDEN = (('state', '--state'), ('hash_cache', '--hash-cache'),
+                   ('stats_json', '--stats-json'), ('profile', '--profile'),
+                   ('fulltext', '--fulltext'), ('stage_dir', '--stage-dir'))
+
+def forbidden_option(args, forbidden):
+    """ First option of forbidden (attribute, option) pairs given in args
 
-    if Args.exclude is not None:
-        debug("excluding entries: " + ','.join(map(str, Args.exclude)))
+    Parsed args are checked rather than argv, so that abbreviations like
+    --stat for --stats-json are caught too.
 
-    # Generate .rdf file from Scrapbook data
-    root, items = open_scrapbook_rdf(Args.scrapbookdir)
-    debug("# of items loaded: %d" % len(items))
-    if Args.rdffilename == '-':
-        filehandle = sys.stdout
+    Returns:
+        option or None if args have none of them
+    """
+    for attribute, option in forbidden:
+        if getattr(args, attribute) != getattr(Args, attribute):
+            return option
+    return None
+
+def parse_batch_args(argv):
+    """ Parse argv of batch subcommand
+
+    Returns:
+        argparse namespace, export options are in its options attribute
+    """
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(sys.argv[0]) + ' batch',
+        description="Export many scrapbooks at once, each one by a separate process",
+        epilog="""Scrapbooks are given by MANIFEST file with one
+'SCRAPBOOKDIR<TAB>OUTPUT.RDF' line per scrapbook ('#' starts a comment)
+or by --glob. Export options go after '--' and are used for every scrapbook,
+e.g. '-- --nocoll --chunk-size 5000'.""")
+    parser.add_argument('manifest', nargs='?', metavar='MANIFEST',
+                        help="File listing scrapbook directories and output files")
+    parser.add_argument('--glob', metavar='PATTERN',
+                        help="Export every scrapbook directory matching PATTERN")
+    parser.add_argument('--output-dir', metavar='DIR', default='.',
+                        help="Directory for output files of --glob, named after "
+                        "scrapbook directories (default: current directory)")
+    parser.add_argument('--processes', type=int, metavar='N',
+                        help="Number of scrapbooks exported at once (default: number of CPUs)")
+    parser.add_argument('--summary', metavar='FILE',
+                        help="Save summary as JSON to FILE")
+    options = []
+    if '--' in argv:
+        options = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    parsed = parser.parse_args(argv)
+    if (parsed.manifest is None) == (parsed.glob is None):
+        parser.error("give either MANIFEST or --glob")
+    # check export options before starting
+    option = forbidden_option(parse_args(['SCRAPBOOKDIR', 'OUTPUT.RDF'] + options),
+                              BATCH_FORBIDDEN)
+    if option is not None:
+        parser.error("%s can't be used in batch" % option)
+    parsed.options = options
+    return parsed
+
+def read_batch_manifest(filename):
+    """ Read batch manifest file
+
+    Returns:
+        list of (scrapbook directory, output file) tuples
+    """
+    scrapbooks = []
+    try:
+        with io.open(filename, 'r', encoding='utf-8') as filehandle:
+            for number, line in enumerate(filehandle, 1):
+                line = line.rstrip('\r\n')
+                if line.strip() == '' or line.lstrip().startswith('#'):
+                    continue
+                fields = line.split('\t')
+                if len(fields) != 2:
+                    raise ExportError("%s:%d: expected SCRAPBOOKDIR<TAB>OUTPUT.RDF"
+                                      % (filename, number))
+                scrapbooks.append((fields[0], fields[1]))
+    except IOError as error:
+        raise ExportError("can't read batch manifest: %s" % error)
+    return scrapbooks
+
+def glob_scrapbooks(pattern, output_dir):
+    """ Find scrapbook directories by glob pattern
+
+    Output file is named after part of scrapbook directory matched by
+    wildcards: profiles/*/Scrapbook gives profiles/alice/Scrapbook ->
+    alice_Scrapbook.rdf
+
+    Returns:
+        list of (scrapbook directory, output file) tuples
+    """
+    import glob
+    # directories before the first wildcard are the same for all
+    prefix = []
+    for part in os.path.normpath(pattern).split(os.sep):
+        if glob.has_magic(part):
+            break
+        prefix.append(part)
+    prefix = os.sep.join(prefix) or os.curdir
+    scrapbooks = []
+    for path in sorted(glob.glob(pattern)):
+        if not os.path.isfile(os.path.join(path, 'scrapbook.rdf')):
+            continue
+        name = os.path.relpath(path, prefix).replace(os.sep, '_')
+        scrapbooks.append((path, os.path.join(output_dir, name + '.rdf')))
+    return scrapbooks
+
+def run_batch_item(job):
+    """ Export single scrapbook of batch, runs in a pool process
+
+    Args:
+        job: (scrapbook directory, output file, export options) tuple
+    Returns:
+        summary of the export as dict()
+    """
+    scrapbookdir, rdffilename, options = job
+    summary = {'scrapbook': scrapbookdir, 'output': rdffilename, 'error': None}
+    started = time.time()
+    try:
+        args = parse_args([scrapbookdir, rdffilename] + options)
+        # pool processes can't start processes of their own
+        args.workers = 1
+        run(args)
+    except ExportError as error:
+        summary['error'] = str(error)
+    except Exception as error: # pylint: disable=broad-except
+        # one broken scrapbook must not stop the others
+        summary['error'] = "%s: %s" % (type(error).__name__, error)
+    summary['seconds'] = time.time() - started
+    summary['items'] = STATS.counters.get('items exported', 0)
+    summary['pdfs'] = STATS.counters.get('pdfs attached', 0)
+    return summary
+
+def batch(argv):
+    """ Batch subcommand: export many scrapbooks by a pool of processes
+
+    Returns:
+        exit code, 1 if any scrapbook failed
+    """
+
+    parsed = parse_batch_args(argv)
+    try:
+        if parsed.manifest is not None:
+            scrapbooks = read_batch_manifest(parsed.manifest)
+        else:
+            scrapbooks = glob_scrapbooks(parsed.glob, parsed.output_dir)
+    except ExportError as error:
+        sys.stderr.write("ERROR: %s\n" % error)
+        return 1
+    jobs = [(scrapbookdir, rdffilename, parsed.options)
+            for scrapbookdir, rdffilename in scrapbooks]
+
+    started = time.time()
+    processes = parsed.processes
+    if processes is None:
+        import multiprocessing
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(jobs)))
+    if processes == 1:
+        summaries = [run_batch_item(job) for job in jobs]
     else:
+        import multiprocessing
+        # a process per scrapbook at a time, new processes after some exports
+        # to give memory back
+        pool = multiprocessing.Pool(processes, maxtasksperchild=16)
+        try:
+            summaries = pool.map(run_batch_item, jobs, chunksize=1)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    failed = [summary for summary in summaries if summary['error'] is not None]
+    totals = {'scrapbooks': len(summaries), 'failed': len(failed),
+              'items': sum(summary['items'] for summary in summaries),
+              'seconds': time.time() - started}
+    sys.stdout.write("%-6s %8s %8s  %s\n" % ('status', 'items', 'seconds', 'scrapbook -> output'))
+    for summary in summaries:
+        sys.stdout.write("%-6s %8d %8.2f  %s -> %s\n" % (
+            'ERROR' if summary['error'] is not None else 'ok', summary['items'],
+            summary['seconds'], summary['scrapbook'], summary['output']))
+        if summary['error'] is not None:
+            sys.stdout.write("       %s\n" % summary['error'])
+    sys.stdout.write("%d scrapbooks, %d failed, %d items in %.2f s\n"
+                     % (totals['scrapbooks'], totals['failed'], totals['items'],
+                        totals['seconds']))
+    if parsed.summary is not None:
+        with open(parsed.summary, 'w') as filehandle:
+            json.dump({'scrapbooks': summaries, 'totals': totals}, filehandle, indent=2)
+    return 1 if failed else 0
+
+def search(argv):
+    """ search subcommand: find pages in full-text index made by --fulltext
+
+    Returns:
+        exit code, 1 if nothing is found
+    """
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(sys.argv[0]) + ' search',
+        description="Search pages in full-text index made by --fulltext",
+        epilog="QUERY is SQLite full-text query: words, \"phrases\", prefix*, "
+        "OR, NOT, title:word.")
+    parser.add_argument('index', metavar='FILE', help="Full-text index file")
+    parser.add_argument('query', nargs='+', metavar='QUERY', help="Words to find")
+    parser.add_argument('--limit', type=int, default=20, metavar='N',
+                        help="Show at most N pages (default: 20)")
+    parsed = parser.parse_args(argv)
+    query = u' '.join(decode_arg(word) for word in parsed.query)
+    try:
+        index = FulltextIndex(parsed.index)
+        try:
+            pages = index.search(query, parsed.limit)
+        finally:
+            index.close()
+    except ExportError as error:
+        sys.stderr.write("ERROR: %s\n" % error)
+        return 2
+    for nodeid, title, source, snippet in pages:
+        sys.stdout.write((u"%s\t%s\t%s\n    %s\n" % (nodeid, title, source, snippet))
+                         .encode('utf-8'))
+    return 0 if pages else 1
+
+def count_records(args):
+    """ Number of records in export of everything (or of --folder options),
+    as numbered for --exclude
+    """
+    manifest = DataManifest(args.scrapbookdir, args.jobs)
+    root, _ = open_scrapbook_rdf(args.scrapbookdir, args.parser, manifest,
+                                 cache=ItemCache(args.cache_dir) if args.cache_dir else None,
+                                 folders=args.folder)
+    # items are numbered, but nothing is planned for export
+    counting = copy.copy(args)
+    counting.include = Selector([])
+    counter = Counter()
+    for _ in plan_items(root, args.scrapbookdir, None, counter, Deduper(), manifest, None,
+                        counting):
+        pass
+    return counter.cnt - 1
+
+def bisect_filename(rdffilename, step):
+    """ Make file name of bisect step: OUTPUT.RDF -> OUTPUT.bisect01.RDF """
+    base, ext = os.path.splitext(rdffilename)
+    return "%s.bisect%02d%s" % (base, step, ext or '.rdf')
+
+# Export options which would change what bisect exports, see forbidden_option()
+BISECT_FORBIDDEN = (('include', '--include'), ('state', '--state'),
+                    ('chunk_size', '--chunk-size'), ('max_bytes', '--max-bytes'),
+                    ('output_format', '--format'))
+
+def bisect_records(argv):
+    """ bisect subcommand: find record hanging Zotero import by halving exports
+
+    Returns:
+        exit code
+    """
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(sys.argv[0]) + ' bisect',
+        description="Find the record hanging Zotero import in log2(N) imports",
+        epilog="""First run writes OUTPUT.bisect01.RDF with the first half of
+records. Import it into a scratch Zotero profile and run the same command
+with --good if import finished or --bad if it hung. Every run writes the
+next file with half of the suspected records, until one is left. Export
+options go after '--' on the first run, e.g. '-- --nocoll --exclude 17'.""")
+    parser.add_argument('scrapbookdir', metavar='SCRAPBOOKDIR', help="Source directory")
+    parser.add_argument('rdffilename', metavar='OUTPUT.RDF',
+                        help="Output file name, bisect state is kept in OUTPUT.RDF.bisect")
+    verdict = parser.add_mutually_exclusive_group()
+    verdict.add_argument('--good', action='store_true',
+                         help="Import of the last file finished")
+    verdict.add_argument('--bad', action='store_true',
+                         help="Import of the last file hung")
+    verdict.add_argument('--reset', action='store_true',
+                         help="Forget previous runs and start again")
+    options = []
+    if '--' in argv:
+        options = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    parsed = parser.parse_args(argv)
+    option = forbidden_option(parse_args([parsed.scrapbookdir, parsed.rdffilename] + options),
+                              BISECT_FORBIDDEN)
+    if option is not None:
+        parser.error("%s can't be used in bisect" % option)
+
+    statefname = parsed.rdffilename + '.bisect'
+    state = None
+    if not parsed.reset:
         try:
-            filehandle = io.open(Args.rdffilename, 'w', encoding='utf-8')
+            with io.open(statefname, 'r', encoding='utf-8') as filehandle:
+                state = json.load(filehandle)
         except IOError:
-            sys.stderr.write("ERROR: can't open file '%s' to write.\n" % Args.rdffilename)
-            exit(-1)
-    #counter = Counter()
-    #allitems = export_node(root, Args.scrapbookdir, None, counter)
-    # write everything
-    filehandle.write(u"""<rdf:RDF
-xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
-xmlns:z="http://www.zotero.org/namespaces/export#"
-xmlns:dcterms="http://purl.org/dc/terms/"
-xmlns:link="http://purl.org/rss/1.0/modules/link/"
-xmlns:dc="http://purl.org/dc/elements/1.1/"
-xmlns:bib="http://purl.org/net/biblio#">""")
-    filehandle.write(export_node(root, Args.scrapbookdir,
-                                 None, Counter(), Deduper()))
-    if not Args.disable_collections:
-        filehandle.write(export_collections(root))
-    filehandle.write(u"\n</rdf:RDF>")
-    filehandle.close()
+            # first run
+            pass
+        except ValueError:
+            parser.error("can't read %s, use --reset" % statefname)
+    try:
+        if state is None:
+            if parsed.good or parsed.bad:
+                parser.error("no bisect in progress, run without --good and --bad first")
+            args = parse_args([parsed.scrapbookdir, parsed.rdffilename] + options)
+            total = count_records(args)
+            if total == 0:
+                raise ExportError("nothing to export")
+            state = {'scrapbookdir': parsed.scrapbookdir, 'options': options,
+                     'total': total, 'low': 1, 'high': total, 'step': 0}
+        elif state['low'] >= state['high']:
+            # found already
+            pass
+        elif parsed.good or parsed.bad:
+            middle = (state['low'] + state['high']) // 2
+            if parsed.bad:
+                state['high'] = middle
+            else:
+                state['low'] = middle + 1
+        elif state['step'] > 0:
+            # write the last file again
+            state['step'] -= 1
+
+        if state['low'] >= state['high']:
+            sys.stdout.write("Record #%d of %d hangs Zotero import. Export everything with "
+                             "'--exclude %d', or only it with '--include %d'.\n"
+                             % (state['low'], state['total'], state['low'], state['low']))
+            write_json(statefname, state)
+            return 0
+        state['step'] += 1
+        middle = (state['low'] + state['high']) // 2
+        stepfname = bisect_filename(parsed.rdffilename, state['step'])
+        args = parse_args([state['scrapbookdir'], stepfname] + state['options'] +
+                          ['--include', '%d-%d' % (state['low'], middle)])
+        run(args)
+        write_json(statefname, state)
+    except ExportError as error:
+        sys.stderr.write("ERROR: %s\n" % error)
+        return 2
+    steps = 0
+    while (1 << steps) < state['high'] - state['low'] + 1:
+        steps += 1
+    sys.stdout.write("Step %d: records %d-%d of suspected %d-%d (items: %d) written to %s.\n"
+                     "Import it, then run this command with --good if import finished "
+                     "or --bad if it hung. Imports left, this one included: %d.\n"
+                     % (state['step'], state['low'], middle, state['low'], state['high'],
+                        STATS.counters.get('items exported', 0), stepfname, steps))
+    return 0
+
+def verify(argv):
+    """ verify subcommand: check RDF files written by export
+
+    Returns:
+        exit code, 1 if there are problems
+    """
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(sys.argv[0]) + ' verify',
+        description="Check RDF files written by export before import: XML is "
+        "well-formed, attachments, items and subcollections linked by records are "
+        "in the same file, attached files exist",
+        epilog="Records are numbered as Zotero imports them, across all files, so "
+        "give chunks in order. With --exclude, --include or --state these numbers are "
+        "not the numbers of --exclude, use --verify option of export to get them.")
+    parser.add_argument('rdffilenames', nargs='+', metavar='OUTPUT.RDF',
+                        help="RDF files to check")
+    parsed = parser.parse_args(argv)
+    verifier = RdfVerifier(filehandle=sys.stdout)
+    try:
+        for rdffilename in parsed.rdffilenames:
+            verifier.verify(rdffilename)
+    except IOError as error:
+        sys.stderr.write("ERROR: %s\n" % error)
+        return 2
+    verifier.report(sys.stdout)
+    return 1 if verifier.problems else 0
+
+# Size of item directory with its subdirectories. PDFs are counted as export
+# attaches them: *.pdf files at top of directory. largest_pdf is (size, name)
+# or None, index is name of index file or None, seconds is time of reading,
+# entries is DirEntries of the top, for DataManifest.add().
+DirUsage = collections.namedtuple('DirUsage', ['files', 'bytes', 'pdfs', 'pdf_bytes',
+                                               'largest_pdf', 'index', 'seconds',
+                                               'entries'])
+
+def list_dir_sizes(a_dir):
+    """ Read directory a_dir with sizes of its files, by scandir() if there is one
+
+    Returns:
+        list of (name, size) of files and list of paths of subdirectories
+    """
+    scandir = import_scandir()
+    files = []
+    subdirs = []
+    if scandir is None:
+        for name in os.listdir(a_dir):
+            path = os.path.join(a_dir, name)
+            if os.path.isfile(path):
+                files.append((name, os.path.getsize(path)))
+            elif os.path.isdir(path):
+                subdirs.append(path)
+        return files, subdirs
+    for entry in scandir(a_dir):
+        if entry.is_file():
+            files.append((entry.name, entry.stat().st_size))
+        elif entry.is_dir():
+            subdirs.append(entry.path)
+    return files, subdirs
+
+def dir_usage(a_dir):
+    """ Walk item directory and its subdirectories, one stat() per file
+
+    Returns:
+        DirUsage of a_dir or None if a_dir can't be read
+    """
+    started = time.time()
+    try:
+        top, dirnames = list_dir_sizes(a_dir)
+    except OSError:
+        return None
+    subdirs = [os.path.basename(path) for path in dirnames]
+    entries = DirEntries([name for name, _ in top] + subdirs, set(name for name, _ in top),
+                         subdirs)
+    files = len(top)
+    size = sum(file_size for _, file_size in top)
+    while dirnames:
+        try:
+            below, paths = list_dir_sizes(dirnames.pop())
+        except OSError:
+            continue
+        files += len(below)
+        size += sum(file_size for _, file_size in below)
+        dirnames.extend(paths)
+    # same as fnmatch(name, '*.pdf') of export, but faster
+    pdfs = [(file_size, name) for name, file_size in top
+            if os.path.normcase(name[-4:]) == '.pdf']
+    return DirUsage(files, size, len(pdfs), sum(file_size for file_size, _ in pdfs),
+                    max(pdfs) if pdfs else None, index_name(entries.files),
+                    time.time() - started, entries)
+
+def add_usage(sizes, usage):
+    """ Add DirUsage to sizes dict() of analyze """
+    sizes['files'] += usage.files
+    sizes['bytes'] += usage.bytes
+    sizes['pdfs'] += usage.pdfs
+    sizes['pdf_bytes'] += usage.pdf_bytes
+
+def analyze_tree(root, nodes, lost, usages, top=20):
+    """ Sizes of collections and other facts of scrapbook for analyze
+
+    Args:
+        root: root of tree from open_scrapbook_rdf()
+        nodes: nodes of scrapbook.rdf items
+        lost: nodes of lost items and folders
+        usages: DirUsage by id of every data directory
+        top: length of lists of largest PDFs and slowest directories
+    Returns:
+        dict() ready for JSON
+    """
+
+    folders = list(iter_folders(root))
+    paths = {id(root): u''}
+    for folder in folders:
+        for node in folder.children:
+            if node.type == 'folder':
+                paths[id(node)] = paths[id(folder)] + u'/' + node.name
+    keys = ('items', 'files', 'bytes', 'pdfs', 'pdf_bytes')
+    totals = {}
+    collections_ = []
+    missing = []
+    noindex = []
+    # children before parents
+    for folder in reversed(folders):
+        own = dict.fromkeys(keys, 0)
+        total = dict.fromkeys(keys, 0)
+        for node in folder.children:
+            usage = usages.get(node.nodeid)
+            if node.type == 'folder':
+                for key in keys:
+                    total[key] += totals[id(node)][key]
+            elif node.type != 'separator':
+                own['items'] += 1
+                if usage is None:
+                    missing.append(node.nodeid)
+                elif usage.index is None:
+                    noindex.append(node.nodeid)
+            if usage is not None:
+                add_usage(own, usage)
+        for key in keys:
+            total[key] += own[key]
+        totals[id(folder)] = total
+        collections_.append({'id': folder.nodeid, 'path': paths[id(folder)],
+                             'own': own, 'total': total})
+    collections_.reverse()
+
+    import heapq
+    titles = dict((node.nodeid, node.name) for node in lost)
+    titles.update((nodeid, node.name) for nodeid, node in nodes.items())
+    pdfs = heapq.nlargest(top, ((usage.largest_pdf[0], nodeid, usage.largest_pdf[1])
+                                for nodeid, usage in usages.items()
+                                if usage is not None and usage.largest_pdf is not None))
+    slowest = heapq.nlargest(top, ((usage.seconds, nodeid)
+                                   for nodeid, usage in usages.items() if usage is not None))
+    lost_folders = []
+    for node in lost:
+        if node.nodeid not in nodes:
+            sizes = dict.fromkeys(keys[1:], 0)
+            if usages.get(node.nodeid) is not None:
+                add_usage(sizes, usages[node.nodeid])
+            sizes['id'] = node.nodeid
+            lost_folders.append(sizes)
+    return {'totals': totals[id(root)],
+            'folders': len(folders) - 1,
+            'directories': len(usages),
+            'collections': collections_,
+            'lost_items': [node.nodeid for node in lost if node.nodeid in nodes],
+            'lost_folders': lost_folders,
+            'missing_directories': sorted(missing),
+            'missing_index': sorted(noindex),
+            'largest_pdfs': [{'id': nodeid, 'file': name, 'bytes': size,
+                              'title': titles.get(nodeid, u'')}
+                             for size, nodeid, name in pdfs],
+            'slowest_directories': [{'id': nodeid, 'seconds': seconds,
+                                     'files': usages[nodeid].files}
+                                    for seconds, nodeid in slowest]}
+
+def format_size(size):
+    """ Human readable size: 12.3 MB """
+    if size < 1024:
+        return "%d B" % size
+    for unit in ('KB', 'MB'):
+        size /= 1024.0
+        if size < 1024:
+            return "%.1f %s" % (size, unit)
+    return "%.1f GB" % (size / 1024.0)
+
+def report_analysis(analysis, filehandle, top=20):
+    """ Write analyze results as text """
+    def write(text, *args):
+        """ Write line of report """
+        filehandle.write((text % args + u'\n').encode('utf-8'))
+    totals = analysis['totals']
+    lost_folders = analysis['lost_folders']
+    write(u"%d items in %d folders, %d files, %s, %d PDFs (%s)",
+          totals['items'], analysis['folders'], totals['files'], format_size(totals['bytes']),
+          totals['pdfs'], format_size(totals['pdf_bytes']))
+    write(u"Lost items: %d, lost folders (data directories without item): %d, %d files, %s",
+          len(analysis['lost_items']), len(lost_folders),
+          sum(folder['files'] for folder in lost_folders),
+          format_size(sum(folder['bytes'] for folder in lost_folders)))
+    write(u"Items without data directory: %d, without index file: %d",
+          len(analysis['missing_directories']), len(analysis['missing_index']))
+    seconds = analysis['seconds']
+    write(u"scrapbook.rdf read in %.2f s, %d directories scanned in %.2f s by %d threads",
+          seconds['open'], analysis['directories'], seconds['scan'], analysis['jobs'])
+
+    write(u"\nLargest folders, with subfolders:")
+    write(u"%8s %8s %10s %6s  %s", 'items', 'files', 'size', 'PDFs', 'folder')
+    largest = sorted(analysis['collections'][1:], key=lambda collection:
+                     collection['total']['bytes'], reverse=True)[:top]
+    for collection in largest:
+        total = collection['total']
+        write(u"%8d %8d %10s %6d  %s", total['items'], total['files'],
+              format_size(total['bytes']), total['pdfs'], collection['path'].lstrip(u'/'))
+    write(u"\nLargest PDFs:")
+    for pdf in analysis['largest_pdfs'][:top]:
+        write(u"%10s  %s  %s  (%s)", format_size(pdf['bytes']), pdf['id'], pdf['file'],
+              pdf['title'])
+    write(u"\nSlowest directories:")
+    write(u"%8s %8s  %s", 'seconds', 'files', 'item')
+    for directory in analysis['slowest_directories'][:top]:
+        write(u"%8.3f %8d  %s", directory['seconds'], directory['files'], directory['id'])
+
+def analyze(argv):
+    """ analyze subcommand: sizes of scrapbook folders and other facts for planning export
+
+    Returns:
+        exit code
+    """
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(sys.argv[0]) + ' analyze',
+        description="Report items, files, sizes and PDFs of every folder, largest "
+        "PDFs, lost items and folders, items which can't be exported and slowest "
+        "data directories, to plan export (--chunk-size, --folder, --exclude). "
+        "Data directories are read once by a pool of threads, nothing is exported.")
+    parser.add_argument('scrapbookdir', metavar='SCRAPBOOKDIR', help="Scrapbook directory")
+    parser.add_argument('--json', metavar='FILE',
+                        help="Save report with every folder to FILE as JSON")
+    parser.add_argument('--top', type=int, default=20, metavar='N',
+                        help="Show N largest folders, PDFs and slowest directories "
+                        "(default: 20)")
+    parser.add_argument('--jobs', type=int, default=8, metavar='N',
+                        help="Number of threads reading data directories (default: 8)")
+    parser.add_argument('--cache-dir', metavar='DIR',
+                        help="Keep parsed scrapbook.rdf in DIR, same as for export")
+    parser.add_argument('--parser', choices=PARSERS, default=PARSERS[0],
+                        help="RDF parser engine, same as for export")
+    parsed = parser.parse_args(argv)
+    jobs = max(1, parsed.jobs)
+
+    started = time.time()
+    manifest = DataManifest(parsed.scrapbookdir, jobs)
+    # directories are walked first, so lost items are found in listings of the walk
+    usages = dict(zip(manifest.subdirs, parallel_map(
+        dir_usage, [manifest.dirname(subdir) for subdir in manifest.subdirs], jobs)))
+    for subdir, usage in usages.items():
+        manifest.add(subdir, usage.entries if usage is not None else None)
+    scanned = time.time()
+    lost = []
+    try:
+        root, nodes = open_scrapbook_rdf(parsed.scrapbookdir, parsed.parser, manifest,
+                                         cache=ItemCache(parsed.cache_dir)
+                                         if parsed.cache_dir else None, lost=lost)
+    except ExportError as error:
+        sys.stderr.write("ERROR: %s\n" % error)
+        return 2
+    opened = time.time()
+    analysis = analyze_tree(root, nodes, lost, usages, max(0, parsed.top))
+    analysis['scrapbook'] = manifest.path
+    analysis['jobs'] = jobs
+    analysis['seconds'] = {'scan': scanned - started, 'open': opened - scanned}
+    report_analysis(analysis, sys.stdout, max(0, parsed.top))
+    if parsed.json is not None:
+        write_json(parsed.json, analysis)
+    return 0
+
+def main(argv):
+    """ Main as function, useful to run test from py.test with command line args
+
+    Returns:
+        exit code
+    """
+
+    if argv[:1] == ['batch']:
+        return batch(argv[1:])
+    if argv[:1] == ['search']:
+        return search(argv[1:])
+    if argv[:1] == ['bisect']:
+        return bisect_records(argv[1:])
+    if argv[:1] == ['verify']:
+        return verify(argv[1:])
+    if argv[:1] == ['analyze']:
+        return analyze(argv[1:])
+    args = parse_args(argv)
+    try:
+        run(args)
+    except ExportError as error:
+        sys.stderr.write("ERROR: %s\n" % error)
+        exit(-1)
+    return 0
 
 if __name__ == '__main__':
-    main(sys.argv[1:])
+    if getattr(sys, 'frozen', False):
+        # --workers and batch in frozen Windows executable
+        import multiprocessing
+        multiprocessing.freeze_support()
+    sys.exit(main(sys.argv[1:]))
@@ -28,6 +28,8 @@ SOFTWARE.
 import filecmp
 import os
 import subprocess
+import time
+import pytest
 import scrapbook2zotero
 
 def run_main_and_compare(args, samplefname, tmpfname):
@@ -59,6 +61,33 @@ def test_1_reading_scrapbook_rdf():
     assert len(items) == 11
     assert isinstance(root, scrapbook2zotero.Node)
 
+@pytest.mark.parametrize("rdffile", ["scrapbook_test_data/scrapbook.rdf",
+                                     "scrapbook_test_data/backup/scrapbook_20180222.rdf",
+                                     "scrapbook_test_data/backup/scrapbook_20180308.rdf"])
+def test_1_stream_parser(rdffile):
+    """ Stream parser should read the same data as rdflib """
+
+    pytest.importorskip("rdflib")
+    expected = scrapbook2zotero.rdf_file_to_dict(rdffile, 'rdflib')
+    expected = dict((itemname, dict((propname, unicode(value))
+                                    for propname, value in item.items()))
+                    for itemname, item in expected.items())
+    assert scrapbook2zotero.rdf_file_to_dict(rdffile, 'stream') == expected
+
+def test_1_compact_items():
+    """ Compact item table holds the same data as rdf dict, nodes have no __dict__ """
+
+    rdffile = "scrapbook_test_data/scrapbook.rdf"
+    items = scrapbook2zotero.rdf_file_to_items(rdffile)
+    assert items == scrapbook2zotero.items_from_dict(scrapbook2zotero.rdf_file_to_dict(rdffile))
+    assert items["20180222113242"].children == ("20180222113317", "20180222115430")
+    assert items["20180222115430"].modify == "20180308220308"
+    # same type strings are shared
+    assert items["20180222115430"].type is items["20180222115534"].type
+    root, nodes = scrapbook2zotero.open_scrapbook_rdf("scrapbook_test_data")
+    assert nodes[scrapbook2zotero.ROOT_ID] is root
+    assert not hasattr(root, '__dict__')
+
 def test_2_standard_run():
     """ Testing default output """
     run_main_and_compare(["scrapbook_test_data", "tmp/test.rdf"],
@@ -102,3 +131,924 @@ def test_7_nodedup():
     """ Testing disabling of deduplication (--nodedup flag) """
     run_main_and_compare(["scrapbook_test_data", "tmp/test-nodedup.rdf", "--nodedup"],
                          "samples/standard-no-dedup.rdf", "tmp/test-nodedup.rdf")
+
+def test_8_stdout(capfdbinary):
+    """ Testing output to stdout ('-' as output file name) """
+    scrapbook2zotero.main(["scrapbook_test_data", "-"])
+    out, _ = capfdbinary.readouterr()
+    with open("samples/standard.rdf", "rb") as sample:
+        assert out == sample.read()
+
+def test_9_jobs():
+    """ Testing parallel scan of data directories (--jobs option) """
+    manifest = scrapbook2zotero.DataManifest("scrapbook_test_data", 4)
+    manifest.scan()
+    assert len(manifest.entries) == 7
+    assert "11_beauchamp.pdf" in manifest.get("20170808125614").files
+    assert manifest.get("19700101000000") is None
+    run_main_and_compare(["scrapbook_test_data", "tmp/test-jobs.rdf", "--jobs", "4"],
+                         "samples/standard.rdf", "tmp/test-jobs.rdf")
+
+def test_10_chunks():
+    """ Testing split of output into chunks (--chunk-size option) """
+    import glob
+    import xml.etree.cElementTree as ElementTree
+    for fname in glob.glob("tmp/test-chunks.*.rdf"):
+        os.remove(fname)
+    scrapbook2zotero.main(["scrapbook_test_data", "tmp/test-chunks.rdf", "--chunk-size", "2"])
+    bib = "{http://purl.org/net/biblio#}Document"
+    collection = "{http://www.zotero.org/namespaces/export#}Collection"
+    haspart = "{http://purl.org/dc/terms/}hasPart"
+    about = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about"
+    resource = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}resource"
+    documents = []
+    for number, size in enumerate([2, 2, 2, 1], 1):
+        chunk = ElementTree.parse("tmp/test-chunks.%03d.rdf" % number).getroot()
+        chunk_documents = [elem.get(about) for elem in chunk.findall(bib)]
+        assert len(chunk_documents) == size
+        # every collection link points to an item or collection in this chunk
+        targets = set(chunk_documents)
+        targets.update("#" + elem.get(about) for elem in chunk.findall(collection))
+        for elem in chunk.findall(collection):
+            for link in elem.findall(haspart):
+                assert link.get(resource) in targets or \
+                    "#" + link.get(resource) in targets
+        documents += chunk_documents
+    assert not os.path.exists("tmp/test-chunks.005.rdf")
+    standard = ElementTree.parse("samples/standard.rdf").getroot()
+    assert documents == [elem.get(about) for elem in standard.findall(bib)]
+
+    # collections count in --max-bytes
+    for fname in glob.glob("tmp/test-chunks-bytes.*.rdf"):
+        os.remove(fname)
+    scrapbook2zotero.main(["scrapbook_test_data", "tmp/test-chunks-bytes.rdf", "--max-bytes",
+                           "6000"])
+    chunks = sorted(glob.glob("tmp/test-chunks-bytes.*.rdf"))
+    assert len(chunks) > 1
+    for fname in chunks:
+        # a single item is never split
+        if len(ElementTree.parse(fname).getroot().findall(bib)) > 1:
+            assert os.path.getsize(fname) <= 6000
+
+def test_11_state():
+    """ Testing incremental export (--state option) """
+    import json
+    for fname in ["tmp/test-state.json", "tmp/test-state-2.rdf", "tmp/test-state-3.rdf"]:
+        if os.path.exists(fname):
+            os.remove(fname)
+    # first run exports everything
+    run_main_and_compare(["scrapbook_test_data", "tmp/test-state.rdf",
+                          "--state", "tmp/test-state.json"],
+                         "samples/standard.rdf", "tmp/test-state.rdf")
+    # second run exports nothing
+    scrapbook2zotero.main(["scrapbook_test_data", "tmp/test-state-2.rdf",
+                           "--state", "tmp/test-state.json"])
+    with open("tmp/test-state-2.rdf") as filehandle:
+        assert filehandle.read() == (scrapbook2zotero.RDF_HEADER + scrapbook2zotero.RDF_FOOTER)
+    # pretend that one item was modified after the first run
+    with open("tmp/test-state.json") as filehandle:
+        state = json.load(filehandle)
+    state["items"]["20180222115534"][0] = "20180222115534"
+    with open("tmp/test-state.json", "w") as filehandle:
+        json.dump(state, filehandle)
+    scrapbook2zotero.main(["scrapbook_test_data", "tmp/test-state-3.rdf",
+                           "--state", "tmp/test-state.json"])
+    with open("tmp/test-state-3.rdf") as filehandle:
+        output = filehandle.read()
+    assert output.count("<bib:Document ") == 1
+    assert "#item_20180222115534" in output
+    # item keeps its collection and parent collection
+    assert output.count("<z:Collection ") == 2
+
+def test_12_synthetic_scrapbook():
+    """ Benchmark generator makes scrapbook with requested contents """
+    import bench_s2z
+    bench_s2z.make_scrapbook("tmp/test-synthetic", items=40, depth=2, pdf_ratio=0.5,
+                             dup_ratio=0.5, lost_folders=3, lost_items=2)
+    root, items = scrapbook2zotero.open_scrapbook_rdf("tmp/test-synthetic")
+    # 40 pages, 5 folders and root
+    assert len(items) == 46
+    # lost items and folders are attached to the root
+    assert set(["20100101000038", "20100101000039", "20100101000045", "20100101000046",
+                "20100101000047"]) <= set(node.nodeid for node in root.children)
+    phases, exported = bench_s2z.run_phases("tmp/test-synthetic", "tmp/test-synthetic.rdf")
+    assert [phase[0] for phase in phases] == ['parse', 'tree', 'scan', 'fixup', 'export',
+                                              'write', 'verify', 'workers',
+                                              'sqlite']
+    assert exported == 43
+
+def test_13_stats():
+    """ Testing --stats-json and --profile options """
+    import json
+    import pstats
+    run_main_and_compare(["scrapbook_test_data", "tmp/test-stats.rdf",
+                          "--stats-json", "tmp/test-stats.json",
+                          "--profile", "tmp/test-stats.prof"],
+                         "samples/standard.rdf", "tmp/test-stats.rdf")
+    with open("tmp/test-stats.json") as filehandle:
+        stats = json.load(filehandle)
+    assert stats["counters"]["items exported"] == 7
+    assert stats["counters"]["pdfs attached"] == 1
+    assert stats["counters"]["bytes written"] == os.path.getsize("samples/standard.rdf")
+    assert set(["open_scrapbook_rdf", "fix_lost_items", "fix_lost_folders", "export_node",
+                "export_collections"]) <= set(stats["phases"])
+    assert pstats.Stats("tmp/test-stats.prof").total_calls > 0
+    # stats are not collected without options
+    scrapbook2zotero.main(["scrapbook_test_data", "tmp/test-stats.rdf"])
+    assert not scrapbook2zotero.STATS.enabled
+
+def test_14_deep_and_cyclic_tree(capsys):
+    """ Very deep folder tree does not hit recursion limit, cycles are reported """
+    depth = 5000
+    rdfdict = {'urn:scrapbook:root': {'NS1:type': 'folder', 'RDF:_1': 'f0'}}
+    for idx in range(depth):
+        rdfdict['f%d' % idx] = {'NS1:type': 'folder', 'NS1:title': 'Folder %d' % idx,
+                                'RDF:_1': 'f%d' % (idx + 1)}
+    # the deepest folder refers back to its grandparent
+    rdfdict['f%d' % depth] = {'NS1:type': 'folder', 'NS1:title': 'Last',
+                              'RDF:_1': 'f%d' % (depth - 2), 'RDF:_2': 'page', 'RDF:_4': 'gap'}
+    rdfdict['page'] = {'NS1:type': '', 'NS1:title': 'Page', 'NS1:source': 'http://example.com/'}
+    rdfdict['gap'] = {'NS1:type': '', 'NS1:title': 'Not linked, RDF:_3 is missing'}
+    items = scrapbook2zotero.items_from_dict(rdfdict)
+    nodes = {}
+    root = scrapbook2zotero.load_node(scrapbook2zotero.ROOT_ID, items, nodes)
+    assert "ERROR: folder cycle f%d -> f%d -> f%d -> f%d." % (
+        depth - 2, depth - 1, depth, depth - 2) in capsys.readouterr().err
+    node = root
+    for _ in range(depth + 1):
+        assert len(node.children) == 1
+        node = node.children[0]
+    assert [child.nodeid for child in node.children] == ['page']
+    assert 'gap' not in nodes
+    collections = list(scrapbook2zotero.export_collections(root))
+    assert len(collections) == depth + 1
+    assert collections[-1].count('http://example.com/') == 1
+    collections = list(scrapbook2zotero.export_collections(root, set(['http://example.com/'])))
+    assert len(collections) == depth + 1
+
+def test_15_workers(monkeypatch):
+    """ Testing rendering of items in worker processes (--workers option) """
+    S2Z = scrapbook2zotero
+    run_main_and_compare(["scrapbook_test_data", "tmp/test-workers.rdf", "--workers", "2"],
+                         "samples/standard.rdf", "tmp/test-workers.rdf")
+    run_main_and_compare(["scrapbook_test_data", "tmp/test-workers-nodedup.rdf",
+                          "--workers", "3", "--nodedup"],
+                         "samples/standard-no-dedup.rdf", "tmp/test-workers-nodedup.rdf")
+    # items are planned a batch ahead of rendering, not all at once
+    monkeypatch.setattr(S2Z, "RENDER_CHUNK_SIZE", 1)
+    planned = []
+    class Recorder(object): # pylint: disable=too-few-public-methods
+        """ Pipeline stage remembering planned items """
+        @staticmethod
+        def add(node, job):
+            """ Remember node """
+            planned.append(node.nodeid)
+            return job
+    manifest = S2Z.DataManifest("scrapbook_test_data")
+    root, _ = S2Z.open_scrapbook_rdf("scrapbook_test_data", manifest=manifest)
+    items = S2Z.export_items(root, "scrapbook_test_data", None, S2Z.Counter(), S2Z.Deduper(),
+                             manifest, workers=2, stages=[Recorder()])
+    next(items)
+    # two batches of two items
+    assert len(planned) == 4
+    assert len(list(items)) == 6
+    assert len(planned) == 7
+
+def test_16_content_dedup(capsys):
+    """ Testing merge of identical captures (--dedup=content option) """
+    import json
+    import shutil
+    import bench_s2z
+    import xml.etree.cElementTree as ElementTree
+    bench_s2z.make_scrapbook("tmp/test-content", items=20, depth=1, pdf_ratio=0.5,
+                             dup_ratio=0, seed=2)
+    # page 5 is saved again as page 12
+    datadir = "tmp/test-content/data/"
+    for name in os.listdir(datadir + "20100101000012"):
+        os.remove(datadir + "20100101000012/" + name)
+    for name in os.listdir(datadir + "20100101000005"):
+        shutil.copy(datadir + "20100101000005/" + name, datadir + "20100101000012/")
+    for fname in ["tmp/test-content.json", "tmp/test-content-stats.json"]:
+        if os.path.exists(fname):
+            os.remove(fname)
+    capsys.readouterr()
+    args = ["tmp/test-content", "tmp/test-content.rdf", "--dedup", "content",
+            "--hash-cache", "tmp/test-content.json", "--stats-json",
+            "tmp/test-content-stats.json", "--jobs", "2"]
+    scrapbook2zotero.main(args)
+    err = capsys.readouterr().err
+    assert "Merged 1 identical captures:" in err
+    assert "20100101000012 'Page 12 & friends' -> 20100101000005 'Page 5 & friends'" in err
+    rdf = ElementTree.parse("tmp/test-content.rdf").getroot()
+    documents = [elem.get("{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about")
+                 for elem in rdf.findall("{http://purl.org/net/biblio#}Document")]
+    assert len(documents) == 19
+    assert "http://example.com/12/page.html?a=1&b=2" not in documents
+    # collections link to the kept page instead
+    links = [elem.get("{http://www.w3.org/1999/02/22-rdf-syntax-ns#}resource")
+             for elem in rdf.iter("{http://purl.org/dc/terms/}hasPart")]
+    assert links.count("http://example.com/5/page.html?a=1&b=2") == 2
+    with open("tmp/test-content-stats.json") as filehandle:
+        counters = json.load(filehandle)["counters"]
+    assert counters["items merged"] == 1
+    assert counters["files hashed"] > 0
+    # second run takes hashes from the cache
+    scrapbook2zotero.main(args)
+    assert "Merged 1 identical captures:" in capsys.readouterr().err
+    with open("tmp/test-content-stats.json") as filehandle:
+        assert json.load(filehandle)["counters"]["files hashed"] == 0
+
+def test_17_xml_metacharacters():
+    """ Sources and titles with XML metacharacters stay intact """
+    import io
+    import bench_s2z
+    import xml.etree.cElementTree as ElementTree
+    bench_s2z.make_scrapbook("tmp/test-escape", items=10, depth=1, pdf_ratio=0, dup_ratio=0)
+    rdffname = "tmp/test-escape/scrapbook.rdf"
+    with io.open(rdffname, encoding="utf-8") as filehandle:
+        rdf = filehandle.read()
+    title = u'<b>"Tom & Jerry"</b> > cartoons'
+    source = u'http://example.com/?q="a<b>"&x=1'
+    rdf = rdf.replace(u'NS1:title="Page 5 &amp; friends"',
+                      u'NS1:title="%s"' % bench_s2z.escape(title))
+    rdf = rdf.replace(u'NS1:source="http://example.com/5/page.html?a=1&amp;b=2"',
+                      u'NS1:source="%s"' % bench_s2z.escape(source))
+    with io.open(rdffname, "w", encoding="utf-8") as filehandle:
+        filehandle.write(rdf)
+    scrapbook2zotero.main(["tmp/test-escape", "tmp/test-escape.rdf"])
+    output = ElementTree.parse("tmp/test-escape.rdf").getroot()
+    titles = [elem.text for elem in output.iter("{http://purl.org/dc/elements/1.1/}title")]
+    assert scrapbook2zotero.neuter_name(title).strip() in titles
+    rdf_ns = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}"
+    assert source in [elem.get(rdf_ns + "about")
+                      for elem in output.findall("{http://purl.org/net/biblio#}Document")]
+    assert source in [elem.text for elem in output.iter(rdf_ns + "value")]
+    assert source in [elem.get(rdf_ns + "resource")
+                      for elem in output.iter("{http://purl.org/dc/terms/}hasPart")]
+    assert scrapbook2zotero.xml_escape(u'a&b<c>d"e') == u'a&amp;b&lt;c&gt;d&quot;e'
+
+def test_18_item_dates():
+    """ Item dates from ids, with fallbacks for ids which are not timestamps """
+    import io
+    import bench_s2z
+    import xml.etree.cElementTree as ElementTree
+    S2Z = scrapbook2zotero
+    assert S2Z.format_timestamp(u"20170808125614") == u"2017-08-08 12:56:14"
+    assert S2Z.format_timestamp("20170808125614") == u"2017-08-08 12:56:14"
+    for nodeid in [u"", u"2017080812561", u"201708081256140", u"20171308125614",
+                   u"20170800125614", u"20170808245614", u"2017-08-08 1256",
+                   u"recovered", u"\u0662" * 14, u"20170808125614\n", u"20180231125614",
+                   u"20190229125614", u"19000229125614", u"20170431125614"]:
+        assert S2Z.format_timestamp(nodeid) is None
+    for nodeid in [u"20160229125614", u"20000229125614", u"20170131125614"]:
+        assert S2Z.format_timestamp(nodeid) == time.strftime(
+            u"%Y-%m-%d %H:%M:%S", time.strptime(nodeid, "%Y%m%d%H%M%S"))
+    # lost folders with names which are not timestamps
+    bench_s2z.make_scrapbook("tmp/test-dates", items=3, depth=1, pdf_ratio=0, dup_ratio=0)
+    bench_s2z.make_item_dir("tmp/test-dates", "recovered", u"Recovered", u"", False)
+    with io.open("tmp/test-dates/data/recovered/index.dat", "w", encoding="utf-8") as filehandle:
+        filehandle.write(u"id\trecovered\ncreate\t20120304050607\ntitle\tRecovered\n")
+    bench_s2z.make_item_dir("tmp/test-dates", "no-dat", u"No index.dat", u"", True)
+    os.remove("tmp/test-dates/data/no-dat/index.dat")
+    os.utime("tmp/test-dates/data/no-dat/index.html", (1300000000, 1300000000))
+    scrapbook2zotero.main(["tmp/test-dates", "tmp/test-dates.rdf"])
+    output = ElementTree.parse("tmp/test-dates.rdf").getroot()
+    dates = {}
+    for elem in output.findall("{http://www.zotero.org/namespaces/export#}Attachment"):
+        date = elem.find("{http://purl.org/dc/terms/}dateSubmitted")
+        if date is not None: # not a PDF
+            dates[elem.get("{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about")] = date.text
+    assert dates["#item_20100101000000"] == "2010-01-01 00:00:00"
+    assert dates["#item_recovered"] == "2012-03-04 05:06:07"
+    assert dates["#item_no-dat"] == time.strftime("%Y-%m-%d %H:%M:%S",
+                                                  time.localtime(1300000000))
+
+def test_19_lazy_imports():
+    """ Slow modules are not imported until they are needed """
+    import sys
+    loaded = subprocess.check_output([
+        sys.executable, "-c", "import sys, scrapbook2zotero; "
+        "print(' '.join(name for name in ['rdflib', 'multiprocessing', 'cProfile', 'ctypes'] "
+        "if name in sys.modules))"])
+    assert loaded.strip() == b""
+
+def test_20_batch(capsys):
+    """ Testing export of many scrapbooks at once (batch subcommand) """
+    import io
+    import json
+    import shutil
+    for fname in ["tmp/test-batch-1.rdf", "tmp/test-batch-2.rdf"]:
+        if os.path.exists(fname):
+            os.remove(fname)
+    with io.open("tmp/test-batch.txt", "w", encoding="utf-8") as filehandle:
+        filehandle.write(u"# scrapbook\toutput\n"
+                         u"scrapbook_test_data\ttmp/test-batch-1.rdf\n"
+                         u"tmp/no-such-scrapbook\ttmp/test-batch-missing.rdf\n"
+                         u"\n"
+                         u"scrapbook_test_data\ttmp/test-batch-2.rdf\n")
+    code = scrapbook2zotero.main(["batch", "tmp/test-batch.txt", "--processes", "2",
+                                  "--summary", "tmp/test-batch.json", "--", "--nodedup"])
+    assert code == 1
+    out = capsys.readouterr().out
+    assert "3 scrapbooks, 1 failed, 14 items" in out
+    assert "tmp/no-such-scrapbook/scrapbook.rdf" in out
+    assert filecmp.cmp("samples/standard-no-dedup.rdf", "tmp/test-batch-1.rdf")
+    assert filecmp.cmp("samples/standard-no-dedup.rdf", "tmp/test-batch-2.rdf")
+    with open("tmp/test-batch.json") as filehandle:
+        summary = json.load(filehandle)
+    assert [item["items"] for item in summary["scrapbooks"]] == [7, 0, 7]
+    assert summary["scrapbooks"][1]["error"].startswith("can't read")
+    assert summary["totals"]["failed"] == 1
+    # --glob names outputs after scrapbook directories
+    if os.path.exists("tmp/test-batch-glob"):
+        shutil.rmtree("tmp/test-batch-glob")
+    os.makedirs("tmp/test-batch-glob/out")
+    shutil.copytree("scrapbook_test_data", "tmp/test-batch-glob/alice/Scrapbook")
+    shutil.copytree("scrapbook_test_data", "tmp/test-batch-glob/bob/Scrapbook")
+    code = scrapbook2zotero.main(["batch", "--glob", "tmp/test-batch-glob/*/Scrapbook",
+                                  "--output-dir", "tmp/test-batch-glob/out", "--processes", "1"])
+    assert code == 0
+    assert sorted(os.listdir("tmp/test-batch-glob/out")) == [
+        "alice_Scrapbook.rdf", "bob_Scrapbook.rdf"]
+    capsys.readouterr()
+    with pytest.raises(SystemExit):
+        scrapbook2zotero.main(["batch", "tmp/test-batch.txt", "--", "--state", "x.json"])
+    # abbreviated and --option=value forms are parsed first
+    for option in [["--stage-dir", "tmp/x"], ["--stage=tmp/x", "--pack", "zip"],
+                   ["--hash", "x.json"], ["--stats-j=x.json"]]:
+        with pytest.raises(SystemExit):
+            scrapbook2zotero.main(["batch", "tmp/test-batch.txt", "--"] + option)
+        assert "can't be used in batch" in capsys.readouterr().err
+
+def test_21_index_dat():
+    """ Lost folders get title, source and type from index.dat """
+    import io
+    import bench_s2z
+    S2Z = scrapbook2zotero
+    assert S2Z.parse_index_dat(b"id\t1\r\ntitle\tA\tB\r\nbad line\n") == {
+        u"id": u"1", u"title": u"A\tB"}
+    # not UTF-8, encoding is given by chars
+    fields = S2Z.parse_index_dat(u"title\t\u041f\u0440\u0438\u0432\u0435\u0442\n"
+                                 u"chars\twindows-1251\n".encode("windows-1251"))
+    assert fields[u"title"] == u"\u041f\u0440\u0438\u0432\u0435\u0442"
+    assert S2Z.parse_index_dat(b"title\t\xff\nchars\tno-such-encoding\n")[u"title"] == u"\ufffd"
+    assert S2Z.read_index_dat("tmp/no-such-dir/index.dat") == {}
+
+    bench_s2z.make_scrapbook("tmp/test-index-dat", items=5, depth=1, pdf_ratio=0,
+                             dup_ratio=0, lost_folders=2)
+    with io.open("tmp/test-index-dat/data/20100101000006/index.dat", "wb") as filehandle:
+        filehandle.write(u"id\t20100101000006\ntype\tnote\n"
+                         u"title\t\u041f\u0440\u0438\u0432\u0435\u0442\n"
+                         u"chars\twindows-1251\nsource\thttp://example.com/lost\n"
+                         .encode("windows-1251"))
+    # item of scrapbook.rdf with different index.dat
+    with io.open("tmp/test-index-dat/data/20100101000001/index.dat", "wb") as filehandle:
+        filehandle.write(b"id\t20100101000001\ntitle\tOther title\n")
+    manifest = S2Z.DataManifest("tmp/test-index-dat", 2)
+    root, nodes = S2Z.open_scrapbook_rdf("tmp/test-index-dat", manifest=manifest)
+    lost = dict((node.nodeid, node) for node in root.children
+                if node.nodeid not in nodes)
+    assert sorted(lost) == ["20100101000006", "20100101000007"]
+    assert lost["20100101000006"].name == u"\u041f\u0440\u0438\u0432\u0435\u0442"
+    assert lost["20100101000006"].source == u"http://example.com/lost"
+    assert lost["20100101000006"].type == u"note"
+    assert lost["20100101000007"].name == u"Lost 20100101000007"
+    assert lost["20100101000007"].create == u"20100101000007"
+    items = S2Z.rdf_file_to_items("tmp/test-index-dat/scrapbook.rdf")
+    assert S2Z.check_index_dats(items, manifest) == 1
+
+def test_22_item_cache(monkeypatch):
+    """ Parsed scrapbook.rdf is reused from --cache-dir until it changes """
+    import io
+    import shutil
+    import bench_s2z
+    S2Z = scrapbook2zotero
+    if os.path.exists("tmp/test-item-cache"):
+        shutil.rmtree("tmp/test-item-cache")
+    for fname in ["tmp/test-item-cache-1.rdf", "tmp/test-item-cache-2.rdf"]:
+        run_main_and_compare(["scrapbook_test_data", fname, "--cache-dir", "tmp/test-item-cache",
+                              "--stats"], "samples/standard.rdf", fname)
+    assert S2Z.STATS.counters["item cache hits"] == 1
+
+    bench_s2z.make_scrapbook("tmp/test-item-cache-sb", items=5, depth=1, pdf_ratio=0,
+                             dup_ratio=0)
+    rdffilename = "tmp/test-item-cache-sb/scrapbook.rdf"
+    cache = S2Z.ItemCache("tmp/test-item-cache")
+    assert cache.load(rdffilename, "stream") is None
+    items = S2Z.rdf_file_to_items(rdffilename)
+    cache.save(rdffilename, "stream", items)
+    assert cache.load(rdffilename, "stream") == items
+    # other parser may read it differently
+    assert cache.load(rdffilename, "rdflib") is None
+    # touched, but content is the same
+    mtime = os.stat(rdffilename).st_mtime
+    os.utime(rdffilename, (mtime + 10, mtime + 10))
+    assert cache.load(rdffilename, "stream") == items
+    # changed, same size
+    with io.open(rdffilename, "rb") as filehandle:
+        data = filehandle.read()
+    with io.open(rdffilename, "wb") as filehandle:
+        filehandle.write(data.replace(b"Page 1 ", b"Page X "))
+    os.utime(rdffilename, (mtime + 20, mtime + 20))
+    assert cache.load(rdffilename, "stream") is None
+
+    # cache directory made by other process of batch after it was checked
+    checks = []
+    isdir = os.path.isdir
+    def racing_isdir(path):
+        """ First check misses directory made meanwhile """
+        checks.append(path)
+        return len(checks) > 1 and isdir(path)
+    monkeypatch.setattr(os.path, "isdir", racing_isdir)
+    S2Z.ItemCache("tmp/test-item-cache")
+    assert len(checks) == 2
+
+def test_23_stage_dir():
+    """ Data directories are staged, RDF refers to staged files """
+    import io
+    import shutil
+    if os.path.exists("tmp/test-stage"):
+        shutil.rmtree("tmp/test-stage")
+    scrapbook2zotero.main(["scrapbook_test_data", "tmp/test-stage.rdf", "--stage-dir",
+                           "tmp/test-stage", "--jobs", "2", "--stats"])
+    counters = scrapbook2zotero.STATS.counters
+    assert counters["files staged"] > 0
+    assert counters["files unchanged"] == 0
+    with io.open("samples/standard.rdf", encoding="utf-8") as filehandle:
+        expected = filehandle.read().replace('"scrapbook_test_data/data/',
+                                             '"tmp/test-stage/data/')
+    with io.open("tmp/test-stage.rdf", encoding="utf-8") as filehandle:
+        assert filehandle.read() == expected
+    assert filecmp.cmp("scrapbook_test_data/data/20180222112456/index.html",
+                       "tmp/test-stage/data/20180222112456/index.html", shallow=False)
+    # second run has nothing to copy
+    staged = counters["files staged"]
+    scrapbook2zotero.main(["scrapbook_test_data", "tmp/test-stage.rdf", "--stage-dir",
+                           "tmp/test-stage", "--stats"])
+    assert scrapbook2zotero.STATS.counters["files unchanged"] == staged
+    assert scrapbook2zotero.STATS.counters["files staged"] == 0
+    # other filesystem: copied, keeping mtime
+    target = "tmp/test-stage/copied.html"
+    source = "scrapbook_test_data/data/20180222112456/index.html"
+    assert scrapbook2zotero.stage_file(source, target, link=False) == "copied"
+    assert not os.path.samefile(source, target)
+    assert scrapbook2zotero.stage_file(source, target, link=False) == "unchanged"
+
+def test_24_sqlite(monkeypatch):
+    """ Items, attachments, tags and collections go straight into Zotero database """
+    import sqlite3
+    import bench_s2z
+    bench_s2z.make_zotero_db("tmp/test-zotero.sqlite")
+    # scrapbook times are local, Zotero keeps UTC
+    monkeypatch.setenv("TZ", "MSK-3")
+    time.tzset()
+    try:
+        scrapbook2zotero.main(["scrapbook_test_data", "tmp/test-zotero.sqlite", "--format",
+                               "sqlite"])
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+    with open("samples/standard.rdf") as filehandle:
+        rdf = filehandle.read()
+    connection = sqlite3.connect("tmp/test-zotero.sqlite")
+    def count(query):
+        """ Single number from database """
+        return connection.execute(query).fetchone()[0]
+    assert count("SELECT COUNT(*) FROM items WHERE itemTypeID = 13") == rdf.count("<bib:Document ")
+    assert count("SELECT COUNT(*) FROM itemAttachments") == rdf.count("<z:Attachment ")
+    assert count("SELECT COUNT(*) FROM collections") == rdf.count("<z:Collection ")
+    assert count("SELECT COUNT(*) FROM collectionItems") == rdf.count('hasPart rdf:resource="http')
+    assert count("SELECT COUNT(*) FROM itemTags") == rdf.count("<dc:subject>") - rdf.count(
+        "<dc:subject></dc:subject>")
+    # the same keys and links as RDF import would make
+    assert count("SELECT COUNT(DISTINCT key) FROM items") == count("SELECT COUNT(*) FROM items")
+    assert count("SELECT COUNT(*) FROM collections WHERE parentCollectionID IS NOT NULL") == 1
+    assert count("SELECT COUNT(*) FROM itemAttachments WHERE parentItemID NOT IN "
+                 "(SELECT itemID FROM items WHERE itemTypeID = 13)") == 0
+    path, = connection.execute("SELECT path FROM itemAttachments WHERE contentType = "
+                               "'application/pdf'").fetchone()
+    assert os.path.isfile(path)
+    title, = connection.execute(
+        "SELECT value FROM itemData JOIN itemDataValues USING (valueID) JOIN items "
+        "USING (itemID) WHERE itemTypeID = 13 AND fieldID = 110 ORDER BY itemID").fetchone()
+    assert title in rdf.decode("utf-8")
+    assert count("SELECT dateAdded FROM items JOIN itemAttachments USING (itemID) WHERE "
+                 "contentType = 'application/pdf'") == "2017-08-08 09:56:14"
+    connection.close()
+
+    # items without date are added now
+    database = scrapbook2zotero.ZoteroDB("tmp/test-zotero.sqlite")
+    itemid = database.add_item("webpage", u"no date", scrapbook2zotero.utc_date(u""))
+    database.flush()
+    database.close()
+    connection = sqlite3.connect("tmp/test-zotero.sqlite")
+    assert connection.execute("SELECT dateAdded FROM items WHERE itemID = ?",
+                              (itemid,)).fetchone()[0].startswith(time.strftime("%Y-"))
+    connection.close()
+
+    # collections of left out items are not made, same as in RDF
+    bench_s2z.make_zotero_db("tmp/test-zotero.sqlite")
+    scrapbook2zotero.main(["scrapbook_test_data", "tmp/test-zotero.sqlite", "--format",
+                           "sqlite", "--exclude", "1-100"])
+    scrapbook2zotero.main(["scrapbook_test_data", "tmp/test-zotero-excluded.rdf",
+                           "--exclude", "1-100"])
+    with open("tmp/test-zotero-excluded.rdf") as filehandle:
+        rdf = filehandle.read()
+    connection = sqlite3.connect("tmp/test-zotero.sqlite")
+    assert count("SELECT COUNT(*) FROM items") == rdf.count("<bib:Document ") == 0
+    assert count("SELECT COUNT(*) FROM collections") == rdf.count("<z:Collection ") == 0
+    connection.close()
+
+    # not a Zotero database
+    with open("tmp/test-zotero-bad.sqlite", "w"):
+        pass
+    with pytest.raises(scrapbook2zotero.ExportError):
+        scrapbook2zotero.export_sqlite(None, "scrapbook_test_data", None,
+                                       "tmp/test-zotero-bad.sqlite")
+
+def test_25_fulltext(capsys, monkeypatch):
+    """ Text of exported pages goes to full-text index, search finds it """
+    import io
+    import sqlite3
+    S2Z = scrapbook2zotero
+    # several chunks, written while export goes on
+    monkeypatch.setattr(S2Z, "FULLTEXT_CHUNK_SIZE", 2)
+    with io.open("tmp/test-fulltext.html", "wb") as filehandle:
+        filehandle.write(u"<html><head><title>\u041f\u0440\u0438\u0432\u0435\u0442</title>"
+                         u"<style>p {color: red}</style><script>var x = '<p>';</script>"
+                         u"</head><body><p>Fish &amp; <b>chi</b>ps&#33;\n\n  &#x41;</p>"
+                         u"</body></html>"
+                         .encode("windows-1251"))
+    assert S2Z.extract_text("tmp/test-fulltext.html", u"windows-1251") == (
+        u"\u041f\u0440\u0438\u0432\u0435\u0442 Fish & chips! A")
+    assert S2Z.extract_text("tmp/no-such-file.html") == u""
+
+    if os.path.exists("tmp/test-fulltext.sqlite"):
+        os.remove("tmp/test-fulltext.sqlite")
+    for workers in ["1", "2"]:
+        run_main_and_compare(["scrapbook_test_data", "tmp/test-fulltext.rdf", "--fulltext",
+                              "tmp/test-fulltext.sqlite", "--workers", workers],
+                             "samples/standard.rdf", "tmp/test-fulltext.rdf")
+    connection = sqlite3.connect("tmp/test-fulltext.sqlite")
+    # second run replaced pages of the first one
+    assert connection.execute("SELECT COUNT(*) FROM pages").fetchone()[0] == 7
+    assert connection.execute("SELECT COUNT(*) FROM fulltext").fetchone()[0] == 7
+    connection.close()
+
+    capsys.readouterr()
+    assert S2Z.main(["search", "tmp/test-fulltext.sqlite", "seamonkey", "ubuntu"]) == 0
+    output = capsys.readouterr()[0]
+    assert output.startswith("20180222115430\t")
+    assert "[SeaMonkey]" in output
+    assert S2Z.main(["search", "tmp/test-fulltext.sqlite", "nosuchword"]) == 1
+    assert S2Z.main(["search", "tmp/no-such-index.sqlite", "word"]) == 2
+
+def test_26_selectors_and_bisect(capsys):
+    """ --exclude and --include take ranges, ids and patterns, bisect finds a record """
+    S2Z = scrapbook2zotero
+    for selectors in [["--include", "2-3", "5-"],
+                      ["--exclude", "id:20180222112456", "url:*SEAMONKEY*"],
+                      ["--exclude", "1", "title:how to install*"]]:
+        run_main_and_compare(["scrapbook_test_data", "tmp/test-selectors.rdf"] + selectors,
+                             "samples/standard_1_4_excluded.rdf", "tmp/test-selectors.rdf")
+    selector = S2Z.Selector(["3", "10-20", "15-30", "50-"])
+    assert (selector.starts, selector.ends) == ([10, 50], [30, S2Z.sys.maxsize])
+    node = S2Z.Node("20180222112456", None)
+    assert [number for number in range(60) if selector.matches(number, node)] == (
+        [3] + list(range(10, 31)) + list(range(50, 60)))
+    for wrong in ["5-2", "title:", "name:x", "x"]:
+        with pytest.raises(ValueError):
+            S2Z.Selector([wrong])
+    with pytest.raises(SystemExit):
+        S2Z.parse_args(["scrapbook_test_data", "tmp/x.rdf", "--exclude", "1-x"])
+
+    for fname in ["tmp/test-bisect.rdf.bisect"]:
+        if os.path.exists(fname):
+            os.remove(fname)
+    bisect = ["bisect", "scrapbook_test_data", "tmp/test-bisect.rdf"]
+    # record 6 hangs: 1-4 good, 5-6 bad, 5 good
+    for verdict in [[], ["--good"], ["--bad"], ["--good"]]:
+        assert S2Z.main(bisect + verdict + ["--", "--nocoll"]) == 0
+    output = capsys.readouterr()[0]
+    assert "records 1-4 of suspected 1-7" in output
+    assert "records 5-5 of suspected 5-6" in output
+    assert output.endswith("Record #6 of 7 hangs Zotero import. Export everything with "
+                           "'--exclude 6', or only it with '--include 6'.\n")
+    with open("tmp/test-bisect.bisect03.rdf") as filehandle:
+        step = filehandle.read()
+    assert step.count("<bib:Document ") == 1
+    assert "<z:Collection " not in step
+    for option in [["--include", "1"], ["--inc=1"], ["--chunk", "2"], ["--form", "sqlite"]]:
+        with pytest.raises(SystemExit):
+            S2Z.main(bisect + ["--reset", "--"] + option)
+        assert "can't be used in bisect" in capsys.readouterr()[1]
+
+def test_27_folders(capsys):
+    """ --folder exports only given folders, tags and collections start from them """
+    import io
+    import bench_s2z
+    S2Z = scrapbook2zotero
+    second = (u"\u0412\u0442\u043e\u0440\u043e\u0439 "
+              u"\u043a\u043e\u0440\u043d\u0435\u0432\u043e\u0439 "
+              u"\u043a\u0430\u0442\u0430\u043b\u043e\u0433")
+    sub = u"\u041f\u043e\u0434\u043a\u0430\u0442\u0430\u043b\u043e\u0433\u0433"
+    with io.open("samples/standard.rdf", encoding="utf-8") as filehandle:
+        standard = filehandle.read()
+    # top level folder: entries are the same as in export of everything
+    for folder in [second.encode("utf-8"), "20180222113242", "/" + second.encode("utf-8") + "/"]:
+        S2Z.main(["scrapbook_test_data", "tmp/test-folder.rdf", "--folder", folder])
+        with io.open("tmp/test-folder.rdf", encoding="utf-8") as filehandle:
+            output = filehandle.read()
+        assert output.count(u"<bib:Document ") == 2
+        assert output.count(u"<z:Collection ") == 2
+        for entry in output.split(u"\n    <")[1:-1]:
+            assert u"\n    <" + entry in standard
+    # subfolder becomes top level, nested selection is exported once
+    S2Z.main(["scrapbook_test_data", "tmp/test-folder.rdf", "--folder",
+              (second + u"/" + sub).encode("utf-8"), "--folder", "20180222113317"])
+    with io.open("tmp/test-folder.rdf", encoding="utf-8") as filehandle:
+        output = filehandle.read()
+    assert output.count(u"<bib:Document ") == 1
+    assert u"<dc:subject>%s</dc:subject>" % sub in output
+    assert output.count(u"<z:Collection ") == 1
+    with pytest.raises(S2Z.ExportError):
+        S2Z.find_folders(S2Z.rdf_file_to_items("scrapbook_test_data/scrapbook.rdf"),
+                         ["20180222112456"])
+
+    # lost items and folders are not looked for
+    bench_s2z.make_scrapbook("tmp/test-folder-sb", items=20, depth=1, pdf_ratio=0,
+                             dup_ratio=0, lost_folders=2, lost_items=2)
+    items = S2Z.rdf_file_to_items("tmp/test-folder-sb/scrapbook.rdf")
+    folderid = items[S2Z.ROOT_ID].children[0]
+    manifest = S2Z.DataManifest("tmp/test-folder-sb")
+    root, nodes = S2Z.open_scrapbook_rdf("tmp/test-folder-sb", manifest=manifest,
+                                         folders=[folderid])
+    assert [node.nodeid for node in root.children] == [folderid]
+    assert set(nodes) < set(items)
+    assert not manifest.entries
+
+    # bisect numbers records of the selected folders only
+    if os.path.exists("tmp/test-folder-bisect.rdf.bisect"):
+        os.remove("tmp/test-folder-bisect.rdf.bisect")
+    capsys.readouterr()
+    bisect = ["bisect", "scrapbook_test_data", "tmp/test-folder-bisect.rdf"]
+    assert S2Z.main(bisect + ["--", "--folder", "20180222113242"]) == 0
+    assert "records 1-1 of suspected 1-2 (items: 1)" in capsys.readouterr()[0]
+    assert S2Z.main(bisect + ["--bad"]) == 0
+    assert "Record #1 of 2 hangs Zotero import" in capsys.readouterr()[0]
+
+def test_28_pack():
+    """ Item directories are packed into single files, PDFs stay separate """
+    import io
+    import re
+    import base64
+    import shutil
+    import zipfile
+    S2Z = scrapbook2zotero
+    for path in ["tmp/test-pack-zip", "tmp/test-pack-html"]:
+        if os.path.exists(path):
+            shutil.rmtree(path)
+    S2Z.main(["scrapbook_test_data", "tmp/test-pack.rdf", "--stage-dir", "tmp/test-pack-zip",
+              "--pack", "zip", "--workers", "2", "--stats"])
+    counters = S2Z.STATS.counters
+    assert counters["files before packing"] == 63
+    assert counters["files after packing"] == 8
+    with io.open("tmp/test-pack.rdf", encoding="utf-8") as filehandle:
+        rdf = filehandle.read()
+    assert rdf.count(u"<link:type>application/zip</link:type>") == 7
+    assert u'"tmp/test-pack-zip/data/20170808125614/11_beauchamp.pdf"' in rdf
+    assert os.path.isfile("tmp/test-pack-zip/data/20170808125614/11_beauchamp.pdf")
+    archive = zipfile.ZipFile("tmp/test-pack-zip/data/20170808125614.zip")
+    assert sorted(archive.namelist()) == ["index.dat", "index.html"]
+    archive = zipfile.ZipFile("tmp/test-pack-zip/data/20180308231656.zip")
+    assert len(archive.namelist()) == 24
+    assert archive.getinfo("index.html").compress_type == zipfile.ZIP_DEFLATED
+    assert archive.getinfo("logo.gif").compress_type == zipfile.ZIP_STORED
+    assert archive.read("logo.gif") == open(
+        "scrapbook_test_data/data/20180308231656/logo.gif", "rb").read()
+    # nothing changed, nothing to pack
+    S2Z.main(["scrapbook_test_data", "tmp/test-pack.rdf", "--stage-dir", "tmp/test-pack-zip",
+              "--pack", "zip", "--stats"])
+    assert S2Z.STATS.counters["items unchanged"] == 7
+    assert S2Z.STATS.counters["items packed"] == 0
+
+    S2Z.main(["scrapbook_test_data", "tmp/test-pack.rdf", "--stage-dir", "tmp/test-pack-html",
+              "--pack", "html"])
+    with io.open("tmp/test-pack.rdf", encoding="utf-8") as filehandle:
+        rdf = filehandle.read()
+    assert u'"tmp/test-pack-html/data/20180308231656.html"' in rdf
+    assert u"application/zip" not in rdf
+    with open("tmp/test-pack-html/data/20180308231656.html", "rb") as filehandle:
+        page = filehandle.read()
+    # images and style sheets with their images are inlined, other links are not
+    assert b'src="counter.gif"' not in page
+    assert b'src="data:image/gif;base64,' in page
+    assert b'src="about:blank"' in page
+    assert b'href="http://citforum.ru/"' in page
+    styles = [base64.b64decode(uri) for uri in
+              re.findall(b'href="data:text/css;base64,([^"]*)"', page)]
+    assert len(styles) == 3
+    assert any(b'url("data:image/gif;base64,' in style for style in styles)
+    # frames with their own style sheets
+    with open("tmp/test-pack-html/data/20180222115534.html", "rb") as filehandle:
+        page = filehandle.read()
+    assert page.count(b'<iframe src="data:text/html;base64,') == 6
+    # links out of item directory are left alone
+    inliner = S2Z.PageInliner("scrapbook_test_data/data/20180308231656")
+    assert inliner.inline_html(b'<img src="../20180308231918/w1.gif">',
+                               inliner.basedir) == b'<img src="../20180308231918/w1.gif">'
+    assert inliner.inline_html(b"<IMG SRC='1x1.gif'>", inliner.basedir).startswith(
+        b'<IMG SRC="data:image/gif;base64,')
+    with pytest.raises(SystemExit):
+        S2Z.parse_args(["scrapbook_test_data", "tmp/test-pack.rdf", "--pack", "zip"])
+
+def test_29_verify(capsys):
+    """ Checking written RDF: XML, links between records, attached files """
+    import io
+    S2Z = scrapbook2zotero
+    assert S2Z.main(["verify", "samples/standard.rdf"]) == 0
+    assert "7 items, 8 attachments, 8 attached files, 3 collections, 0 problems" in \
+        capsys.readouterr().out
+    # chunks are checked one by one, records are numbered across them
+    S2Z.main(["scrapbook_test_data", "tmp/test-verify.rdf", "--chunk-size", "3", "--verify"])
+    assert S2Z.main(["verify", "tmp/test-verify.001.rdf", "tmp/test-verify.002.rdf",
+                     "tmp/test-verify.003.rdf"]) == 0
+
+    # collections don't link to excluded items
+    S2Z.main(["scrapbook_test_data", "tmp/test-verify.rdf", "--exclude", "2", "4", "--verify"])
+    assert "0 problems" in capsys.readouterr().err
+    # links to items left out are reported with their numbers for --exclude
+    with io.open("tmp/test-verify.rdf", encoding="utf-8") as filehandle:
+        rdf = filehandle.read()
+    link = (u'        <dcterms:hasPart '
+            u'rdf:resource="http://linuxpitstop.com/install-seamonkey-on-ubuntu/"/>\n')
+    footer = u"    </z:Collection>"
+    with io.open("tmp/test-verify-excluded.rdf", "w", encoding="utf-8") as filehandle:
+        filehandle.write(rdf.replace(footer, link + footer, 1))
+    verifier = S2Z.RdfVerifier({u"http://linuxpitstop.com/install-seamonkey-on-ubuntu/": 4},
+                               io.BytesIO())
+    verifier.verify("tmp/test-verify-excluded.rdf")
+    assert "(record #4, excluded or skipped)" in verifier.filehandle.getvalue()
+    assert verifier.problems == 1
+
+    with io.open("samples/standard.rdf", encoding="utf-8") as filehandle:
+        rdf = filehandle.read()
+    third = rdf.index(u"http://linuxpitstop.com/install-seamonkey-on-ubuntu/")
+    title = rdf.index(u"<dc:title>", third)
+    pdf = u"scrapbook_test_data/data/20170808125614/11_beauchamp.pdf"
+    broken = (rdf[:title + 10] + u"Tom & Jerry" + rdf[title + 10:]).replace(pdf, pdf + u"x")
+    with io.open("tmp/test-verify-broken.rdf", "w", encoding="utf-8") as filehandle:
+        filehandle.write(broken.replace(u'rdf:resource="#item_20180222115534"/>', u'/>'))
+    assert S2Z.main(["verify", "tmp/test-verify-broken.rdf"]) == 1
+    out = capsys.readouterr().out
+    assert "#4 http://linuxpitstop.com/install-seamonkey-on-ubuntu/: broken XML" in out
+    assert "#5 http://www.lpi.usra.edu/opag/" in out and pdf + "x' does not exist" in out
+    # record of attachment with missing item link is not known
+    assert "attachment #item_20180222115534" not in out
+
+    with io.open("tmp/test-verify-links.rdf", "w", encoding="utf-8") as filehandle:
+        filehandle.write(rdf.replace(u'<z:Attachment rdf:about="#item_20180222115534">',
+                                     u'<z:Attachment rdf:about="#item_none">')
+                         .replace(u'hasPart rdf:resource="#collection_20180222113317"',
+                                  u'hasPart rdf:resource="#collection_none"'))
+    assert S2Z.main(["verify", "tmp/test-verify-links.rdf"]) == 1
+    out = capsys.readouterr().out
+    assert ("#3 http://polit.ru/article/2010/07/01/zalizniak/: link to attachment "
+            "'#item_20180222115534' which is not in file") in out
+    assert "link to subcollection '#collection_none' which is not in file" in out
+    assert "2 problems" in out
+
+def test_30_analyze(capsys, monkeypatch):
+    """ Sizes of folders, largest PDFs and lost items, without exporting """
+    import json
+    import bench_s2z
+    S2Z = scrapbook2zotero
+    assert S2Z.main(["analyze", "scrapbook_test_data", "--json", "tmp/test-analyze.json",
+                     "--jobs", "2"]) == 0
+    out = capsys.readouterr().out
+    assert "7 items in 3 folders, 63 files, 3.7 MB, 1 PDFs (2.5 MB)" in out
+    assert "20170808125614  11_beauchamp.pdf" in out
+    with open("tmp/test-analyze.json") as filehandle:
+        analysis = json.load(filehandle)
+    assert analysis["totals"] == {"items": 7, "files": 63, "bytes": 3902398,
+                                  "pdfs": 1, "pdf_bytes": 2643145}
+    collections = dict((collection["path"], collection["total"]["items"])
+                       for collection in analysis["collections"])
+    first = (u"/\u041a\u043e\u0440\u043d\u0435\u0432\u043e\u0439 "
+             u"\u043a\u0430\u0442\u0430\u043b\u043e\u0433")
+    second = (u"/\u0412\u0442\u043e\u0440\u043e\u0439 "
+              u"\u043a\u043e\u0440\u043d\u0435\u0432\u043e\u0439 "
+              u"\u043a\u0430\u0442\u0430\u043b\u043e\u0433")
+    third = second + u"/\u041f\u043e\u0434\u043a\u0430\u0442\u0430\u043b\u043e\u0433\u0433"
+    assert collections == {u"": 7, first: 1, second: 2, third: 1}
+    assert analysis["largest_pdfs"][0]["file"] == "11_beauchamp.pdf"
+    assert analysis["lost_items"] == analysis["lost_folders"] == []
+
+    bench_s2z.make_scrapbook("tmp/test-analyze-sb", items=20, depth=1, pdf_ratio=0,
+                             dup_ratio=0, lost_folders=2, lost_items=2)
+    assert S2Z.main(["analyze", "tmp/test-analyze-sb", "--json", "tmp/test-analyze.json"]) == 0
+    out = capsys.readouterr().out
+    with open("tmp/test-analyze.json") as filehandle:
+        analysis = json.load(filehandle)
+    assert len(analysis["lost_items"]) == 2
+    assert len(analysis["lost_folders"]) == 2
+    assert "Lost items: 2, lost folders (data directories without item): 2" in out
+
+    # lost data directories are not read again after walking them for sizes
+    monkeypatch.setattr(S2Z, "_SCANDIR", [None])
+    read = []
+    list_dir = S2Z.list_dir
+    def recording_list_dir(a_dir, only=None):
+        """ list_dir() recording directories read """
+        read.append(a_dir)
+        return list_dir(a_dir, only)
+    monkeypatch.setattr(S2Z, "list_dir", recording_list_dir)
+    assert S2Z.main(["analyze", "tmp/test-analyze-sb", "--json", "tmp/test-analyze.json"]) == 0
+    with open("tmp/test-analyze.json") as filehandle:
+        assert len(json.load(filehandle)["lost_folders"]) == 2
+    assert read == ["tmp/test-analyze-sb/data"]
+
+def test_31_listdir(monkeypatch):
+    """ Without scandir() item directories cost a few stat() calls, not one per file """
+    S2Z = scrapbook2zotero
+    monkeypatch.setattr(S2Z, "_SCANDIR", [None])
+    checked = []
+    isfile = os.path.isfile
+    def counting_isfile(path):
+        """ os.path.isfile() counting calls """
+        checked.append(path)
+        return isfile(path)
+    monkeypatch.setattr(os.path, "isfile", counting_isfile)
+    entries = S2Z.list_item_dir("scrapbook_test_data/data/20170808125614")
+    assert entries.files == set(["index.html", "index.dat"])
+    assert "11_beauchamp.pdf" in entries.names
+    assert len(checked) == 2
+    run_main_and_compare(["scrapbook_test_data", "tmp/test-listdir.rdf"],
+                         "samples/standard.rdf", "tmp/test-listdir.rdf")
+
+def test_32_state_moves(capsys):
+    """ Incremental export follows items moved to other folders and deleted ones """
+    import io
+    import json
+    import shutil
+    import sqlite3
+    import bench_s2z
+    S2Z = scrapbook2zotero
+    if os.path.exists("tmp/test-state-move"):
+        shutil.rmtree("tmp/test-state-move")
+    shutil.copytree("scrapbook_test_data", "tmp/test-state-move")
+    for fname in ["tmp/test-state-move.json", "tmp/test-state-move-db.json"]:
+        if os.path.exists(fname):
+            os.remove(fname)
+    bench_s2z.make_zotero_db("tmp/test-state-move.sqlite")
+    rdf = ["tmp/test-state-move", "tmp/test-state-move.rdf", "--state",
+           "tmp/test-state-move.json"]
+    database = ["tmp/test-state-move", "tmp/test-state-move.sqlite", "--format", "sqlite",
+                "--state", "tmp/test-state-move-db.json"]
+    S2Z.main(rdf)
+    S2Z.main(database)
+
+    # item goes from one folder into another, one exported item is gone
+    moved = u'    <RDF:li RDF:resource="urn:scrapbook:item20180222115059"/>\n'
+    with io.open("tmp/test-state-move/scrapbook.rdf", encoding="utf-8") as filehandle:
+        scrapbook = filehandle.read().replace(moved, u"")
+    folder = u'  <RDF:Seq RDF:about="urn:scrapbook:item20180222113242">\n'
+    with io.open("tmp/test-state-move/scrapbook.rdf", "w", encoding="utf-8") as filehandle:
+        filehandle.write(scrapbook.replace(folder, folder + moved))
+    with open("tmp/test-state-move.json") as filehandle:
+        state = json.load(filehandle)
+    assert state["items"]["20180222115059"][5] == "20180222113228"
+    state["items"]["19990101000000"] = ["", "", "gone", "gone", "index.html",
+                                        "20180222113228"]
+    with open("tmp/test-state-move.json", "w") as filehandle:
+        json.dump(state, filehandle)
+    capsys.readouterr()
+
+    S2Z.main(rdf)
+    err = capsys.readouterr().err
+    assert "20180222115059: 20180222113228 -> 20180222113242" in err
+    assert "Deleted 1 items" in err and "19990101000000" in err
+    with io.open("tmp/test-state-move.rdf", encoding="utf-8") as filehandle:
+        output = filehandle.read()
+    assert output.count(u"<bib:Document ") == 1
+    assert u'<z:Collection rdf:about="#collection_20180222113242">' in output
+    assert u"#collection_20180222113228" not in output
+    with open("tmp/test-state-move.json") as filehandle:
+        state = json.load(filehandle)
+    assert state["items"]["20180222115059"][5] == "20180222113242"
+    assert "19990101000000" not in state["items"]
+    # nothing is moved twice
+    S2Z.main(rdf)
+    assert "moved" not in capsys.readouterr().err
+
+    # database loses old membership of moved item
+    S2Z.main(database)
+    connection = sqlite3.connect("tmp/test-state-move.sqlite")
+    def collection_items(folderid):
+        """ Number of items in collection of folder """
+        return connection.execute(
+            "SELECT COUNT(*) FROM collectionItems JOIN collections USING (collectionID) "
+            "WHERE key = ?", (S2Z.zotero_key(u"collection/" + folderid),)).fetchone()[0]
+    assert collection_items("20180222113228") == 0
+    assert collection_items("20180222113242") == 2
+    connection.close()
@@ -0,0 +1,122 @@
+-- Part of Zotero 5 database schema (zotero.sqlite) written by --format=sqlite,
+-- for tests and benchmarks. Item types and fields are looked up by name,
+-- so only the rows used by export are here.
+
+CREATE TABLE version (
+    schema TEXT PRIMARY KEY,
+    version INT NOT NULL
+);
+INSERT INTO version VALUES ('userdata', 112);
+
+CREATE TABLE libraries (
+    libraryID INTEGER PRIMARY KEY,
+    type TEXT NOT NULL,
+    editable INT NOT NULL,
+    filesEditable INT NOT NULL,
+    version INT NOT NULL DEFAULT 0,
+    storageVersion INT NOT NULL DEFAULT 0,
+    lastSync INT NOT NULL DEFAULT 0,
+    archived INT NOT NULL DEFAULT 0
+);
+INSERT INTO libraries (libraryID, type, editable, filesEditable) VALUES (1, 'user', 1, 1);
+
+CREATE TABLE itemTypes (
+    itemTypeID INTEGER PRIMARY KEY,
+    typeName TEXT,
+    templateItemTypeID INT,
+    display INT DEFAULT 1
+);
+INSERT INTO itemTypes (itemTypeID, typeName) VALUES (1, 'note');
+INSERT INTO itemTypes (itemTypeID, typeName) VALUES (13, 'webpage');
+INSERT INTO itemTypes (itemTypeID, typeName) VALUES (14, 'attachment');
+
+CREATE TABLE fields (
+    fieldID INTEGER PRIMARY KEY,
+    fieldName TEXT,
+    fieldFormatID INT
+);
+INSERT INTO fields (fieldID, fieldName) VALUES (1, 'url');
+INSERT INTO fields (fieldID, fieldName) VALUES (6, 'accessDate');
+INSERT INTO fields (fieldID, fieldName) VALUES (110, 'title');
+
+CREATE TABLE items (
+    itemID INTEGER PRIMARY KEY,
+    itemTypeID INT NOT NULL,
+    dateAdded TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    dateModified TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    clientDateModified TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    libraryID INT NOT NULL,
+    key TEXT NOT NULL,
+    version INT NOT NULL DEFAULT 0,
+    synced INT NOT NULL DEFAULT 0,
+    UNIQUE (libraryID, key),
+    FOREIGN KEY (libraryID) REFERENCES libraries(libraryID) ON DELETE CASCADE
+);
+
+CREATE TABLE itemDataValues (
+    valueID INTEGER PRIMARY KEY,
+    value UNIQUE
+);
+
+CREATE TABLE itemData (
+    itemID INT,
+    fieldID INT,
+    valueID,
+    PRIMARY KEY (itemID, fieldID),
+    FOREIGN KEY (itemID) REFERENCES items(itemID) ON DELETE CASCADE,
+    FOREIGN KEY (fieldID) REFERENCES fields(fieldID),
+    FOREIGN KEY (valueID) REFERENCES itemDataValues(valueID)
+);
+
+CREATE TABLE itemAttachments (
+    itemID INTEGER PRIMARY KEY,
+    parentItemID INT,
+    linkMode INT,
+    contentType TEXT,
+    charsetID INT,
+    path TEXT,
+    syncState INT DEFAULT 0,
+    storageModTime INT,
+    storageHash TEXT,
+    lastProcessedModificationTime INT,
+    FOREIGN KEY (itemID) REFERENCES items(itemID) ON DELETE CASCADE,
+    FOREIGN KEY (parentItemID) REFERENCES items(itemID) ON DELETE CASCADE
+);
+CREATE INDEX itemAttachments_parentItemID ON itemAttachments(parentItemID);
+
+CREATE TABLE tags (
+    tagID INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE itemTags (
+    itemID INT NOT NULL,
+    tagID INT NOT NULL,
+    type INT NOT NULL,
+    PRIMARY KEY (itemID, tagID),
+    FOREIGN KEY (itemID) REFERENCES items(itemID) ON DELETE CASCADE,
+    FOREIGN KEY (tagID) REFERENCES tags(tagID) ON DELETE CASCADE
+);
+
+CREATE TABLE collections (
+    collectionID INTEGER PRIMARY KEY,
+    collectionName TEXT NOT NULL,
+    parentCollectionID INT DEFAULT NULL,
+    clientDateModified TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    libraryID INT NOT NULL,
+    key TEXT NOT NULL,
+    version INT NOT NULL DEFAULT 0,
+    synced INT NOT NULL DEFAULT 0,
+    UNIQUE (libraryID, key),
+    FOREIGN KEY (libraryID) REFERENCES libraries(libraryID) ON DELETE CASCADE,
+    FOREIGN KEY (parentCollectionID) REFERENCES collections(collectionID) ON DELETE CASCADE
+);
+
+CREATE TABLE collectionItems (
+    collectionID INT NOT NULL,
+    itemID INT NOT NULL,
+    orderIndex INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (collectionID, itemID),
+    FOREIGN KEY (collectionID) REFERENCES collections(collectionID) ON DELETE CASCADE,
+    FOREIGN KEY (itemID) REFERENCES items(itemID) ON DELETE CASCADE
+);